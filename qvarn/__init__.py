@@ -15,7 +15,21 @@
 
 
 from .version import __version__, __version_info__
-from .log_setup import log, setup_logging
+from .log_setup import (
+    LevelGatedLog,
+    get_accepted_types,
+    log,
+    setup_logging,
+)
+from .metrics import (
+    MetricsRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    MetricTypeMismatch,
+    metrics,
+)
+from .tracing import Tracer, TraceFileWriter, tracer
 from .stopwatch import Stopwatch, stopwatch
 from .idgen import ResourceIdGenerator
 from .schema import schema
@@ -24,11 +38,21 @@ from .resource_type import (
     load_resource_types,
     add_missing_fields,
 )
+from .allow_rules import AllowRuleIndex
+from .pool import ConnectionPool, PoolTimeout
+from .replicas import ReplicaSet
 from .sql import (
     PostgresAdapter,
     quote,
     placeholder,
     get_unique_name,
+    get_statement_name,
+    is_preparable,
+    is_explainable,
+    get_explain_query,
+    prepare_query,
+)
+from .conditions import (
     AccessIsAllowed,
     All,
     Cmp,
@@ -39,12 +63,22 @@ from .sql import (
     LessThan,
     LessOrEqual,
     NotEqual,
+    OneOf,
     ResourceTypeIs,
     Startswith,
     Yes,
     No,
 )
-from .sql_select import sql_select, flatten
+from .sql_select import sql_select, select_matching_keys, flatten
+
+from .blobstore import (
+    MemoryBlobStoreMixin,
+    PostgresBlobStoreMixin,
+    BlobKeyCollision,
+    NoSuchObject,
+    hash_blob,
+    iter_chunks,
+)
 
 from .objstore import (
     ObjectStoreInterface,
@@ -54,11 +88,21 @@ from .objstore import (
     UnknownKey,
     WrongKeyType,
     KeyValueError,
-    NoSuchObject,
-    BlobKeyCollision,
     flatten_object,
 )
 
+from .blobs import (
+    BlobBackendInterface,
+    PostgresBlobBackend,
+    FilesystemBlobBackend,
+    TableChunks,
+    BadBlobHash,
+    UnknownBlobStorage,
+    create_blob_backend,
+    iter_table_chunks,
+    iter_chunks_in_transaction,
+)
+
 from .validator import (
     Validator,
     ValidationError,
@@ -95,11 +139,21 @@ from .responses import (
     created_response,
     need_sort_response,
     no_such_resource_response,
+    not_modified_response,
     ok_response,
+    partial_content_response,
+    range_not_satisfiable_response,
     search_parser_error_response,
     unknown_search_field_response,
 )
 
+from .ranges import (
+    etag_matches,
+    parse_range,
+    iter_range,
+    RangeNotSatisfiable,
+)
+
 from .api_errors import (
     IdMismatch,
     NoSuchResourceType,
@@ -114,7 +168,15 @@ from .notification_router import NotificationRouter
 from .resource_router import ResourceRouter
 from .subresource_router import SubresourceRouter
 from .version_router import VersionRouter
+from .metrics_router import MetricsRouter
 from .allow_router import AllowRouter
 from .timestamp import get_current_timestamp
+from .tokens import decode_token, get_accessors
 
+from .access_log import (
+    AccessLogRetention,
+    AccessLogWriter,
+    UnknownQueuePolicy,
+)
+from .log_writer import AsyncLogWriter
 from .api import QvarnAPI
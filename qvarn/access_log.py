@@ -0,0 +1,230 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+import time
+
+
+import qvarn
+
+
+# The writer keeps its settings and its state as separate attributes.
+class AccessLogWriter:  # pylint: disable=too-many-instance-attributes
+
+    '''Write access log entries in batches, in a background thread.
+
+    Entries get appended to a bounded queue by the request handlers. A
+    writer thread takes entries from the queue and gives them to the
+    write_batch callback, up to max_batch entries at a time. A batch
+    is written when it is full, or when max_delay seconds have passed
+    since the writer thread took its first entry.
+
+    If the queue is full, the when_full policy decides what happens:
+    "block" waits for there to be room in the queue, "drop" throws the
+    entry away (and counts it as dropped), and "write" writes the
+    entry synchronously, bypassing the queue.
+
+    The stop method writes any entries still in the queue. It should
+    be called when the process is shutting down. Entries appended
+    after stop are written at once, in the thread appending them.
+
+    '''
+
+    policies = ('block', 'drop', 'write')
+
+    def __init__(self, write_batch, max_queue=10000, max_batch=100,
+                 max_delay=1.0, when_full='block'):
+        if when_full not in self.policies:
+            raise UnknownQueuePolicy(when_full)
+        self._write_batch = write_batch
+        self._max_queue = max_queue
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._when_full = when_full
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._stopped = False
+        self._dropped = 0
+
+    def get_dropped_count(self):
+        with self._cond:
+            return self._dropped
+
+    def start(self):
+        assert self._thread is None
+        self._thread = threading.Thread(
+            target=self._run, name='access log writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            with self._cond:
+                self._stopping = True
+                self._cond.notify_all()
+            self._thread.join()
+            self._thread = None
+
+        # Request handlers blocked on a full queue, and any later ones,
+        # write their entries themselves from now on.
+        with self._cond:
+            self._stopped = True
+            entries = list(self._queue)
+            self._queue.clear()
+            self._cond.notify_all()
+        for i in range(0, len(entries), self._max_batch):
+            self._write(entries[i:i + self._max_batch])
+
+    def append(self, entry):
+        with self._cond:
+            if self._is_full() and self._when_full == 'block':
+                while self._is_full():
+                    self._cond.wait()
+            if self._stopped:
+                action = 'write'
+            elif not self._is_full():
+                action = 'queue'
+                self._queue.append(entry)
+                self._cond.notify_all()
+            else:
+                action = self._when_full
+                if action == 'drop':
+                    self._dropped += 1
+
+        if action == 'write':
+            self._write([entry])
+        elif action == 'drop':
+            qvarn.log.log(
+                'warning', msg_text='Access log queue full, dropped entry',
+                access_entry=entry)
+
+    def _is_full(self):
+        # Must be called with self._cond held. After stop, there's
+        # no queue to wait for.
+        return not self._stopped and len(self._queue) >= self._max_queue
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            self._write(batch)
+
+    def _collect_batch(self):
+        # Wait for an entry, and then for a full batch, or for
+        # max_delay seconds. Return None when stopping: stop writes
+        # what's left in the queue.
+        with self._cond:
+            while not self._queue and not self._stopping:
+                self._cond.wait()
+            deadline = time.time() + self._max_delay
+            wanted = min(self._max_batch, self._max_queue)
+            while len(self._queue) < wanted and not self._stopping:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+            if self._stopping:
+                return None
+            batch = []
+            while self._queue and len(batch) < self._max_batch:
+                batch.append(self._queue.popleft())
+            self._cond.notify_all()
+            return batch
+
+    def _write(self, batch):
+        # Any error is caught, so that the writer thread goes on to
+        # write later batches.
+        try:
+            self._write_batch(batch)
+        except Exception as e:  # pragma: no cover pylint: disable=broad-except
+            with self._cond:
+                self._dropped += len(batch)
+            qvarn.log.log(
+                'error', msg_text='Could not write access log entries',
+                exception=str(e), count=len(batch), exc_info=True)
+        else:
+            qvarn.log.log(
+                'debug', msg_text='Wrote access log entries',
+                count=len(batch))
+
+
+class AccessLogRetention:
+
+    '''Remove access log entries older than max_age seconds.
+
+    The removal is done by the Qvarn server itself, with one set-based
+    DELETE, every interval seconds, in a background thread. Several
+    Qvarn instances sharing a database may all do this: removing
+    entries that are already gone is harmless.
+
+    '''
+
+    def __init__(self, store, max_age, interval=3600):
+        self._store = store
+        self._max_age = max_age
+        self._interval = interval
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def remove_old_entries(self, now=None):
+        if now is None:
+            now = time.time()
+        cutoff = time.strftime(
+            '%Y-%m-%dT%H:%M:%S', time.gmtime(now - self._max_age))
+        cond = qvarn.All(
+            qvarn.Equal('type', 'access'),
+            qvarn.LessThan('timestamp', cutoff),
+        )
+        with qvarn.Stopwatch('remove old access log entries'):
+            count = self._store.remove_matches(cond)
+        qvarn.log.log(
+            'info', msg_text='Removed old access log entries',
+            cutoff=cutoff, count=count)
+        return count
+
+    def start(self):  # pragma: no cover
+        assert self._thread is None
+        self._thread = threading.Thread(
+            target=self._run, name='access log retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):  # pragma: no cover
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):  # pragma: no cover
+        # Any error is caught, so that removal is tried again later.
+        while not self._stopped.is_set():
+            try:
+                self.remove_old_entries()
+            except Exception as e:  # pylint: disable=broad-except
+                qvarn.log.log(
+                    'error',
+                    msg_text='Could not remove old access log entries',
+                    exception=str(e), exc_info=True)
+            self._stopped.wait(self._interval)
+
+
+class UnknownQueuePolicy(Exception):
+
+    def __init__(self, policy):
+        super().__init__(
+            'Unknown policy for full access log queue: {}'.format(policy))
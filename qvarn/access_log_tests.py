@@ -0,0 +1,176 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import unittest
+
+
+import qvarn
+
+
+class AccessLogWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def write_batch(self, entries):
+        self.batches.append(list(entries))
+
+    def test_raises_error_for_unknown_policy(self):
+        with self.assertRaises(qvarn.UnknownQueuePolicy):
+            qvarn.AccessLogWriter(self.write_batch, when_full='panic')
+
+    def test_writes_nothing_if_nothing_is_appended(self):
+        writer = qvarn.AccessLogWriter(self.write_batch)
+        writer.stop()
+        self.assertEqual(self.batches, [])
+
+    def test_writes_queued_entries_when_stopped(self):
+        writer = qvarn.AccessLogWriter(self.write_batch)
+        writer.append({'id': 1})
+        writer.append({'id': 2})
+        self.assertEqual(self.batches, [])
+        writer.stop()
+        self.assertEqual(self.batches, [[{'id': 1}, {'id': 2}]])
+
+    def test_writes_in_batches_of_max_size(self):
+        writer = qvarn.AccessLogWriter(self.write_batch, max_batch=2)
+        for i in range(5):
+            writer.append({'id': i})
+        writer.stop()
+        self.assertEqual(
+            self.batches,
+            [
+                [{'id': 0}, {'id': 1}],
+                [{'id': 2}, {'id': 3}],
+                [{'id': 4}],
+            ]
+        )
+
+    def test_drops_entries_when_full(self):
+        writer = qvarn.AccessLogWriter(
+            self.write_batch, max_queue=1, when_full='drop')
+        writer.append({'id': 1})
+        writer.append({'id': 2})
+        self.assertEqual(writer.get_dropped_count(), 1)
+        writer.stop()
+        self.assertEqual(self.batches, [[{'id': 1}]])
+
+    def test_writes_synchronously_when_full(self):
+        writer = qvarn.AccessLogWriter(
+            self.write_batch, max_queue=1, when_full='write')
+        writer.append({'id': 1})
+        writer.append({'id': 2})
+        self.assertEqual(self.batches, [[{'id': 2}]])
+        writer.stop()
+        self.assertEqual(self.batches, [[{'id': 2}], [{'id': 1}]])
+        self.assertEqual(writer.get_dropped_count(), 0)
+
+    def test_writes_at_once_after_stop(self):
+        writer = qvarn.AccessLogWriter(self.write_batch)
+        writer.stop()
+        writer.append({'id': 1})
+        self.assertEqual(self.batches, [[{'id': 1}]])
+
+    def test_blocked_append_writes_when_stopped(self):
+        writer = qvarn.AccessLogWriter(self.write_batch, max_queue=1)
+        writer.append({'id': 1})
+        stopper = threading.Timer(0.01, writer.stop)
+        stopper.start()
+        writer.append({'id': 2})
+        stopper.join()
+        self.assertCountEqual(self.batches, [[{'id': 1}], [{'id': 2}]])
+
+    def test_thread_writes_batch_after_max_delay(self):
+        writer = qvarn.AccessLogWriter(
+            self.write_batch, max_batch=10, max_delay=0.01)
+        writer.start()
+        writer.append({'id': 1})
+        writer.append({'id': 2})
+        self.wait_for_entries(2)
+        writer.stop()
+        self.assertEqual(
+            [entry for batch in self.batches for entry in batch],
+            [{'id': 1}, {'id': 2}])
+
+    def test_thread_writes_full_batch_without_waiting(self):
+        writer = qvarn.AccessLogWriter(
+            self.write_batch, max_batch=2, max_delay=60)
+        writer.start()
+        writer.append({'id': 1})
+        writer.append({'id': 2})
+        self.wait_for_entries(2)
+        writer.stop()
+        self.assertEqual(self.batches, [[{'id': 1}, {'id': 2}]])
+
+    def test_thread_blocks_appends_until_there_is_room(self):
+        writer = qvarn.AccessLogWriter(
+            self.write_batch, max_queue=1, max_delay=0.01)
+        writer.start()
+        for i in range(3):
+            writer.append({'id': i})
+        self.wait_for_entries(3)
+        writer.stop()
+        self.assertEqual(
+            [entry for batch in self.batches for entry in batch],
+            [{'id': 0}, {'id': 1}, {'id': 2}])
+
+    def wait_for_entries(self, count):
+        deadline = time.time() + 10
+        while sum(len(batch) for batch in self.batches) < count:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.001)
+
+
+class AccessLogRetentionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store = qvarn.MemoryObjectStore()
+        self.store.create_store(obj_id=str, subpath=str)
+
+    def create_entry(self, obj_id, timestamp, type_name='access'):
+        entry = {
+            'type': type_name,
+            'id': obj_id,
+            'timestamp': timestamp,
+        }
+        self.store.create_object(entry, obj_id=obj_id, subpath='')
+
+    def get_ids(self):
+        return sorted(
+            keys['obj_id'] for keys, _ in self.store.get_matches(qvarn.Yes()))
+
+    def test_removes_only_old_access_log_entries(self):
+        self.create_entry('old', '1970-01-01T00:00:10.000000')
+        self.create_entry('new', '1970-01-01T00:01:40.000000')
+        self.create_entry('other', '1970-01-01T00:00:10.000000', 'other')
+        retention = qvarn.AccessLogRetention(self.store, 60)
+        self.assertEqual(retention.remove_old_entries(now=100), 1)
+        self.assertEqual(self.get_ids(), ['new', 'other'])
+
+    def test_removes_entries_older_than_max_age_from_now_by_default(self):
+        self.create_entry('old', '1970-01-01T00:00:10.000000')
+        self.create_entry('new', '9999-01-01T00:00:00.000000')
+        retention = qvarn.AccessLogRetention(self.store, 60)
+        self.assertEqual(retention.remove_old_entries(), 1)
+        self.assertEqual(self.get_ids(), ['new'])
+
+    def test_removes_nothing_if_nothing_is_old(self):
+        self.create_entry('new', '1970-01-01T00:01:40.000000')
+        retention = qvarn.AccessLogRetention(self.store, 60)
+        self.assertEqual(retention.remove_old_entries(now=100), 0)
+        self.assertEqual(self.get_ids(), ['new'])
@@ -34,6 +34,11 @@ class AllowRouter(qvarn.Router):
                 'path': path,
                 'callback': self._add_rule,
             },
+            {
+                'method': 'PUT',
+                'path': path,
+                'callback': self._replace_rules,
+            },
             {
                 'method': 'GET',
                 'path': path,
@@ -50,9 +55,28 @@ class AllowRouter(qvarn.Router):
         if content_type != 'application/json':
             raise qvarn.NotJson(content_type)
 
-        self._store.add_allow_rule(body)
+        if isinstance(body, list):
+            if not self._are_rules(body):
+                return qvarn.bad_request_response(
+                    'body must be a JSON object or a list of them')
+            self._store.add_allow_rules(body)
+        else:
+            self._store.add_allow_rule(body)
         return qvarn.ok_response(None)
 
+    def _replace_rules(self, content_type, body, *args, **kwargs):
+        if content_type != 'application/json':
+            raise qvarn.NotJson(content_type)
+
+        if not isinstance(body, list) or not self._are_rules(body):
+            return qvarn.bad_request_response(
+                'body must be a list of JSON objects')
+        self._store.replace_allow_rules(body)
+        return qvarn.ok_response(None)
+
+    def _are_rules(self, rules):
+        return all(isinstance(rule, dict) for rule in rules)
+
     def _has_rule(self, content_type, body, *args, **kwargs):
         if content_type != 'application/json':
             raise qvarn.NotJson(content_type)
@@ -0,0 +1,82 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import itertools
+
+
+class AllowRuleIndex:
+
+    '''An in-memory index of fine-grained access control rules.
+
+    Checking if a rule allows access used to mean checking every rule
+    for every object. The index groups rules by method, client id,
+    user id, resource type, and resource id, so that only the few
+    rules that can possibly match a request and an object need to be
+    looked at. Wildcards ("*", or None for the resource type) are
+    indexed as such, and looked up in addition to the actual value.
+
+    '''
+
+    def __init__(self, rules=None):
+        self._rules = {}
+        for rule in rules or []:
+            self.add(rule)
+
+    def add(self, rule):
+        key = (rule['method'], rule['client_id'], rule['user_id'])
+        by_type = self._rules.setdefault(key, {})
+        by_id = by_type.setdefault(rule.get('resource_type'), {})
+        by_id.setdefault(rule.get('resource_id'), []).append(dict(rule))
+
+    def remove(self, rule):
+        key = (rule['method'], rule['client_id'], rule['user_id'])
+        by_type = self._rules.get(key, {})
+        by_id = by_type.get(rule.get('resource_type'), {})
+        rules = by_id.get(rule.get('resource_id'), [])
+        rules[:] = [r for r in rules if r != rule]
+
+    def allows(self, params, obj, keys):
+        for rule in self._candidates(params, obj, keys):
+            field = rule.get('resource_field')
+            value = rule.get('resource_value')
+            if field is not None and field not in obj:
+                continue
+            if value in ('*', obj.get(field)):
+                return True
+        return False
+
+    def _candidates(self, params, obj, keys):
+        method = params['method']
+        clients = set([params['client_id'], '*'])
+        users = set([params['user_id'], '*'])
+        resource_ids = set([keys['obj_id'], '*'])
+        for client_id, user_id in itertools.product(clients, users):
+            by_type = self._rules.get((method, client_id, user_id), {})
+            for by_id in self._by_type(by_type, obj):
+                for resource_id in resource_ids:
+                    for rule in by_id.get(resource_id, []):
+                        yield rule
+
+    def _by_type(self, by_type, obj):
+        # Sub-resources don't have a type, and rules for any resource
+        # type apply to them.
+        if 'type' not in obj:
+            return by_type.values()
+        return [
+            by_type[t]
+            for t in set([obj['type'], None])
+            if t in by_type
+        ]
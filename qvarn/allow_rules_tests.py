@@ -0,0 +1,123 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import qvarn
+
+
+def rule(**kwargs):
+    r = {
+        'method': 'GET',
+        'client_id': 'client',
+        'user_id': 'user',
+        'subpath': '',
+        'resource_id': '*',
+        'resource_type': None,
+        'resource_field': None,
+        'resource_value': None,
+    }
+    r.update(kwargs)
+    return r
+
+
+class AllowRuleIndexTests(unittest.TestCase):
+
+    params = {
+        'method': 'GET',
+        'client_id': 'client',
+        'user_id': 'user',
+    }
+
+    obj = {
+        'type': 'person',
+        'name': 'James',
+    }
+
+    keys = {
+        'obj_id': 'id-1',
+    }
+
+    def allows(self, *rules, obj=None):
+        index = qvarn.AllowRuleIndex(rules)
+        if obj is None:
+            obj = self.obj
+        return index.allows(self.params, obj, self.keys)
+
+    def test_denies_without_rules(self):
+        self.assertFalse(self.allows())
+
+    def test_allows_with_matching_rule(self):
+        self.assertTrue(self.allows(rule()))
+
+    def test_denies_other_method(self):
+        self.assertFalse(self.allows(rule(method='PUT')))
+
+    def test_allows_any_client_and_user(self):
+        self.assertTrue(self.allows(rule(client_id='*', user_id='*')))
+
+    def test_denies_other_client(self):
+        self.assertFalse(self.allows(rule(client_id='other')))
+
+    def test_denies_other_user(self):
+        self.assertFalse(self.allows(rule(user_id='other')))
+
+    def test_allows_specific_resource(self):
+        self.assertTrue(self.allows(rule(resource_id='id-1')))
+
+    def test_denies_other_resource(self):
+        self.assertFalse(self.allows(rule(resource_id='id-2')))
+
+    def test_allows_matching_type(self):
+        self.assertTrue(self.allows(rule(resource_type='person')))
+
+    def test_denies_other_type(self):
+        self.assertFalse(self.allows(rule(resource_type='org')))
+
+    def test_allows_any_type_for_subresource(self):
+        self.assertTrue(self.allows(rule(resource_type='org'), obj={}))
+
+    def test_allows_matching_field_value(self):
+        r = rule(resource_field='name', resource_value='James')
+        self.assertTrue(self.allows(r))
+
+    def test_allows_any_field_value(self):
+        r = rule(resource_field='name', resource_value='*')
+        self.assertTrue(self.allows(r))
+
+    def test_denies_other_field_value(self):
+        r = rule(resource_field='name', resource_value='Jane')
+        self.assertFalse(self.allows(r))
+
+    def test_denies_missing_field(self):
+        r = rule(resource_field='age', resource_value='*')
+        self.assertFalse(self.allows(r))
+
+    def test_allows_if_any_rule_matches(self):
+        self.assertTrue(self.allows(rule(user_id='other'), rule()))
+
+    def test_denies_after_rule_is_removed(self):
+        r = rule()
+        index = qvarn.AllowRuleIndex([r])
+        index.remove(r)
+        self.assertFalse(index.allows(self.params, self.obj, self.keys))
+
+    def test_keeps_other_rules_when_one_is_removed(self):
+        r1 = rule()
+        r2 = rule(resource_id='id-1')
+        index = qvarn.AllowRuleIndex([r1, r2])
+        index.remove(r1)
+        self.assertTrue(index.allows(self.params, self.obj, self.keys))
@@ -15,25 +15,46 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import re
-import jwt
+import contextlib
+import threading
+
 
 import qvarn
 
 
-class QvarnAPI:
+# The API keeps its settings and its lazily created collections as
+# separate attributes.
+class QvarnAPI:  # pylint: disable=too-many-instance-attributes
+
+    '''The Qvarn HTTP API.
+
+    Once set up, this may serve requests from several threads at once.
+    The collections for notifications and the access log are created
+    on first use, under a lock.
+
+    '''
 
     def __init__(self):
+        self._lock = threading.Lock()
         self._store = None
         self._validator = qvarn.Validator()
         self._baseurl = None
         self._rt_coll = None
         self._notifs = None
         self._alog = None
+        self._alog_writer = None
+        self._alog_per_request = False
+        self._alog_local = threading.local()
 
     def set_base_url(self, baseurl):  # pragma: no cover
         self._baseurl = baseurl
 
+    def set_access_log_writer(self, writer):  # pragma: no cover
+        self._alog_writer = writer
+
+    def set_access_log_per_request(self, per_request):  # pragma: no cover
+        self._alog_per_request = per_request
+
     def set_object_store(self, store):
         self._store = store
         self._store.create_store(obj_id=str, subpath=str)
@@ -131,6 +152,11 @@ class QvarnAPI:
             v = qvarn.VersionRouter()
             return v.get_routes()
 
+        if path == '/metrics':
+            qvarn.log.log('info', msg_text='Add /metrics route')
+            m = qvarn.MetricsRouter()
+            return m.get_routes()
+
         if path == '/allow':
             qvarn.log.log('info', msg_text='Add /allow route')
             a = qvarn.AllowRouter()
@@ -158,6 +184,7 @@ class QvarnAPI:
         router.set_collection(coll)
         router.set_notifier(self.notify)
         router.set_access_logger(self.log_access)
+        router.set_bulk_access_logger(self.log_access_many)
         routes = router.get_routes()
 
         files = rt.get_files()
@@ -199,9 +226,10 @@ class QvarnAPI:
             'resource_change': change,
             'timestamp': qvarn.get_current_timestamp(),
         }
-        for listener in self.find_listeners(rid, change):
-            obj['listener_id'] = listener['id']
-            self.create_notification(obj)
+        with qvarn.tracer.span('notify', change=change):
+            for listener in self.find_listeners(rid, change):
+                obj['listener_id'] = listener['id']
+                self.create_notification(obj)
 
     def create_notification(self, notif):  # pragma: no cover
         qvarn.log.log(
@@ -211,12 +239,14 @@ class QvarnAPI:
         notifs.post_with_id(notif)
 
     def _create_notifs_collection(self):  # pragma: no cover
-        if self._notifs is None:
-            rt = self.get_notification_resource_type()
-            self._notifs = qvarn.CollectionAPI()
-            self._notifs.set_object_store(self._store)
-            self._notifs.set_resource_type(rt)
-        return self._notifs
+        with self._lock:
+            if self._notifs is None:
+                rt = self.get_notification_resource_type()
+                notifs = qvarn.CollectionAPI()
+                notifs.set_object_store(self._store)
+                notifs.set_resource_type(rt)
+                self._notifs = notifs
+            return self._notifs
 
     def find_listeners(self, rid, change):  # pragma: no cover
         cond = qvarn.Equal('type', 'listener')
@@ -234,63 +264,111 @@ class QvarnAPI:
             return True
         return False
 
+    # Access to resources of these types is not logged.
+    _not_access_logged = [
+        'access', 'notification', 'listener', 'resource_type']
+
     def log_access(self, res, rtype, op,
                    ahead, qhead, ohead, whead):  # pragma: no cover
-        if rtype in [
-                'access', 'notification', 'listener', 'resource_type']:
+        if rtype in self._not_access_logged:
             return
 
-        token_headers = ahead
-        if qhead:
-            token_headers = ', '.join([ahead, qhead])
-        encoded_tokens = re.split(r'(?:\A|,\s*)Bearer ', token_headers)[1:]
-        tokens = [jwt.decode(t, verify=False) for t in encoded_tokens]
-        persons = [
-            {
-                'accessor_id': t['sub'],
-                'accessor_type': 'person',
-            }
-            for t in tokens]
-        clients = [
-            {
-                'accessor_id': t['aud'],
-                'accessor_type': 'client',
-            }
-            for t in tokens]
-        orgs = [
-            {
-                'accessor_id': t,
-                'accessor_type': 'org',
-            }
-            for t in re.findall(r',?\s*Org (.+?)(?:,|\Z)', ohead) if t]
-        others = [
-            {
-                'accessor_id': t,
-                'accessor_type': 'other',
-            }
-            for t in re.findall(r',?\s*Other (.+?)(?:,|\Z)', ohead) if t]
-
-        self.create_access_entry(
-            {
-                'type': 'access',
-                'resource_type': rtype,
-                'resource_id': res.get('id'),
-                'resource_revision': res.get('revision'),
-                'operation': op,
-                'accessors': [*persons, *clients, *orgs, *others],
-                'why': whead,
-                'timestamp': qvarn.get_current_timestamp(),
-            })
+        with qvarn.tracer.span('access log', count=1):
+            accessors = qvarn.get_accessors(ahead, qhead, ohead)
+            self.create_access_entry(
+                self._new_access_entry([res], rtype, op, accessors, whead))
+
+    def log_access_many(self, resources, rtype, op,
+                        ahead, qhead, ohead, whead):  # pragma: no cover
+        # Log access to all resources returned by one request. The
+        # accessors are the same for all of them, so the headers get
+        # parsed only once. If access is logged per request, only one
+        # entry is created, listing the ids of all the resources.
+        if rtype in self._not_access_logged or not resources:
+            return
+
+        with qvarn.tracer.span('access log', count=len(resources)):
+            accessors = qvarn.get_accessors(ahead, qhead, ohead)
+            if self._alog_per_request:
+                self.create_access_entry(
+                    self._new_access_entry(
+                        resources, rtype, op, accessors, whead))
+            else:
+                for res in resources:
+                    self.create_access_entry(
+                        self._new_access_entry(
+                            [res], rtype, op, accessors, whead))
+
+    def _new_access_entry(
+            self, resources, rtype, op, accessors,
+            whead):  # pragma: no cover
+        entry = {
+            'type': 'access',
+            'resource_type': rtype,
+            'resource_id': None,
+            'resource_revision': None,
+            'operation': op,
+            'accessors': [dict(a) for a in accessors],
+            'why': whead,
+            'timestamp': qvarn.get_current_timestamp(),
+        }
+        if len(resources) == 1:
+            entry['resource_id'] = resources[0].get('id')
+            entry['resource_revision'] = resources[0].get('revision')
+        # The access type loaded from the operator's resource type
+        # files may be older than v1, which has no resource_ids. Per
+        # request logging needs it, and fails without it.
+        if self._alog_per_request or self._access_type_has_resource_ids():
+            entry['resource_ids'] = [res.get('id') for res in resources]
+        return entry
+
+    def _access_type_has_resource_ids(self):  # pragma: no cover
+        rt = self._create_alog_collection().get_type()
+        return 'resource_ids' in rt.get_latest_prototype()
 
     def create_access_entry(self, entry):  # pragma: no cover
         qvarn.log.log('info', msg_text='Log access', access_entry=entry)
+        if self._alog_writer is not None:
+            if self._has_pending_access():
+                self._alog_local.pending.append(entry)
+            else:
+                self._alog_writer.append(entry)
+        else:
+            alog = self._create_alog_collection()
+            alog.post_with_id(entry)
+
+    @contextlib.contextmanager
+    def deferred_access_log(self):  # pragma: no cover
+        # Hold the access entries the current thread creates within
+        # this context, and queue them for the access log writer at
+        # the end. As with synchronous access logging, nothing is
+        # logged if there's an exception.
+        if self._alog_writer is None or self._has_pending_access():
+            yield
+            return
+
+        self._alog_local.pending = []
+        try:
+            yield
+            pending = self._alog_local.pending
+        finally:
+            self._alog_local.pending = None
+        for entry in pending:
+            self._alog_writer.append(entry)
+
+    def _has_pending_access(self):  # pragma: no cover
+        return getattr(self._alog_local, 'pending', None) is not None
+
+    def write_access_entries(self, entries):  # pragma: no cover
         alog = self._create_alog_collection()
-        alog.post_with_id(entry)
+        alog.post_many_with_id(entries)
 
     def _create_alog_collection(self):  # pragma: no cover
-        if self._alog is None:
-            rt = self.get_access_log_resource_type()
-            self._alog = qvarn.CollectionAPI()
-            self._alog.set_object_store(self._store)
-            self._alog.set_resource_type(rt)
-        return self._alog
+        with self._lock:
+            if self._alog is None:
+                rt = self.get_access_log_resource_type()
+                alog = qvarn.CollectionAPI()
+                alog.set_object_store(self._store)
+                alog.set_resource_type(rt)
+                self._alog = alog
+            return self._alog
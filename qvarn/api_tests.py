@@ -38,6 +38,10 @@ class QvarnAPITests(unittest.TestCase):
         api = qvarn.QvarnAPI()
         self.assertNotEqual(api.find_missing_route('/version'), [])
 
+    def test_returns_routes_for_metrics_path(self):
+        api = qvarn.QvarnAPI()
+        self.assertNotEqual(api.find_missing_route('/metrics'), [])
+
     def test_returns_routes_for_allow_path(self):
         api = qvarn.QvarnAPI()
         self.assertNotEqual(api.find_missing_route('/allow'), [])
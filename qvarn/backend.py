@@ -20,6 +20,7 @@
 # authorization.
 
 
+import atexit
 import os
 
 import yaml
@@ -53,6 +54,7 @@ _counter = slog.Counter()
 def counter():
     new_context = 'HTTP transaction {}'.format(_counter.increment())
     qvarn.log.set_context(new_context)
+    qvarn.tracer.start_trace(new_context)
 
 
 default_config = {
@@ -63,14 +65,26 @@ default_config = {
     'log': [],
     'resource-type-dir': None,
     'enable-fine-grained-access-control': None,
+    'access-log-async': False,
+    'access-log-queue-size': 10000,
+    'access-log-batch-size': 100,
+    'access-log-max-delay': 1.0,
+    'access-log-when-full': 'block',
+    'access-log-per-request': False,
+    'access-log-max-age': 0,
+    'access-log-retention-interval': 3600,
     'memory-database': True,
+    'blob-storage': 'postgres',
+    'blob-directory': '',
+    'trace-file': '',
+    'trace-sample-rate': 0.01,
     'database': {
         'host': None,
         'port': 5432,
         'database': None,
         'user': None,
         'min_conn': 1,
-        'max_conn': 1,
+        'max_conn': 10,
         'password': None,
     },
 }
@@ -84,6 +98,15 @@ check_config(config)
 qvarn.setup_logging(config)
 qvarn.log.log('info', msg_text='Qvarn backend starting')
 
+if config['trace-file']:
+    qvarn.tracer.configure(
+        qvarn.TraceFileWriter(config['trace-file']),
+        sample_rate=config['trace-sample-rate'])
+qvarn.log.log(
+    'info', msg_text='Request tracing',
+    trace_file=config['trace-file'],
+    sample_rate=config['trace-sample-rate'])
+
 subject = qvarn.ResourceType()
 subject.from_spec({
     'type': 'subject',
@@ -134,7 +157,9 @@ if config['memory-database']:
 else:
     sql = qvarn.PostgresAdapter()
     sql.connect(**config['database'])
-    store = qvarn.PostgresObjectStore(sql)
+    blobs = qvarn.create_blob_backend(
+        config['blob-storage'], sql, config['blob-directory'])
+    store = qvarn.PostgresObjectStore(sql, blobs=blobs)
 if config.get('enable-fine-grained-access-control'):
     store.enable_fine_grained_access_control()
 qvarn.log.log(
@@ -144,10 +169,35 @@ qvarn.log.log(
 api = qvarn.QvarnAPI()
 api.set_base_url(config['baseurl'])
 api.set_object_store(store)
+api.set_access_log_per_request(config['access-log-per-request'])
 api.add_resource_type(subject)
 for rt in resource_types:
     api.add_resource_type(rt)
 
+if config['access-log-async']:
+    alog_writer = qvarn.AccessLogWriter(
+        api.write_access_entries,
+        max_queue=config['access-log-queue-size'],
+        max_batch=config['access-log-batch-size'],
+        max_delay=config['access-log-max-delay'],
+        when_full=config['access-log-when-full'])
+    alog_writer.start()
+    atexit.register(alog_writer.stop)
+    api.set_access_log_writer(alog_writer)
+qvarn.log.log(
+    'info', msg_text='Asynchronous access log?',
+    enabled=config['access-log-async'])
+
+if config['access-log-max-age'] > 0:
+    alog_retention = qvarn.AccessLogRetention(
+        store, config['access-log-max-age'],
+        interval=config['access-log-retention-interval'])
+    alog_retention.start()
+    atexit.register(alog_retention.stop)
+qvarn.log.log(
+    'info', msg_text='Access log retention',
+    max_age=config['access-log-max-age'])
+
 app = apifw.create_bottle_application(
     api, counter, dict_logger, config, resource_types)
 
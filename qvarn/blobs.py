@@ -0,0 +1,256 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import string
+import tempfile
+
+
+import qvarn
+
+
+class BlobBackendInterface:  # pragma: no cover
+
+    '''Store blob content by its SHA-256 hash.
+
+    The PostgreSQL object store keeps track of which blobs refer to
+    which content, and how many references there are. A backend only
+    stores the content.
+
+    put is called when the first reference to the content is created,
+    inside the database transaction t that creates it. If t is rolled
+    back, the content may be left behind; a later put of the same
+    content must then overwrite it.
+
+    remove is called only after the transaction that removed the last
+    reference has been committed, so a rollback never loses content.
+    It's called inside a new transaction t, in which the store has
+    made sure that the content isn't referenced again: no new
+    reference can be committed before t ends.
+
+    '''
+
+    def create(self):
+        raise NotImplementedError()
+
+    def put(self, t, blob_hash, blob):
+        raise NotImplementedError()
+
+    def open(self, blob_hash):
+        # Return an iterable over the content, possibly an open file.
+        raise NotImplementedError()
+
+    def remove(self, t, blob_hash):
+        raise NotImplementedError()
+
+
+class PostgresBlobBackend(BlobBackendInterface):  # pragma: no cover
+
+    '''Store blob content in chunks in the _blobdata table.'''
+
+    _table = '_blobdata'
+
+    # Content is stored in chunks of this many bytes, one row per
+    # chunk, so that no query needs to handle a whole big blob.
+    _chunk_size = 1024 * 1024
+
+    def __init__(self, sql):
+        self._sql = sql
+
+    def create(self):
+        columns = {
+            '_hash': str,
+            '_chunk': int,
+            '_blob': bytes,
+        }
+        with self._sql.transaction() as t:
+            query = t.create_table(self._table, **columns)
+            t.execute(query, {})
+            query = t.create_multicolumn_index(
+                self._table, '_blobdata_hash__idx', '_hash', '_chunk')
+            t.execute(query, {})
+
+    def put(self, t, blob_hash, blob):
+        column_names = ['_hash', '_chunk', '_blob']
+        query = t.insert_object(self._table, *column_names)
+        chunks = qvarn.iter_chunks(blob, self._chunk_size)
+        for i, chunk in enumerate(chunks):
+            values = {
+                '_hash': blob_hash,
+                '_chunk': i,
+                '_blob': chunk,
+            }
+            t.execute(query, values)
+
+    def open(self, blob_hash):
+        return TableChunks(
+            self._sql, self._table, {'_hash': blob_hash}, self._chunk_size)
+
+    def remove(self, t, blob_hash):
+        query = t.remove_objects(self._table, '_hash')
+        t.execute(query, {'_hash': blob_hash})
+
+
+class FilesystemBlobBackend(BlobBackendInterface):
+
+    '''Store blob content as files in a local directory.
+
+    Each blob is a file named after its hash, in a two-level tree of
+    subdirectories named after the first four hex digits of the hash,
+    to keep directories small. A file is written under a temporary
+    name and renamed into place, so a file with the final name is
+    always complete. Reads return the open file, which lets a WSGI
+    server send it with sendfile(2).
+
+    A file is removed only after the removal of its last reference
+    has been committed, as BlobBackendInterface requires, so a rolled
+    back removal leaves the file in place. A file written by a rolled
+    back transaction is left behind, and overwritten if the same
+    content is stored again.
+
+    '''
+
+    _chunk_size = 1024 * 1024
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def create(self):
+        os.makedirs(self._directory, exist_ok=True)
+
+    def get_filename(self, blob_hash):
+        if len(blob_hash) != 64 or blob_hash.strip(string.hexdigits):
+            raise BadBlobHash(blob_hash)
+        return os.path.join(
+            self._directory, blob_hash[0:2], blob_hash[2:4], blob_hash)
+
+    def put(self, t, blob_hash, blob):
+        filename = self.get_filename(blob_hash)
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+
+        fd, tempname = tempfile.mkstemp(dir=dirname, prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in qvarn.iter_chunks(blob, self._chunk_size):
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tempname, filename)
+        except BaseException:
+            os.remove(tempname)
+            raise
+
+    def open(self, blob_hash):
+        try:
+            return open(self.get_filename(blob_hash), 'rb')
+        except FileNotFoundError:
+            raise qvarn.NoSuchObject({'_hash': blob_hash})
+
+    def remove(self, t, blob_hash):
+        try:
+            os.remove(self.get_filename(blob_hash))
+        except FileNotFoundError:
+            pass
+
+
+def create_blob_backend(storage, sql, directory):
+    # Return the blob backend selected by the blob-storage setting.
+    if storage == 'postgres':
+        return PostgresBlobBackend(sql)
+    if storage == 'filesystem':
+        return FilesystemBlobBackend(directory)
+    raise UnknownBlobStorage(storage)
+
+
+class TableChunks:  # pragma: no cover
+
+    '''The content of a blob stored in a table, in chunks of chunk_size.
+
+    Iterating gives all chunks. iter_from(start) skips the chunks
+    before the one with byte start, without reading them, and returns
+    the position of the first byte of the first chunk, and the chunks.
+    close closes any iterations still going on.
+
+    '''
+
+    def __init__(self, sql, table_name, keys, chunk_size):
+        self._sql = sql
+        self._table_name = table_name
+        self._keys = keys
+        self._chunk_size = chunk_size
+        self._iterators = []
+
+    def __iter__(self):
+        _, chunks = self.iter_from(0)
+        return chunks
+
+    def iter_from(self, start):
+        first_chunk = start // self._chunk_size
+        chunks = iter_table_chunks(
+            self._sql, self._table_name, self._keys, first_chunk=first_chunk)
+        self._iterators.append(chunks)
+        return first_chunk * self._chunk_size, chunks
+
+    def close(self):
+        for chunks in self._iterators:
+            chunks.close()
+        self._iterators = []
+
+
+def iter_table_chunks(
+        sql, table_name, keys, first_chunk=0):  # pragma: no cover
+    # This is iterated only after the request handler has returned,
+    # and its unit of work has ended, so it uses a transaction of its
+    # own. Only one chunk is in memory at a time. All chunks are read
+    # from one snapshot, so that a concurrent change to the blob
+    # can't change the content after the response headers, and its
+    # Content-Length, have been sent.
+    with sql.transaction(read_only=True, independent=True) as t:
+        t.use_snapshot()
+        yield from iter_chunks_in_transaction(t, table_name, keys, first_chunk)
+
+
+def iter_chunks_in_transaction(
+        t, table_name, keys, first_chunk=0):  # pragma: no cover
+    # Return the chunks of a blob in a table, from first_chunk on.
+    column_names = list(keys.keys())
+    query = t.select_objects(table_name, '_chunk', *column_names)
+    chunks = sorted(
+        row['_chunk']
+        for row in t.execute(query, keys)
+        if row['_chunk'] >= first_chunk
+    )
+
+    column_names.append('_chunk')
+    query = t.select_objects(table_name, '_blob', *column_names)
+    for chunk in chunks:
+        values = dict(keys)
+        values['_chunk'] = chunk
+        for row in t.execute(query, values):
+            yield bytes(row['_blob'])
+
+
+class BadBlobHash(Exception):
+
+    def __init__(self, blob_hash):
+        super().__init__('Not a SHA-256 in hex: {!r}'.format(blob_hash))
+
+
+class UnknownBlobStorage(Exception):
+
+    def __init__(self, name):
+        super().__init__('Unknown blob storage: {}'.format(name))
@@ -0,0 +1,115 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import qvarn
+
+
+class FilesystemBlobBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'blobs')
+        self.backend = qvarn.FilesystemBlobBackend(self.dirname)
+        self.backend.create()
+        self.blob = b'hello, world'
+        self.hash, _ = qvarn.hash_blob(self.blob)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read(self, blob_hash):
+        with self.backend.open(blob_hash) as f:
+            return f.read()
+
+    def test_creates_directory(self):
+        self.assertTrue(os.path.isdir(self.dirname))
+
+    def test_stores_blob_in_sharded_directory(self):
+        self.backend.put(None, self.hash, self.blob)
+        filename = self.backend.get_filename(self.hash)
+        self.assertEqual(
+            filename,
+            os.path.join(self.dirname, self.hash[:2], self.hash[2:4],
+                         self.hash))
+        self.assertTrue(os.path.exists(filename))
+
+    def test_reads_stored_blob(self):
+        self.backend.put(None, self.hash, self.blob)
+        self.assertEqual(self.read(self.hash), self.blob)
+
+    def test_stores_blob_from_file(self):
+        self.backend.put(None, self.hash, io.BytesIO(self.blob))
+        self.assertEqual(self.read(self.hash), self.blob)
+
+    def test_leaves_no_temporary_files(self):
+        self.backend.put(None, self.hash, self.blob)
+        dirname = os.path.dirname(self.backend.get_filename(self.hash))
+        self.assertEqual(os.listdir(dirname), [self.hash])
+
+    def test_removes_temporary_file_on_failure(self):
+        with self.assertRaises(OSError):
+            self.backend.put(None, self.hash, BrokenFile())
+        dirname = os.path.dirname(self.backend.get_filename(self.hash))
+        self.assertEqual(os.listdir(dirname), [])
+
+    def test_storing_twice_keeps_content(self):
+        self.backend.put(None, self.hash, self.blob)
+        self.backend.put(None, self.hash, self.blob)
+        self.assertEqual(self.read(self.hash), self.blob)
+
+    def test_opening_missing_blob_fails(self):
+        with self.assertRaises(qvarn.NoSuchObject):
+            self.backend.open(self.hash)
+
+    def test_removes_blob(self):
+        self.backend.put(None, self.hash, self.blob)
+        self.backend.remove(None, self.hash)
+        with self.assertRaises(qvarn.NoSuchObject):
+            self.backend.open(self.hash)
+
+    def test_removing_missing_blob_is_ok(self):
+        self.backend.remove(None, self.hash)
+
+    def test_rejects_bad_hash(self):
+        with self.assertRaises(qvarn.BadBlobHash):
+            self.backend.get_filename('../../etc/passwd')
+
+
+class CreateBlobBackendTests(unittest.TestCase):
+
+    def test_creates_postgres_backend(self):
+        backend = qvarn.create_blob_backend('postgres', None, '')
+        self.assertTrue(isinstance(backend, qvarn.PostgresBlobBackend))
+
+    def test_creates_filesystem_backend(self):
+        backend = qvarn.create_blob_backend('filesystem', None, '/tmp')
+        self.assertTrue(isinstance(backend, qvarn.FilesystemBlobBackend))
+
+    def test_raises_error_for_unknown_storage(self):
+        with self.assertRaises(qvarn.UnknownBlobStorage):
+            qvarn.create_blob_backend('cloud', None, '')
+
+
+class BrokenFile:
+
+    def read(self, size):
+        raise OSError('read failed')
@@ -0,0 +1,419 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+
+
+import qvarn
+
+
+class MemoryBlobStoreMixin:
+
+    '''Blob methods of MemoryObjectStore.
+
+    The store provides the lock, the _blobs list of references, and
+    the _blobdata dict of contents and reference counts.
+
+    '''
+
+    def create_blob(self, blob, subpath=None, **keys):
+        with self._lock:
+            qvarn.log.log('trace', msg_text='Creating blob', keys=keys)
+            self.check_all_keys_are_allowed(**keys)
+            self.check_value_types(**keys)
+            self._check_unique_blob(subpath, **keys)
+            if not self.get_matches(**keys):
+                raise NoSuchObject(keys)
+            blob_hash, _ = hash_blob(blob)
+            if blob_hash not in self._blobdata:
+                self._blobdata[blob_hash] = [blob, 0]
+            self._blobdata[blob_hash][1] += 1
+            self._blobs.append((blob_hash, subpath, keys))
+
+    def _check_unique_blob(self, subpath, **keys):
+        for _, s, k in self._blobs:
+            if self._keys_match(k, keys) and s == subpath:
+                raise BlobKeyCollision(subpath, k)
+
+    def _get_blob_hash(self, subpath, keys):
+        self.check_all_keys_are_allowed(**keys)
+        self.check_value_types(**keys)
+        hashes = [
+            h
+            for h, s, k in self._blobs
+            if self._keys_match(k, keys) and s == subpath
+        ]
+        assert len(hashes) <= 1
+        if not hashes:
+            raise NoSuchObject(keys)
+        return hashes[0]
+
+    def get_blob(self, subpath=None, **keys):
+        with self._lock:
+            blob_hash = self._get_blob_hash(subpath, keys)
+            return self._blobdata[blob_hash][0]
+
+    def iter_blob(self, subpath=None, **keys):
+        return iter([self.get_blob(subpath=subpath, **keys)])
+
+    def get_blob_info(self, subpath=None, **keys):
+        with self._lock:
+            blob_hash = self._get_blob_hash(subpath, keys)
+            return {
+                'sha256': blob_hash,
+                'size': len(self._blobdata[blob_hash][0]),
+            }
+
+    def get_blob_count(self):
+        # Return number of distinct blob contents stored.
+        with self._lock:
+            return len(self._blobdata)
+
+    def remove_blob(self, subpath=None, **keys):
+        with self._lock:
+            self.check_all_keys_are_allowed(**keys)
+            self.check_value_types(**keys)
+            kept = []
+            for h, s, k in self._blobs:
+                if self._keys_match(k, keys) and s == subpath:
+                    self._blobdata[h][1] -= 1
+                    if self._blobdata[h][1] <= 0:
+                        del self._blobdata[h]
+                else:
+                    kept.append((h, s, k))
+            self._blobs = kept
+
+    def replace_blob(self, blob, subpath=None, **keys):
+        # The new blob is referenced before the old one is
+        # unreferenced, and both are swapped in at the end, so that a
+        # failure leaves the old blob in place.
+        if hasattr(blob, 'read'):
+            blob = blob.read()
+        blob_hash, _ = hash_blob(blob)
+        with self._lock:
+            self.check_all_keys_are_allowed(**keys)
+            self.check_value_types(**keys)
+            old_hashes = []
+            blobs = []
+            for h, s, k in self._blobs:
+                if self._keys_match(k, keys) and s == subpath:
+                    old_hashes.append(h)
+                else:
+                    blobs.append((h, s, k))
+            blobs.append((blob_hash, subpath, keys))
+
+            if blob_hash not in self._blobdata:
+                self._blobdata[blob_hash] = [blob, 0]
+            self._blobdata[blob_hash][1] += 1
+            for h in old_hashes:
+                self._blobdata[h][1] -= 1
+                if self._blobdata[h][1] <= 0:
+                    del self._blobdata[h]
+            self._blobs = blobs
+
+
+class PostgresBlobStoreMixin:  # pragma: no cover
+
+    '''Blob methods of PostgresObjectStore.
+
+    The store provides the database adapter, the blob backend, and
+    the keys.
+
+    '''
+
+    _blobtable = '_blobs'
+    _blobrefstable = '_blobrefs'
+
+    def _add_blob_columns(self):
+        # Blobs stored before they were chunked are all in one row,
+        # which becomes chunk 0. Blobs stored before they were
+        # deduplicated have no hash, and their content is in _blobs.
+        with self._sql.transaction() as t:
+            query = t.add_column(self._blobtable, '_chunk', int, default=0)
+            t.execute(query, {})
+            index_name = self._index_name(self._blobtable, 'chunk', '')
+            query = t.create_multicolumn_index(
+                self._blobtable, index_name, *self._keys, '_chunk')
+            t.execute(query, {})
+
+            query = t.add_column(self._blobtable, '_hash', str)
+            t.execute(query, {})
+
+    def _create_blob_data_tables(self):
+        # Blob content is stored once per SHA-256 hash, by the blob
+        # backend. _blobrefs counts the _blobs rows referring to each
+        # hash.
+        self._blob_backend.create()
+
+        columns = {
+            '_hash': str,
+            '_refs': int,
+            '_size': int,
+        }
+        with self._sql.transaction() as t:
+            query = t.create_table(self._blobrefstable, **columns)
+            t.execute(query, {})
+            index_name = self._index_name(self._blobrefstable, 'hash', '')
+            query = t.create_unique_index(
+                self._blobrefstable, index_name, '_hash', nulls_equal=False)
+            t.execute(query, {})
+
+    def _hash_old_blobs(self):
+        # Blobs stored before they were deduplicated have no hash, and
+        # their content is in _blobs. Move their content to the blob
+        # backend, once, so that it needn't be hashed on every read.
+        with self._sql.transaction(read_only=True) as t:
+            query = t.select_keys_with_null(
+                self._blobtable, '_hash', *self._keys)
+            old_keys = [
+                self.get_keys_from_row(row)
+                for row in t.execute(query, {})
+            ]
+        for keys in old_keys:
+            with self._sql.transaction() as t:
+                self._hash_old_blob(t, keys)
+
+    def _hash_old_blob(self, t, keys):
+        # The rows are locked, in case another Qvarn instance is
+        # moving the same blob at the same time. If it's been moved
+        # or replaced already, there's nothing to do.
+        column_names = list(keys.keys())
+        query = t.select_objects(
+            self._blobtable, '_hash', *column_names, for_update=True)
+        hashes = [row['_hash'] for row in t.execute(query, keys)]
+        if not hashes or any(h is not None for h in hashes):
+            return
+
+        chunks = qvarn.iter_chunks_in_transaction(t, self._blobtable, keys)
+        blob = b''.join(chunks)
+        blob_hash, size = hash_blob(blob)
+        query = t.remove_objects(self._blobtable, *column_names)
+        t.execute(query, keys)
+        self._insert_blob(t, blob, blob_hash, size, keys)
+
+    def create_blob(self, blob, subpath=None, **keys):
+        keys['subpath'] = subpath
+        self.check_all_keys_are_allowed(**keys)
+        self.check_value_types(**keys)
+        if not self.get_matches(**keys):
+            raise NoSuchObject(keys)
+
+        blob_hash, size = hash_blob(blob)
+        span = qvarn.tracer.span('store: create blob', size=size)
+        with span, self._sql.transaction() as t:
+            self._insert_blob(t, blob, blob_hash, size, keys)
+
+    def _insert_blob(self, t, blob, blob_hash, size, keys):
+        # The content is stored only once per hash. Only the first
+        # reference to a hash stores it.
+        query = t.increment_count(
+            self._blobrefstable, '_hash', '_refs', '_size')
+        values = {
+            '_hash': blob_hash,
+            '_size': size,
+        }
+        refs = [row['_refs'] for row in t.execute(query, values)]
+        if refs == [1]:
+            self._blob_backend.put(t, blob_hash, blob)
+
+        column_names = list(keys.keys()) + ['_hash']
+        query = t.insert_object(self._blobtable, *column_names)
+        values = dict(keys)
+        values['_hash'] = blob_hash
+        t.execute(query, values)
+
+    def get_blob(self, subpath=None, **keys):
+        chunks = self.iter_blob(subpath=subpath, **keys)
+        try:
+            return b''.join(chunks)
+        finally:
+            chunks.close()
+
+    def iter_blob(self, subpath=None, **keys):
+        blob_hash = self._get_blob_hash(subpath, keys)
+        if blob_hash is None:
+            # Blobs stored before deduplication have their chunks in
+            # the _blobs table itself.
+            return qvarn.iter_table_chunks(self._sql, self._blobtable, keys)
+        return self._blob_backend.open(blob_hash)
+
+    def get_blob_info(self, subpath=None, **keys):
+        blob_hash = self._get_blob_hash(subpath, keys)
+        if blob_hash is None:
+            # Only blobs stored by an older Qvarn, still running
+            # against the same database after create_store moved the
+            # old ones, have no hash.
+            h = hashlib.sha256()
+            size = 0
+            chunks = qvarn.iter_table_chunks(
+                self._sql, self._blobtable, keys)
+            for chunk in chunks:
+                h.update(chunk)
+                size += len(chunk)
+            return {
+                'sha256': h.hexdigest(),
+                'size': size,
+            }
+
+        with self._sql.transaction(read_only=True) as t:
+            query = t.select_objects(self._blobrefstable, '_size', '_hash')
+            for row in t.execute(query, {'_hash': blob_hash}):
+                return {
+                    'sha256': blob_hash,
+                    'size': row['_size'],
+                }
+        raise NoSuchObject(keys)
+
+    def _get_blob_hash(self, subpath, keys):
+        # Note that this modifies keys to include subpath.
+        keys['subpath'] = subpath
+        self.check_all_keys_are_allowed(**keys)
+        self.check_value_types(**keys)
+
+        column_names = list(keys.keys())
+        span = qvarn.tracer.span('store: get blob hash')
+        with span, self._sql.transaction(read_only=True) as t:
+            query = t.select_objects(self._blobtable, '_hash', *column_names)
+            hashes = [row['_hash'] for row in t.execute(query, keys)]
+        if not hashes:
+            raise NoSuchObject(keys)
+        return hashes[0]
+
+    def remove_blob(self, subpath=None, **keys):
+        keys['subpath'] = subpath
+        self.check_all_keys_are_allowed(**keys)
+        self.check_value_types(**keys)
+
+        span = qvarn.tracer.span('store: remove blob')
+        with span, self._sql.transaction() as t:
+            hashes = self._remove_blob_rows(t, keys)
+            self._unref_blob_data(t, hashes)
+
+    def replace_blob(self, blob, subpath=None, **keys):
+        keys['subpath'] = subpath
+        self.check_all_keys_are_allowed(**keys)
+        self.check_value_types(**keys)
+
+        # The old content is unreferenced only after the new content
+        # is referenced, so that replacing a file with the same
+        # content doesn't remove and store the content again.
+        blob_hash, size = hash_blob(blob)
+        span = qvarn.tracer.span('store: replace blob', size=size)
+        with span, self._sql.transaction() as t:
+            hashes = self._remove_blob_rows(t, keys)
+            self._insert_blob(t, blob, blob_hash, size, keys)
+            self._unref_blob_data(t, hashes)
+
+    def _remove_blob_rows(self, t, keys):
+        # Remove the _blobs rows for keys, and return their hashes.
+        column_names = list(keys.keys())
+        query = t.select_objects(self._blobtable, '_hash', *column_names)
+        hashes = [row['_hash'] for row in t.execute(query, keys)]
+        query = t.remove_objects(self._blobtable, *column_names)
+        t.execute(query, keys)
+        return hashes
+
+    def _unref_blob_data(self, t, hashes):
+        for blob_hash in hashes:
+            if blob_hash is not None:
+                self._unref_one_blob(t, blob_hash)
+
+    def _unref_one_blob(self, t, blob_hash):
+        # The content is removed when its last reference goes, but
+        # only after the transaction has been committed: if it's
+        # rolled back, the references are back, and so must the
+        # content be. A concurrent create_blob of the same content
+        # waits for the row lock taken by the UPDATE, and then stores
+        # it anew.
+        values = {
+            '_hash': blob_hash,
+        }
+        query = t.decrement_count(self._blobrefstable, '_hash', '_refs')
+        refs = [row['_refs'] for row in t.execute(query, values)]
+        if refs and refs[0] <= 0:
+            query = t.remove_uncounted(self._blobrefstable, '_hash', '_refs')
+            t.execute(query, values)
+            t.after_commit(lambda: self._remove_blob_data(blob_hash))
+
+    def _remove_blob_data(self, blob_hash):
+        # The content may have been referenced again since the last
+        # reference went. Claim the hash with a row of no references,
+        # which waits for any concurrent new reference to be committed
+        # or rolled back, and remove the content only if that works.
+        # The row is removed in the same transaction.
+        values = {
+            '_hash': blob_hash,
+        }
+        try:
+            with self._sql.transaction(independent=True) as t:
+                query = t.claim_uncounted(
+                    self._blobrefstable, '_hash', '_refs')
+                if list(t.execute(query, values)):
+                    self._blob_backend.remove(t, blob_hash)
+                    query = t.remove_uncounted(
+                        self._blobrefstable, '_hash', '_refs')
+                    t.execute(query, values)
+        # The change that unreferenced the content has already been
+        # committed, so it must not fail now. Content that can't be
+        # removed only wastes space.
+        except Exception as e:  # pylint: disable=broad-except
+            qvarn.log.log(
+                'error', msg_text='Could not remove unreferenced blob',
+                blob_hash=blob_hash, exception=str(e))
+
+
+def hash_blob(blob):
+    # Return the SHA-256 of a blob, given as bytes or as a file-like
+    # object, as hex, and its size. A file is read in chunks, and
+    # rewound afterwards, so that it can be stored.
+    h = hashlib.sha256()
+    size = 0
+    for chunk in iter_chunks(blob, 1024 * 1024):
+        h.update(chunk)
+        size += len(chunk)
+    if hasattr(blob, 'seek'):
+        blob.seek(0)
+    return h.hexdigest(), size
+
+
+def iter_chunks(blob, size):
+    # Split a blob, given as bytes or as a file-like object, into
+    # chunks. There's always at least one chunk, even if empty.
+    if hasattr(blob, 'read'):
+        chunk = blob.read(size)
+        yield chunk
+        while chunk:
+            chunk = blob.read(size)
+            if chunk:
+                yield chunk
+    else:
+        view = memoryview(blob)
+        yield bytes(view[:size])
+        for i in range(size, len(view), size):
+            yield bytes(view[i:i + size])
+
+
+class BlobKeyCollision(Exception):
+
+    def __init__(self, subpath, keys):
+        super().__init__(
+            'Cannot add blob with same keys: subpath=%s %r' % (subpath, keys))
+
+
+class NoSuchObject(Exception):
+
+    def __init__(self, keys):
+        super().__init__('No object/blob with keys {}'.format(keys))
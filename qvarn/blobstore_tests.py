@@ -0,0 +1,197 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import io
+import unittest
+
+import qvarn
+
+
+class MemoryBlobStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.obj1 = {
+            'name': 'this is my object',
+        }
+        self.obj2 = {
+            'name': 'this is my other object',
+        }
+        self.blob1 = b'my first blob'
+        self.blob2 = b'my other blob'
+
+    def create_store(self, **keys):
+        store = qvarn.MemoryObjectStore()
+        store.create_store(**keys)
+        return store
+
+    def test_has_no_blob_initially(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        with self.assertRaises(qvarn.NoSuchObject):
+            store.get_blob(key='1st', subpath='blob')
+
+    def test_add_blob_to_nonexistent_parent_fails(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        with self.assertRaises(qvarn.NoSuchObject):
+            store.create_blob(self.blob1, key='2nd', subpath='blob')
+
+    def test_adds_blob(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        blob = store.get_blob(key='1st', subpath='blob')
+        self.assertEqual(blob, self.blob1)
+
+    def test_add_blob_twice_fails(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        with self.assertRaises(qvarn.BlobKeyCollision):
+            store.create_blob(self.blob1, key='1st', subpath='blob')
+
+    def test_removes_blob(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        store.remove_blob(key='1st', subpath='blob')
+        with self.assertRaises(qvarn.NoSuchObject):
+            store.get_blob(key='1st', subpath='blob')
+
+    def test_replaces_blob(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        store.replace_blob(self.blob2, key='1st', subpath='blob')
+        self.assertEqual(store.get_blob(key='1st', subpath='blob'), self.blob2)
+        self.assertEqual(store.get_blob_count(), 1)
+
+    def test_replace_keeps_old_blob_if_new_one_cannot_be_read(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        with self.assertRaises(OSError):
+            store.replace_blob(UnreadableFile(), key='1st', subpath='blob')
+        self.assertEqual(store.get_blob(key='1st', subpath='blob'), self.blob1)
+
+    def test_replace_creates_missing_blob(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.replace_blob(self.blob1, key='1st', subpath='blob')
+        self.assertEqual(store.get_blob(key='1st', subpath='blob'), self.blob1)
+
+    def test_iterates_over_blob(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        chunks = list(store.iter_blob(key='1st', subpath='blob'))
+        self.assertEqual(b''.join(chunks), self.blob1)
+
+    def test_returns_blob_info(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        self.assertEqual(
+            store.get_blob_info(key='1st', subpath='blob'),
+            {
+                'sha256': hashlib.sha256(self.blob1).hexdigest(),
+                'size': len(self.blob1),
+            })
+
+    def test_stores_same_blob_only_once(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_object(self.obj2, key='2nd')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        store.create_blob(self.blob1, key='2nd', subpath='blob')
+        self.assertEqual(store.get_blob_count(), 1)
+        self.assertEqual(store.get_blob(key='2nd', subpath='blob'), self.blob1)
+
+    def test_keeps_shared_blob_until_last_reference_is_removed(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_object(self.obj2, key='2nd')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        store.create_blob(self.blob1, key='2nd', subpath='blob')
+        store.remove_blob(key='1st', subpath='blob')
+        self.assertEqual(store.get_blob(key='2nd', subpath='blob'), self.blob1)
+        store.remove_blob(key='2nd', subpath='blob')
+        self.assertEqual(store.get_blob_count(), 0)
+
+    def test_iterating_over_missing_blob_fails_at_once(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        with self.assertRaises(qvarn.NoSuchObject):
+            store.iter_blob(key='1st', subpath='blob')
+
+    def test_replaces_one_blob_and_keeps_others(self):
+        store = self.create_store(key=str)
+        store.create_object(self.obj1, key='1st')
+        store.create_object(self.obj2, key='2nd')
+        store.create_blob(self.blob1, key='1st', subpath='blob')
+        store.create_blob(self.blob1, key='2nd', subpath='blob')
+        store.replace_blob(self.blob2, key='1st', subpath='blob')
+        self.assertEqual(store.get_blob(key='1st', subpath='blob'), self.blob2)
+        self.assertEqual(store.get_blob(key='2nd', subpath='blob'), self.blob1)
+        self.assertEqual(store.get_blob_count(), 2)
+
+
+class HashBlobTests(unittest.TestCase):
+
+    def test_hashes_bytes(self):
+        self.assertEqual(
+            qvarn.hash_blob(b'abc'),
+            (hashlib.sha256(b'abc').hexdigest(), 3))
+
+    def test_hashes_and_rewinds_file(self):
+        f = io.BytesIO(b'abc')
+        self.assertEqual(
+            qvarn.hash_blob(f), (hashlib.sha256(b'abc').hexdigest(), 3))
+        self.assertEqual(f.read(), b'abc')
+
+
+class IterChunksTests(unittest.TestCase):
+
+    def test_returns_one_empty_chunk_for_empty_blob(self):
+        self.assertEqual(list(qvarn.iter_chunks(b'', 4)), [b''])
+
+    def test_returns_one_chunk_for_short_blob(self):
+        self.assertEqual(list(qvarn.iter_chunks(b'abc', 4)), [b'abc'])
+
+    def test_splits_bytes(self):
+        self.assertEqual(
+            list(qvarn.iter_chunks(b'abcdefghij', 4)),
+            [b'abcd', b'efgh', b'ij'])
+
+    def test_splits_exact_multiple(self):
+        self.assertEqual(
+            list(qvarn.iter_chunks(b'abcdefgh', 4)), [b'abcd', b'efgh'])
+
+    def test_splits_file(self):
+        f = io.BytesIO(b'abcdefghij')
+        self.assertEqual(
+            list(qvarn.iter_chunks(f, 4)), [b'abcd', b'efgh', b'ij'])
+
+    def test_returns_one_empty_chunk_for_empty_file(self):
+        f = io.BytesIO(b'')
+        self.assertEqual(list(qvarn.iter_chunks(f, 4)), [b''])
+
+
+class UnreadableFile:
+
+    def read(self):
+        raise OSError('cannot read')
@@ -42,6 +42,9 @@ class CollectionAPI:
     def get_type(self):
         return self._type
 
+    def unit_of_work(self, read_only=False):
+        return self._store.unit_of_work(read_only=read_only)
+
     def get_type_name(self):
         return self._type.get_type()
 
@@ -56,29 +59,59 @@ class CollectionAPI:
         result = self._post_helper(obj)
         return result
 
-    def _post_helper(self, obj):
-        meta_fields = {
-            'id': self._invent_id(obj['type']),
-            'revision': self._invent_id('revision'),
-        }
+    def post_many_with_id(self, objs):
+        v = qvarn.Validator()
+        for obj in objs:
+            v.validate_new_resource_with_id(obj, self.get_type())
 
-        new_obj = self._new_object(self._proto, obj)
+        new_objs = [self._new_resource(obj) for obj in objs]
+        pairs = []
+        for new_obj in new_objs:
+            pairs.append((new_obj, self._keys(new_obj['id'], '')))
+            for subpath, empty in self._new_empty_subresources():
+                pairs.append((empty, self._keys(new_obj['id'], subpath)))
+
+        with qvarn.Stopwatch('post many: create objects in db'):
+            self._store.create_objects(pairs)
+
+        return new_objs
+
+    def _post_helper(self, obj):
         with qvarn.Stopwatch('post helper: create object in db'):
-            for key in meta_fields:
-                if not new_obj.get(key):
-                    new_obj[key] = meta_fields[key]
+            new_obj = self._new_resource(obj)
             self._create_object(new_obj, obj_id=new_obj['id'], subpath='')
 
         with qvarn.Stopwatch('post helper: create subpaths in db'):
-            rt = self.get_type()
-            subprotos = rt.get_subpaths()
-            for subpath, subproto in subprotos.items():
-                empty = self._new_object(subproto, {})
+            for subpath, empty in self._new_empty_subresources():
                 self._create_object(
                     empty, obj_id=new_obj['id'], subpath=subpath)
 
         return new_obj
 
+    def _new_resource(self, obj):
+        meta_fields = {
+            'id': self._invent_id(obj['type']),
+            'revision': self._invent_id('revision'),
+        }
+
+        new_obj = self._new_object(self._proto, obj)
+        for key in meta_fields:
+            if not new_obj.get(key):
+                new_obj[key] = meta_fields[key]
+        return new_obj
+
+    def _new_empty_subresources(self):
+        rt = self.get_type()
+        subprotos = rt.get_subpaths()
+        for subpath, subproto in subprotos.items():
+            yield subpath, self._new_object(subproto, {})
+
+    def _keys(self, obj_id, subpath):
+        return {
+            'obj_id': obj_id,
+            'subpath': subpath,
+        }
+
     def _create_object(self, obj, **keys):
         assert set(keys.keys()) == set(self.object_keys.keys())
         self._store.create_object(obj, **keys)
@@ -111,10 +144,7 @@ class CollectionAPI:
             allow_cond is None and
             self._store.have_fine_grained_access_control())
         if need_allow_cond:  # pragma: no cover
-            assert claims is not None
-            assert access_params is not None
-            allow_cond = qvarn.AccessIsAllowed(
-                access_params, self._store.get_allow_rules())
+            allow_cond = self._get_allow_cond(claims, access_params)
 
         keys = {
             'obj_id': obj_id,
@@ -127,18 +157,23 @@ class CollectionAPI:
             return objs[0]
         raise NoSuchResource(**keys)
 
+    def _get_allow_cond(
+            self, claims, access_params):  # pragma: no cover
+        assert claims is not None
+        assert access_params is not None
+        return qvarn.AccessIsAllowed(
+            access_params, self._store.get_allow_index())
+
     def delete(self, obj_id, claims=None, access_params=None):
-        self.get(obj_id, claims=claims, access_params=access_params)
-        self._store.remove_objects(obj_id=obj_id)
+        with self._store.unit_of_work():
+            self.get(obj_id, claims=claims, access_params=access_params)
+            self._store.remove_objects(obj_id=obj_id)
 
     def list(self, claims=None, access_params=None):
         oftype = qvarn.Equal('type', self.get_type_name())
         allowed = None
         if self._store.have_fine_grained_access_control():  # pragma: no cover
-            assert claims is not None
-            assert access_params is not None
-            allowed = qvarn.AccessIsAllowed(
-                access_params, self._store.get_allow_rules())
+            allowed = self._get_allow_cond(claims, access_params)
         matches = self._store.get_matches(
             oftype, allow_cond=allowed, subpath='')
         return {
@@ -153,33 +188,42 @@ class CollectionAPI:
         v = qvarn.Validator()
         v.validate_resource_update(obj, self.get_type())
 
-        old = self.get(obj['id'], claims=claims, access_params=access_params)
-        if old['revision'] != obj['revision']:
-            raise WrongRevision(obj['revision'], old['revision'])
+        with self._store.unit_of_work():
+            old = self.get(
+                obj['id'], claims=claims, access_params=access_params)
+            if old['revision'] != obj['revision']:
+                raise WrongRevision(obj['revision'], old['revision'])
 
-        new_obj = dict(obj)
-        new_obj['revision'] = self._invent_id('revision')
-        self._store.remove_objects(obj_id=new_obj['id'], subpath='')
-        self._create_object(new_obj, obj_id=new_obj['id'], subpath='')
+            new_obj = dict(obj)
+            new_obj['revision'] = self._invent_id('revision')
+            self._store.remove_objects(obj_id=new_obj['id'], subpath='')
+            self._create_object(new_obj, obj_id=new_obj['id'], subpath='')
 
         return new_obj
 
     def put_subresource(
             self, sub_obj, subpath=None, claims=None, access_params=None,
             **keys):
-        new_sub = self.put_subresource_no_new_revision(
-            sub_obj, subpath=subpath, claims=claims,
-            access_params=access_params, **keys)
-
-        obj_id = keys.pop('obj_id')
-        parent = self._update_revision(
-            obj_id, claims=claims, access_params=access_params)
+        with self._store.unit_of_work():
+            parent, new_sub = self._put_subresource(
+                sub_obj, subpath=subpath, claims=claims,
+                access_params=access_params, **keys)
+            parent = self._update_revision(parent)
         new_sub['revision'] = parent['revision']
         return new_sub
 
     def put_subresource_no_new_revision(
             self, sub_obj, subpath=None, claims=None, access_params=None,
             **keys):
+        with self._store.unit_of_work():
+            _, new_sub = self._put_subresource(
+                sub_obj, subpath=subpath, claims=claims,
+                access_params=access_params, **keys)
+        return new_sub
+
+    def _put_subresource(
+            self, sub_obj, subpath=None, claims=None, access_params=None,
+            **keys):
         assert subpath is not None
         obj_id = keys.pop('obj_id')
         revision = keys.pop('revision')
@@ -195,7 +239,34 @@ class CollectionAPI:
         self._store.remove_objects(**keys)
         self._create_object(new_sub, **keys)
 
-        return dict(new_sub)
+        return parent, dict(new_sub)
+
+    def put_file(
+            self, obj_id, subpath, blob, content_type, revision,
+            new_revision=True, check_revision=True, claims=None,
+            access_params=None):
+        # Replace a file and its content type, and give the parent a
+        # new revision unless told not to, all in one unit of work.
+        # The parent's revision must match revision, unless told not
+        # to check it. The new revision of the parent is returned.
+        with self._store.unit_of_work():
+            parent = self.get(
+                obj_id, claims=claims, access_params=access_params)
+            if check_revision and parent['revision'] != revision:
+                raise WrongRevision(revision, parent['revision'])
+
+            sub_obj = self.get_subresource(
+                obj_id, subpath, allow_cond=qvarn.Yes())
+            sub_obj['content_type'] = content_type
+            new_sub = self._new_subresource(sub_obj, subpath)
+            keys = self._keys(obj_id, subpath)
+            self._store.remove_objects(**keys)
+            self._create_object(new_sub, **keys)
+            self._store.replace_blob(blob, **keys)
+
+            if new_revision:
+                parent = self._update_revision(parent)
+        return parent['revision']
 
     def _new_subresource(self, sub_obj, subpath):
         rt = self.get_type()
@@ -203,8 +274,11 @@ class CollectionAPI:
         subproto = subprotos[subpath]
         return qvarn.add_missing_fields(subproto, sub_obj)
 
-    def _update_revision(self, obj_id, claims=None, access_params=None):
-        obj = self.get(obj_id, claims=claims, access_params=access_params)
+    def _update_revision(self, parent):
+        # The parent was fetched in the same unit of work, so it's
+        # still current and doesn't need to be fetched again.
+        obj = dict(parent)
+        obj_id = obj['id']
         obj['revision'] = self._invent_id('revision')
         qvarn.log.log(
             'debug', msg_text='new revision after updating subresource',
@@ -310,21 +384,33 @@ class CollectionAPI:
     def _find_matches(self, cond, claims=None, access_params=None):
         allow_cond = None
         if self._store.have_fine_grained_access_control():  # pragma: no cover
-            assert claims is not None
-            assert access_params is not None
-            allow_cond = qvarn.AccessIsAllowed(
-                access_params, self._store.get_allow_rules())
+            allow_cond = self._get_allow_cond(claims, access_params)
 
         matches = self._store.get_matches(cond=cond, allow_cond=allow_cond)
-        qvarn.log.log('xxx', matches=matches)
-        obj_ids = self._uniq(keys['obj_id'] for keys, _ in matches)
-        objects = [
-            self._get_object(
-                obj_id=obj_id, subpath='', claims=claims,
-                access_params=access_params)
+        obj_ids = list(self._uniq(keys['obj_id'] for keys, _ in matches))
+        objects = {
+            keys['obj_id']: obj
+            for keys, obj in matches
+            if keys['subpath'] == ''
+        }
+
+        # If only a sub-resource matched, the parent resource needs to
+        # be fetched. Fetch all of them with one query, with the same
+        # access check, rather than one query per resource.
+        missing = [obj_id for obj_id in obj_ids if obj_id not in objects]
+        if missing:
+            parents = self._store.get_matches(
+                cond=qvarn.OneOf('id', missing), allow_cond=allow_cond,
+                subpath='')
+            for keys, obj in parents:
+                objects[keys['obj_id']] = obj
+
+        return [
+            objects[obj_id]
             for obj_id in obj_ids
+            if (obj_id in objects and
+                objects[obj_id]['type'] == self.get_type_name())
         ]
-        return [o for o in objects if o['type'] == self.get_type_name()]
 
     def _uniq(self, items):
         seen = set()
@@ -15,6 +15,7 @@
 
 
 import itertools
+import threading
 import unittest
 
 import qvarn
@@ -151,6 +152,46 @@ class CollectionAPITests(unittest.TestCase):
         new_obj2 = self.coll.post(obj)
         self.assertNotEqual(new_obj1, new_obj2)
 
+    def test_post_many_creates_new_resources(self):
+        objs = [
+            {
+                'type': 'subject',
+                'full_name': 'James Bond',
+            },
+            {
+                'type': 'subject',
+                'full_name': 'Alec Trevelyan',
+            },
+        ]
+        new_objs = self.coll.post_many_with_id(objs)
+        self.assertEqual(len(new_objs), 2)
+        self.assertNotEqual(new_objs[0]['id'], new_objs[1]['id'])
+        for obj, new_obj in zip(objs, new_objs):
+            self.assertEqual(new_obj['full_name'], obj['full_name'])
+            self.assertTrue(new_obj['revision'])
+            self.assertEqual(new_obj, self.coll.get(new_obj['id']))
+            sub = self.coll.get_subresource(new_obj['id'], 'sub')
+            self.assertEqual(sub, {'subfield': None})
+
+    def test_post_many_keeps_given_id(self):
+        obj = {
+            'type': 'subject',
+            'id': 'subject-1',
+            'full_name': 'James Bond',
+        }
+        new_objs = self.coll.post_many_with_id([obj])
+        self.assertEqual(new_objs[0]['id'], 'subject-1')
+        self.assertEqual(self.coll.get('subject-1')['full_name'], 'James Bond')
+
+    def test_post_many_raises_error_if_type_is_wrong(self):
+        obj = {
+            'type': 'unknown',
+            'full_name': 'James Bond',
+        }
+        with self.assertRaises(qvarn.ValidationError):
+            self.coll.post_many_with_id([obj])
+        self.assertEqual(self.coll.list(), {'resources': []})
+
     def test_get_raise_error_if_not_found(self):
         with self.assertRaises(qvarn.NoSuchResource):
             self.coll.get('no-such-object-id')
@@ -347,6 +388,55 @@ class CollectionAPITests(unittest.TestCase):
         self.assertNotEqual(new_parent['revision'], revision)
         self.assertEqual(new_parent['revision'], new_sub['revision'])
 
+    def test_putting_subresource_without_new_revision(self):
+        parent = {
+            'type': 'subject',
+            'full_name': 'James Bond',
+        }
+        sub = {
+            'subfield': 'subvalue',
+        }
+        new_obj = self.coll.post(parent)
+        obj_id = new_obj['id']
+        revision = new_obj['revision']
+        new_sub = self.coll.put_subresource_no_new_revision(
+            sub, subpath='sub', obj_id=obj_id, revision=revision)
+        self.assertEqual(new_sub, sub)
+        self.assertEqual(self.coll.get_subresource(obj_id, 'sub'), sub)
+        self.assertEqual(self.coll.get(obj_id)['revision'], revision)
+
+    def test_putting_subresource_without_new_revision_checks_revision(self):
+        parent = {
+            'type': 'subject',
+            'full_name': 'James Bond',
+        }
+        sub = {
+            'subfield': 'subvalue',
+        }
+        new_obj = self.coll.post(parent)
+        with self.assertRaises(qvarn.WrongRevision):
+            self.coll.put_subresource_no_new_revision(
+                sub, obj_id=new_obj['id'], revision='wrong', subpath='sub')
+
+    def test_unit_of_work_is_atomic_for_other_threads(self):
+        obj = {
+            'type': 'subject',
+            'full_name': 'James Bond',
+        }
+        seen = []
+
+        def count():
+            seen.append(len(self.coll.list()['resources']))
+
+        with self.coll.unit_of_work():
+            self.coll.post(obj)
+            t = threading.Thread(target=count)
+            t.start()
+            t.join(0.01)
+            self.coll.post(obj)
+        t.join()
+        self.assertEqual(seen, [2])
+
     def test_putting_subresource_raises_error_without_parent_object(self):
         sub = {
             'subfield': 'subvalue',
@@ -424,7 +514,7 @@ class CollectionAPITests(unittest.TestCase):
             sub, subpath='sub', obj_id=new_obj['id'],
             revision=new_obj['revision'])
         matches = self.coll.search('exact/full_name/James Bond/show_all')
-        self.assertEqual(matches, [new_obj])
+        self.assertEqual(matches, [self.coll.get(new_obj['id'])])
 
     def test_search_return_full_resources(self):
         obj = {
@@ -499,6 +589,59 @@ class CollectionAPITests(unittest.TestCase):
         return objs
 
 
+class CollectionAPIThreadTests(unittest.TestCase):
+
+    def test_posts_puts_and_searches_from_many_threads(self):
+        spec = {
+            'type': 'subject',
+            'path': '/subjects',
+            'versions': [
+                {
+                    'version': 'v0',
+                    'prototype': {
+                        'type': '',
+                        'id': '',
+                        'revision': '',
+                        'full_name': '',
+                    },
+                },
+            ],
+        }
+        rt = qvarn.ResourceType()
+        rt.from_spec(spec)
+        coll = qvarn.CollectionAPI()
+        coll.set_object_store(qvarn.MemoryObjectStore())
+        coll.set_resource_type(rt)
+
+        num_threads = 8
+        num_objects = 20
+        failures = []
+
+        def work(thread_no):
+            for i in range(num_objects):
+                name = 'Subject {} {}'.format(thread_no, i)
+                obj = coll.post({'type': 'subject', 'full_name': name})
+                obj['full_name'] = name + ' updated'
+                coll.put(obj)
+                found = coll.search(
+                    'exact/full_name/{} updated'.format(name))
+                if found != [{'id': obj['id']}]:
+                    failures.append((name, found))
+
+        threads = [
+            threading.Thread(target=work, args=(i,))
+            for i in range(num_threads)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(failures, [])
+        ids = coll.list()['resources']
+        self.assertEqual(len(ids), num_threads * num_objects)
+
+
 class FineGrainedAccessControlTests(unittest.TestCase):
 
     def setUp(self):
@@ -658,3 +801,103 @@ class FineGrainedAccessControlTests(unittest.TestCase):
             client_id=self.client_id, user_id=self.user_id)
         moar = self.get_subresource(obj_id, 'moar', self.claims, params)
         self.assertEqual(moar['nickname'], 'Nik')
+
+    def test_search_finds_nothing_with_fine_grained_access_control(self):
+        self.store.enable_fine_grained_access_control()
+        self.create_subject()
+        params = self.access_params()
+        matches = self.coll.search(
+            'exact/nickname/Nik', claims=self.claims, access_params=params)
+        self.assertEqual(matches, [])
+
+    def test_search_finds_parent_with_fine_grained_access_control(self):
+        self.store.enable_fine_grained_access_control()
+        obj_id = self.create_subject()
+        params = self.access_params(
+            client_id=self.client_id, user_id=self.user_id)
+        matches = self.coll.search(
+            'exact/nickname/Nik', claims=self.claims, access_params=params)
+        self.assertEqual(matches, [{'id': obj_id}])
+
+
+class CollectionAPIFileTests(unittest.TestCase):
+
+    def setUp(self):
+        spec = {
+            'type': 'subject',
+            'path': '/subjects',
+            'versions': [
+                {
+                    'version': 'v0',
+                    'prototype': {
+                        'type': '',
+                        'id': '',
+                        'revision': '',
+                        'full_name': '',
+                    },
+                    'subpaths': {
+                        'photo': {
+                            'prototype': {
+                                'body': 'blob',
+                                'content_type': '',
+                            },
+                        },
+                    },
+                },
+            ],
+        }
+        rt = qvarn.ResourceType()
+        rt.from_spec(spec)
+        self.store = qvarn.MemoryObjectStore()
+        self.coll = qvarn.CollectionAPI()
+        self.coll.set_object_store(self.store)
+        self.coll.set_resource_type(rt)
+        self.obj = self.coll.post({'type': 'subject', 'full_name': 'Bond'})
+
+    def put_file(self, blob, revision=None, new_revision=True):
+        if revision is None:
+            revision = self.obj['revision']
+        return self.coll.put_file(
+            self.obj['id'], 'photo', blob, 'image/jpeg', revision,
+            new_revision=new_revision)
+
+    def test_puts_file_and_content_type(self):
+        self.put_file(b'jpeg')
+        blob = self.store.get_blob(obj_id=self.obj['id'], subpath='photo')
+        self.assertEqual(blob, b'jpeg')
+        sub = self.coll.get_subresource(self.obj['id'], 'photo')
+        self.assertEqual(sub['content_type'], 'image/jpeg')
+
+    def test_replaces_file(self):
+        revision = self.put_file(b'jpeg')
+        self.put_file(b'png', revision=revision)
+        blob = self.store.get_blob(obj_id=self.obj['id'], subpath='photo')
+        self.assertEqual(blob, b'png')
+
+    def test_gives_parent_new_revision(self):
+        revision = self.put_file(b'jpeg')
+        self.assertNotEqual(revision, self.obj['revision'])
+        self.assertEqual(self.coll.get(self.obj['id'])['revision'], revision)
+
+    def test_keeps_parent_revision_if_asked(self):
+        revision = self.put_file(b'jpeg', new_revision=False)
+        self.assertEqual(revision, self.obj['revision'])
+        self.assertEqual(self.coll.get(self.obj['id'])['revision'], revision)
+
+    def test_raises_error_if_revision_is_wrong(self):
+        with self.assertRaises(qvarn.WrongRevision):
+            self.put_file(b'jpeg', revision='wrong')
+        with self.assertRaises(qvarn.NoSuchObject):
+            self.store.get_blob(obj_id=self.obj['id'], subpath='photo')
+
+    def test_skips_revision_check_if_asked(self):
+        self.coll.put_file(
+            self.obj['id'], 'photo', b'jpeg', 'image/jpeg', 'wrong',
+            new_revision=False, check_revision=False)
+        blob = self.store.get_blob(obj_id=self.obj['id'], subpath='photo')
+        self.assertEqual(blob, b'jpeg')
+
+    def test_raises_error_for_missing_resource(self):
+        with self.assertRaises(qvarn.NoSuchResource):
+            self.coll.put_file(
+                'unknown', 'photo', b'jpeg', 'image/jpeg', 'unknown')
@@ -0,0 +1,264 @@
+# Copyright (C) 2017  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Search conditions, matched against objects in memory or in SQL.'''
+
+
+import qvarn
+
+
+class Condition:  # pragma: no cover
+
+    def get_subconditions(self):
+        return []
+
+    def matches(self, obj, keys):  # pragma: no cover
+        raise NotImplementedError()
+
+    def as_sql(self):  # pragma: no cover
+        raise NotImplementedError()
+
+
+class All(Condition):
+
+    def __init__(self, *conds):
+        self.conds = list(conds)
+
+    def append_subcondition(self, cond):
+        self.conds.append(cond)
+
+    def get_subconditions(self):
+        return self.conds
+
+    def matches(self, obj, keys):
+        for cond in self.conds:
+            if not cond.matches(obj, keys):
+                return False
+        return True
+
+    def as_sql(self):  # pragma: no cover
+        pairs = [cond.as_sql() for cond in self.conds]
+        conds = ' AND '.join(query for query, _ in pairs)
+        values = {}
+        for _, value in pairs:
+            values.update(value)
+        return '( {} )'.format(conds), values
+
+
+class Cmp(Condition):  # pragma: no cover
+
+    def __init__(self, name, pattern):
+        self.name = name
+        self.pattern = pattern
+
+    def compare(self, a, b):
+        raise NotImplementedError()
+
+    def cmp_py(self, actual):
+        if isinstance(actual, str):
+            return self.compare(actual.lower(), self.pattern.lower())
+        return self.compare(actual, self.pattern)
+
+    def cmp_sql(self, pattern_name):
+        return "lower(_field->>'value') {} lower(%({})s)".format(
+            self.get_operator(), pattern_name)
+
+    def get_operator(self):
+        raise NotImplementedError()
+
+    def matches(self, obj, keys):
+        for key, actual in qvarn.flatten_object(obj):
+            if key == self.name and self.cmp_py(actual):
+                return True
+        return False
+
+    def as_sql(self):  # pragma: no cover
+        name_name = qvarn.get_unique_name('name')
+        pattern_name = qvarn.get_unique_name('pattern')
+        values = {
+            name_name: self.name,
+            pattern_name: self.pattern,
+        }
+        query = ("_field ->> 'name' = %%(%s)s AND "
+                 "_field ->> 'value' %s") % (
+                     name_name, self.cmp_sql(pattern_name))
+        return query, values
+
+
+class Equal(Cmp):
+
+    def compare(self, a, b):
+        return a == b
+
+    def get_operator(self):  # pragma: no cover
+        return '='
+
+
+class ResourceTypeIs(Equal):
+
+    def __init__(self, type_name):
+        super().__init__('type', type_name)
+
+    def matches(self, obj, keys):
+        return obj.get('type') == self.pattern
+
+
+class NotEqual(Cmp):
+
+    def compare(self, a, b):
+        return a != b
+
+    def get_operator(self):  # pragma: no cover
+        return '!='
+
+
+class GreaterThan(Cmp):
+
+    def compare(self, a, b):
+        return a > b
+
+    def get_operator(self):  # pragma: no cover
+        return '>'
+
+
+class GreaterOrEqual(Cmp):
+
+    def compare(self, a, b):
+        return a >= b
+
+    def get_operator(self):  # pragma: no cover
+        return '>='
+
+
+class LessThan(Cmp):
+
+    def compare(self, a, b):
+        return a < b
+
+    def get_operator(self):  # pragma: no cover
+        return '<'
+
+
+class LessOrEqual(Cmp):
+
+    def compare(self, a, b):
+        return a <= b
+
+    def get_operator(self):  # pragma: no cover
+        return '<='
+
+
+class Contains(Cmp):
+
+    def compare(self, a, b):
+        return b in a
+
+    def cmp_sql(self, pattern_name):  # pragma: no cover
+        t = "lower(_field->>'value') LIKE '%%' || lower(%({})s) || '%%'"
+        return t.format(pattern_name)
+
+    def get_operator(self):  # pragma: no cover
+        pass
+
+
+class Startswith(Cmp):
+
+    def compare(self, a, b):
+        return a.startswith(b)
+
+    def cmp_sql(self, pattern_name):  # pragma: no cover
+        t = "lower(_field->>'value') LIKE lower(%({})s) || '%%'"
+        return t.format(pattern_name)
+
+    def get_operator(self):  # pragma: no cover
+        pass
+
+
+class OneOf(Cmp):
+
+    def __init__(self, name, patterns):
+        super().__init__(name, list(patterns))
+
+    def compare(self, a, b):
+        return a in b
+
+    def cmp_py(self, actual):
+        return self.compare(actual, self.pattern)
+
+    def cmp_sql(self, pattern_name):  # pragma: no cover
+        return "_field->>'value' = ANY(%({})s)".format(pattern_name)
+
+    def get_operator(self):  # pragma: no cover
+        pass
+
+
+class Yes(Condition):
+
+    def compare(self, a, b):  # pragma: no cover
+        assert False
+
+    def matches(self, obj, keys):
+        return True
+
+    def as_sql(self):  # pragma: no cover
+        return 'TRUE', {}
+
+
+class No(Condition):
+
+    def compare(self, a, b):  # pragma: no cover
+        assert False
+
+    def matches(self, obj, keys):
+        return False
+
+    def as_sql(self):  # pragma: no cover
+        return 'FALSE', {}
+
+
+class AccessIsAllowed(Condition):  # pragma: no cover
+
+    def __init__(self, req_params, allow):
+        self._params = req_params
+        if not isinstance(allow, qvarn.AllowRuleIndex):
+            allow = qvarn.AllowRuleIndex(allow or [])
+        self._allow = allow
+
+    def matches(self, obj, keys):  # pragma: no cover
+        return self._allow.allows(self._params, obj, keys)
+
+    def as_sql(self):  # pragma: no cover
+        # This is a semi-join: it's checked for each object whether
+        # there is at least one matching rule, which can be found via
+        # the indexes on the _allow table. It doesn't multiply the
+        # rows in the result by the number of matching rules.
+        placeholders = {
+            key: qvarn.placeholder(key)
+            for key in self._params
+        }
+        values = {
+            qvarn.quote(key): self._params[key]
+            for key in self._params
+        }
+        conds = ' AND '.join([
+            "_allow.method = {method}",
+            "_allow.subpath = _objects.subpath",
+            "_allow.client_id IN ('*', {client_id})",
+            "_allow.user_id IN ('*', {user_id})",
+            "_allow.resource_id IN ('*', _objects.obj_id)",
+        ]).format(**placeholders)
+        query = 'EXISTS (SELECT 1 FROM _allow WHERE {})'.format(conds)
+        return query, values
@@ -41,7 +41,7 @@ class FileRouter(qvarn.Router):
     def get_routes(self):
         rt = self._parent_coll.get_type()
         file_path = '{}/<id>/{}'.format(rt.get_path(), self._subpath)
-        return [
+        routes = [
             {
                 'method': 'GET',
                 'path': file_path,
@@ -53,6 +53,7 @@ class FileRouter(qvarn.Router):
                 'callback': self._put_file,
             },
         ]
+        return self.in_units_of_work(routes, self._parent_coll)
 
     def _get_file(self, *args, **kwargs):
         qvarn.log.log('trace', msg_text='_get_file', kwargs=kwargs)
@@ -67,14 +68,53 @@ class FileRouter(qvarn.Router):
                 obj_id, claims=claims, access_params=params)
             sub_obj = self._parent_coll.get_subresource(
                 obj_id, self._subpath, claims=claims, access_params=params)
-            blob = self._store.get_blob(obj_id=obj_id, subpath=self._subpath)
+            info = self._store.get_blob_info(
+                obj_id=obj_id, subpath=self._subpath)
         except (qvarn.NoSuchResource, qvarn.NoSuchObject) as e:
             return qvarn.no_such_resource_response(str(e))
+
+        etag = '"{}"'.format(info['sha256'])
+        size = info['size']
         headers = {
             'Content-Type': sub_obj['content_type'],
             'Revision': obj['revision'],
+            'ETag': etag,
+            'Accept-Ranges': 'bytes',
         }
-        return qvarn.ok_response(blob, headers)
+
+        # FIXME: add header getting to apifw
+        import bottle
+        if_none_match = bottle.request.get_header('If-None-Match')
+        if qvarn.etag_matches(if_none_match, etag):
+            return qvarn.not_modified_response(headers)
+
+        # A Range is only honoured if If-Range, when given, still
+        # matches: otherwise the client's partial copy is stale.
+        byte_range = None
+        if_range = bottle.request.get_header('If-Range')
+        if if_range is None or qvarn.etag_matches(
+                if_range, etag, strong=True):
+            try:
+                byte_range = qvarn.parse_range(
+                    bottle.request.get_header('Range'), size)
+            except qvarn.RangeNotSatisfiable:
+                return qvarn.range_not_satisfiable_response(size)
+
+        try:
+            blob = self._store.iter_blob(
+                obj_id=obj_id, subpath=self._subpath)
+        except qvarn.NoSuchObject as e:
+            return qvarn.no_such_resource_response(str(e))
+
+        if byte_range is None:
+            headers['Content-Length'] = str(size)
+            return qvarn.ok_response(blob, headers)
+
+        start, end = byte_range
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        headers['Content-Length'] = str(end - start + 1)
+        return qvarn.partial_content_response(
+            qvarn.iter_range(blob, start, end), headers)
 
     def _put_file(self, content_type, body, *args, **kwargs):
         claims = kwargs.get('claims')
@@ -87,40 +127,30 @@ class FileRouter(qvarn.Router):
         import bottle
         revision = bottle.request.get_header('Revision')
 
+        # Clients allowed to set meta fields may upload without the
+        # current revision, and the revision isn't changed.
         id_allowed = self._api.is_id_allowed(kwargs.get('claims', {}))
 
-        obj = self._parent_coll.get(obj_id, allow_cond=qvarn.Yes())
-        if not id_allowed and obj['revision'] != revision:
+        qvarn.log.log(
+            'trace', msg_text='_put_file', claims=claims,
+            access_params=params)
+        try:
+            new_revision = self._parent_coll.put_file(
+                obj_id, self._subpath, body, content_type, revision,
+                new_revision=not id_allowed, check_revision=not id_allowed,
+                claims=claims, access_params=params)
+        except qvarn.WrongRevision as e:
             qvarn.log.log(
                 'error',
                 msg_text='Client gave wrong revision',
                 revision_from_client=revision,
-                current_revision=obj['revision'])
+                exception=str(e))
             return qvarn.conflict_response(
                 'Bad revision {}'.format(revision))
-
-        sub_obj = self._parent_coll.get_subresource(
-            obj_id, self._subpath, allow_cond=qvarn.Yes())
-        sub_obj['content_type'] = content_type
-        qvarn.log.log(
-            'trace', msg_text='_put_file', claims=claims,
-            access_params=params)
-        if id_allowed:
-            new_sub = self._parent_coll.put_subresource_no_revision(
-                sub_obj, subpath=self._subpath, obj_id=obj_id,
-                revision=revision, claims=claims, access_params=params)
-        else:
-            new_sub = self._parent_coll.put_subresource(
-                sub_obj, subpath=self._subpath, obj_id=obj_id,
-                revision=revision, claims=claims, access_params=params)
-
-        try:
-            self._store.remove_blob(obj_id=obj_id, subpath=self._subpath)
-            self._store.create_blob(body, obj_id=obj_id, subpath=self._subpath)
-        except qvarn.NoSuchObject as e:
+        except (qvarn.NoSuchResource, qvarn.NoSuchObject) as e:
             return qvarn.no_such_resource_response(str(e))
 
         headers = {
-            'Revision': new_sub['revision'],
+            'Revision': new_revision,
         }
         return qvarn.ok_response('', headers)
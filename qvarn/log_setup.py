@@ -14,10 +14,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import atexit
+
+
 import slog
 
 
-def drop_get_message(log_obj):
+import qvarn
+
+
+def drop_get_message(log_obj):  # pragma: no cover
     # These are useless and annoying in gunicorn log messages.
     if 'getMessage' in log_obj:
         del log_obj['getMessage']
@@ -30,23 +36,62 @@ def drop_get_message(log_obj):
 gunicorn_loggers = ['gunicorn.access', 'gunicorn.error']
 
 
+class LevelGatedLog(slog.StructuredLog):
+
+    '''A structured log that skips message types no writer accepts.
+
+    Each writer is added with a function that tells if its filter
+    lets through a message type, or None if the filter may let
+    through messages of any type. Messages of a type no writer
+    accepts are dropped before anything is done with them. Code that
+    would do expensive work only to log it can check enabled() first.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._accepts = []
+        self._enabled = {}
+
+    def add_log_writer(self, writer, rule, accepts=None):
+        super().add_log_writer(writer, rule)
+        self._accepts.append(accepts)
+        self._enabled = {}
+
+    def enabled(self, msg_type):
+        # This is called for every log message, so the answer is
+        # cached per message type.
+        enabled = self._enabled.get(msg_type)
+        if enabled is None:
+            enabled = any(
+                accepts is None or accepts(msg_type)
+                for accepts in self._accepts)
+            self._enabled[msg_type] = enabled
+        return enabled
+
+    def log(self, msg_type, **kwargs):
+        if self.enabled(msg_type):
+            super().log(msg_type, **kwargs)
+
+
 # This sets up a global log variable that doesn't actually log
 # anything anywhere. This is useful so that code can unconditionally
 # call log.log(...) from anywhere. See setup_logging() for setting up
 # actual logging to somewhere persistent.
 
-log = slog.StructuredLog()
-log.add_log_writer(slog.NullSlogWriter(), slog.FilterAllow())
+log = LevelGatedLog()
+log.add_log_writer(
+    slog.NullSlogWriter(), slog.FilterAllow(), accepts=lambda t: False)
 log.add_log_massager(drop_get_message)
 slog.hijack_logging(log, logger_names=gunicorn_loggers)
 
 
-def setup_logging(config):
+def setup_logging(config):  # pragma: no cover
     for target in config.get('log', []):
         setup_logging_to_target(target)
 
 
-def setup_logging_to_target(target):
+def setup_logging_to_target(target):  # pragma: no cover
     rule = get_filter_rules(target)
     if 'filename' in target:
         setup_logging_to_file(target, rule)
@@ -54,15 +99,48 @@ def setup_logging_to_target(target):
         raise Exception('Do not understand logging target %r' % target)
 
 
-def get_filter_rules(target):
+def get_filter_rules(target):  # pragma: no cover
     if 'filter' in target:
         return slog.construct_log_filter(target['filter'])
     return slog.FilterAllow()
 
 
-def setup_logging_to_file(target, rule):
+def get_accepted_types(target, rule):
+    # If the filter only looks at msg_type, return a function that
+    # tells if it lets through a message type, by trying it on a
+    # message with only that field. Otherwise any type may get
+    # through, depending on other fields, which is signalled by
+    # returning None. Specs without a field, such as grep and
+    # traceback specs, look at other fields.
+    specs = target.get('filter')
+    if specs is None:
+        return None
+    if any(spec.get('field') != 'msg_type' for spec in specs):
+        return None
+
+    def accepts(msg_type):
+        # A rule may fail in any way on a message with no other
+        # fields. The type is then let through, to be safe.
+        try:
+            return bool(rule.allow({'msg_type': msg_type}))
+        except Exception:  # pylint: disable=broad-except
+            return True
+
+    return accepts
+
+
+def setup_logging_to_file(target, rule):  # pragma: no cover
     writer = slog.FileSlogWriter()
     writer.set_filename(target['filename'])
     if 'max_bytes' in target:
         writer.set_max_file_size(target['max_bytes'])
-    log.add_log_writer(writer, rule)
+    if target.get('async'):
+        writer = qvarn.AsyncLogWriter(
+            writer,
+            max_queue=target.get('queue_size', 10000),
+            max_batch=target.get('batch_size', 100),
+            when_full=target.get('when_full', 'drop-oldest'))
+        writer.start()
+        atexit.register(writer.stop)
+    log.add_log_writer(
+        writer, rule, accepts=get_accepted_types(target, rule))
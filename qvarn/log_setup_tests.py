@@ -0,0 +1,126 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+
+import qvarn
+
+
+class LevelGatedLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.log = qvarn.LevelGatedLog()
+        self.writer = DummyWriter()
+
+    def test_is_enabled_for_types_a_writer_accepts(self):
+        self.log.add_log_writer(
+            self.writer, AllowTypes('error'), accepts=lambda t: t == 'error')
+        self.assertTrue(self.log.enabled('error'))
+        self.assertFalse(self.log.enabled('debug'))
+
+    def test_is_enabled_for_any_type_if_a_writer_may_accept_it(self):
+        self.log.add_log_writer(
+            self.writer, AllowTypes('error'), accepts=lambda t: False)
+        self.log.add_log_writer(self.writer, AllowTypes('error'))
+        self.assertTrue(self.log.enabled('debug'))
+
+    def test_rechecks_types_when_writer_is_added(self):
+        self.log.add_log_writer(
+            self.writer, AllowTypes('error'), accepts=lambda t: t == 'error')
+        self.assertFalse(self.log.enabled('debug'))
+        self.log.add_log_writer(
+            self.writer, AllowTypes('debug'), accepts=lambda t: t == 'debug')
+        self.assertTrue(self.log.enabled('debug'))
+
+    def test_drops_messages_no_writer_accepts(self):
+        self.log.add_log_writer(
+            self.writer, AllowTypes('error'), accepts=lambda t: t == 'error')
+        self.log.log('debug', msg_text='dropped')
+        self.log.log('error', msg_text='written')
+        self.assertEqual(
+            [log_obj['msg_text'] for log_obj in self.writer.written],
+            ['written'])
+
+
+class GetAcceptedTypesTests(unittest.TestCase):
+
+    def test_accepts_any_type_without_filter(self):
+        self.assertEqual(qvarn.get_accepted_types({}, AllowTypes()), None)
+
+    def test_tries_types_on_msg_type_filter(self):
+        target = {
+            'filter': [
+                {'field': 'msg_type', 'regexp': '^error$'},
+            ],
+        }
+        accepts = qvarn.get_accepted_types(target, AllowTypes('error'))
+        self.assertTrue(accepts('error'))
+        self.assertFalse(accepts('debug'))
+
+    def test_accepts_any_type_if_a_spec_looks_at_another_field(self):
+        target = {
+            'filter': [
+                {'field': 'msg_type', 'regexp': '^error$'},
+                {'field': 'msg_text', 'regexp': 'oops'},
+            ],
+        }
+        accepts = qvarn.get_accepted_types(target, AllowTypes('error'))
+        self.assertEqual(accepts, None)
+
+    def test_accepts_any_type_if_a_spec_has_no_field(self):
+        for spec in [{'grep': 'oops'}, {'traceback': True}]:
+            target = {
+                'filter': [
+                    {'field': 'msg_type', 'regexp': '^error$'},
+                    spec,
+                ],
+            }
+            accepts = qvarn.get_accepted_types(target, AllowTypes('error'))
+            self.assertEqual(accepts, None)
+
+    def test_accepts_type_if_filter_fails_on_it(self):
+        target = {
+            'filter': [
+                {'field': 'msg_type', 'regexp': '^error$'},
+            ],
+        }
+        accepts = qvarn.get_accepted_types(target, BrokenRule())
+        self.assertTrue(accepts('debug'))
+
+
+class AllowTypes:
+
+    def __init__(self, *msg_types):
+        self._msg_types = msg_types
+
+    def allow(self, log_obj):
+        return log_obj['msg_type'] in self._msg_types
+
+
+class BrokenRule:
+
+    def allow(self, log_obj):
+        raise KeyError('msg_text')
+
+
+class DummyWriter:
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, log_obj):
+        self.written.append(log_obj)
@@ -0,0 +1,170 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+
+
+import qvarn
+
+
+class AsyncLogWriter:
+
+    '''Write log messages via another slog writer, in a background thread.
+
+    Messages are put in a bounded ring buffer by the threads logging
+    them. A writer thread takes up to max_batch messages at a time
+    from the buffer and gives them to the wrapped writer, which then
+    does the serialising and writing.
+
+    If the buffer is full, the when_full policy decides what happens:
+    "block" waits for there to be room, "drop" throws away the new
+    message, and "drop-oldest" throws away the oldest message in the
+    buffer to make room. Dropped messages are counted, and the
+    count is written to the log as a warning once there's room.
+
+    A message must not be modified after it's been logged, since it
+    may be serialised later, in another thread.
+
+    The stop method writes any messages still in the buffer. It should
+    be called when the process is shutting down. Messages logged after
+    stop are written at once, in the thread logging them.
+
+    '''
+
+    # The attributes are the settings, the buffer, and its state.
+    # pylint: disable=too-many-instance-attributes
+
+    policies = ('block', 'drop', 'drop-oldest')
+
+    def __init__(self, writer, max_queue=10000, max_batch=100,
+                 when_full='drop-oldest'):
+        if when_full not in self.policies:
+            raise qvarn.UnknownQueuePolicy(when_full)
+        self._writer = writer
+        self._max_queue = max_queue
+        self._max_batch = max_batch
+        self._when_full = when_full
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._stopped = False
+        self._dropped = 0
+        self._unreported = 0
+
+    def get_dropped_count(self):
+        with self._cond:
+            return self._dropped
+
+    def start(self):
+        assert self._thread is None
+        self._thread = threading.Thread(
+            target=self._run, name='log writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            with self._cond:
+                self._stopping = True
+                self._cond.notify_all()
+            self._thread.join()
+            self._thread = None
+
+        # Writers blocked on a full buffer, and any later ones, write
+        # their messages themselves from now on.
+        with self._cond:
+            self._stopped = True
+            batch = list(self._buffer)
+            self._buffer.clear()
+            unreported = self._unreported
+            self._unreported = 0
+            self._cond.notify_all()
+        self._write(batch, unreported)
+
+    def close(self):
+        self.stop()
+        self._writer.close()
+
+    def write(self, log_obj):
+        with self._cond:
+            if len(self._buffer) >= self._max_queue and not self._stopped:
+                if self._when_full == 'block':
+                    while (len(self._buffer) >= self._max_queue and
+                           not self._stopped):
+                        self._cond.wait()
+                elif self._when_full == 'drop-oldest':
+                    self._buffer.popleft()
+                    self._count_dropped()
+                else:
+                    self._count_dropped()
+                    return
+            if not self._stopped:
+                self._buffer.append(log_obj)
+                self._cond.notify_all()
+                return
+            unreported = self._unreported
+            self._unreported = 0
+        self._write([log_obj], unreported)
+
+    def _count_dropped(self):
+        # Must be called with self._cond held.
+        self._dropped += 1
+        self._unreported += 1
+        self._count_dropped_metric()
+
+    def _count_dropped_metric(self):
+        qvarn.metrics.counter(
+            'qvarn_log_messages_dropped_total',
+            'Log messages dropped because the buffer was full, '
+            'or writing them failed').inc()
+
+    def _take_batch(self):
+        # Must be called with self._cond held.
+        batch = []
+        while self._buffer and len(batch) < self._max_batch:
+            batch.append(self._buffer.popleft())
+        unreported = self._unreported
+        self._unreported = 0
+        self._cond.notify_all()
+        return batch, unreported
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                batch, unreported = self._take_batch()
+            self._write(batch, unreported)
+
+    def _write(self, batch, unreported):
+        if unreported:
+            batch.append({
+                'msg_type': 'warning',
+                'msg_text': 'Log buffer was full, dropped messages',
+                'count': unreported,
+            })
+        for log_obj in batch:
+            # The wrapped writer may fail in any way. The message is
+            # then dropped, and counted, but the others are written.
+            try:
+                self._writer.write(log_obj)
+            except Exception:  # pylint: disable=broad-except
+                with self._cond:
+                    self._dropped += 1
+                self._count_dropped_metric()
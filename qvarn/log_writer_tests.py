@@ -0,0 +1,178 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import unittest
+
+
+import qvarn
+
+
+class AsyncLogWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = DummyWriter()
+
+    def test_raises_error_for_unknown_policy(self):
+        with self.assertRaises(qvarn.UnknownQueuePolicy):
+            qvarn.AsyncLogWriter(self.writer, when_full='panic')
+
+    def test_writes_nothing_if_nothing_is_logged(self):
+        w = qvarn.AsyncLogWriter(self.writer)
+        w.stop()
+        self.assertEqual(self.writer.written, [])
+
+    def test_writes_buffered_messages_when_stopped(self):
+        w = qvarn.AsyncLogWriter(self.writer)
+        w.write({'id': 1})
+        w.write({'id': 2})
+        self.assertEqual(self.writer.written, [])
+        w.stop()
+        self.assertEqual(self.writer.written, [{'id': 1}, {'id': 2}])
+
+    def test_closes_wrapped_writer(self):
+        w = qvarn.AsyncLogWriter(self.writer)
+        w.write({'id': 1})
+        w.close()
+        self.assertEqual(self.writer.written, [{'id': 1}])
+        self.assertTrue(self.writer.closed)
+
+    def test_drops_newest_message_when_full(self):
+        w = qvarn.AsyncLogWriter(self.writer, max_queue=2, when_full='drop')
+        for i in range(3):
+            w.write({'id': i})
+        self.assertEqual(w.get_dropped_count(), 1)
+        w.stop()
+        self.assertEqual(
+            self.writer.written,
+            [
+                {'id': 0},
+                {'id': 1},
+                {
+                    'msg_type': 'warning',
+                    'msg_text': 'Log buffer was full, dropped messages',
+                    'count': 1,
+                },
+            ]
+        )
+
+    def test_drops_oldest_message_when_full(self):
+        w = qvarn.AsyncLogWriter(
+            self.writer, max_queue=2, when_full='drop-oldest')
+        for i in range(4):
+            w.write({'id': i})
+        self.assertEqual(w.get_dropped_count(), 2)
+        w.stop()
+        self.assertEqual(self.writer.written[:2], [{'id': 2}, {'id': 3}])
+        self.assertEqual(self.writer.written[2]['count'], 2)
+
+    def test_reports_drops_only_once(self):
+        w = qvarn.AsyncLogWriter(self.writer, max_queue=1, when_full='drop')
+        w.write({'id': 1})
+        w.write({'id': 2})
+        w.stop()
+        w.write({'id': 3})
+        w.stop()
+        self.assertEqual(self.writer.written[-1], {'id': 3})
+        self.assertEqual(w.get_dropped_count(), 1)
+
+    def test_writes_at_once_after_stop(self):
+        w = qvarn.AsyncLogWriter(self.writer)
+        w.stop()
+        w.write({'id': 1})
+        self.assertEqual(self.writer.written, [{'id': 1}])
+
+    def test_does_not_block_on_full_buffer_after_stop(self):
+        w = qvarn.AsyncLogWriter(self.writer, max_queue=1, when_full='block')
+        w.write({'id': 1})
+        w.stop()
+        w.write({'id': 2})
+        self.assertEqual(self.writer.written, [{'id': 1}, {'id': 2}])
+
+    def test_writes_when_blocked_writer_is_stopped(self):
+        w = qvarn.AsyncLogWriter(self.writer, max_queue=1, when_full='block')
+        w.write({'id': 1})
+        stopper = threading.Timer(0.01, w.stop)
+        stopper.start()
+        w.write({'id': 2})
+        stopper.join()
+        self.assertCountEqual(self.writer.written, [{'id': 1}, {'id': 2}])
+
+    def test_thread_writes_messages_in_batches(self):
+        w = qvarn.AsyncLogWriter(self.writer, max_batch=2)
+        w.start()
+        for i in range(3):
+            w.write({'id': i})
+        self.wait_for_messages(3)
+        w.stop()
+        self.assertEqual(
+            self.writer.written, [{'id': 0}, {'id': 1}, {'id': 2}])
+
+    def test_thread_makes_room_for_blocked_writer(self):
+        w = qvarn.AsyncLogWriter(self.writer, max_queue=1, when_full='block')
+        w.start()
+        for i in range(3):
+            w.write({'id': i})
+        self.wait_for_messages(3)
+        w.stop()
+        self.assertEqual(
+            self.writer.written, [{'id': 0}, {'id': 1}, {'id': 2}])
+
+    def test_thread_reports_dropped_messages(self):
+        w = qvarn.AsyncLogWriter(self.writer, max_queue=1, when_full='drop')
+        w.write({'id': 1})
+        w.write({'id': 2})
+        w.start()
+        self.wait_for_messages(2)
+        w.stop()
+        self.assertEqual(self.writer.written[0], {'id': 1})
+        self.assertEqual(self.writer.written[1]['count'], 1)
+
+    def test_counts_failed_writes_as_dropped(self):
+        counter = qvarn.metrics.counter(
+            'qvarn_log_messages_dropped_total', 'Dropped log messages')
+        count = counter.get()
+        w = qvarn.AsyncLogWriter(BrokenWriter())
+        w.write({'id': 1})
+        w.stop()
+        self.assertEqual(w.get_dropped_count(), 1)
+        self.assertEqual(counter.get(), count + 1)
+
+    def wait_for_messages(self, count):
+        deadline = time.time() + 10
+        while len(self.writer.written) < count:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.001)
+
+
+class BrokenWriter:
+
+    def write(self, log_obj):
+        raise OSError('disk full')
+
+
+class DummyWriter:
+
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, log_obj):
+        self.written.append(log_obj)
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,208 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+
+class MetricsRegistry:
+
+    '''Keep counters, gauges, and histograms in memory.
+
+    Each metric has a name, and values for any number of label sets.
+    Metrics are created the first time they're asked for, and after
+    that the same metric is returned. The whole registry can be
+    formatted in the Prometheus text exposition format.
+
+    All methods may be called from several threads at once.
+
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, help_text):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text):
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=None):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def _get(self, klass, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = klass(name, help_text, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, klass):
+                raise MetricTypeMismatch(name)
+            return metric
+
+    def format_text(self):
+        with self._lock:
+            in_order = [self._metrics[name] for name in sorted(self._metrics)]
+        return ''.join(metric.format_text() for metric in in_order)
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, help_text):
+        self._name = name
+        self._help = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def format_text(self):
+        lines = [
+            '# HELP {} {}\n'.format(self._name, _escape(self._help, False)),
+            '# TYPE {} {}\n'.format(self._name, self.kind),
+        ]
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._format_value(key, self._values[key]))
+        return ''.join(lines)
+
+    def _format_value(self, key, value):
+        return [_sample(self._name, key, value)]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+
+    '''Count observations in buckets, as well as their count and sum.
+
+    The default buckets grow in a 1-2-5 sequence from 0.1 ms to 60 s,
+    so that the relative error of a percentile read from them is about
+    the same for short and long durations.
+
+    '''
+
+    kind = 'histogram'
+
+    default_buckets = [
+        mantissa * 10 ** exponent
+        for exponent in range(-4, 2)
+        for mantissa in (1, 2, 5)
+    ] + [60]
+
+    def __init__(self, name, help_text, buckets=None):
+        super().__init__(name, help_text)
+        self._buckets = sorted(buckets or self.default_buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = {
+                    'buckets': [0] * len(self._buckets),
+                    'count': 0,
+                    'sum': 0,
+                }
+                self._values[key] = data
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    data['buckets'][i] += 1
+                    break
+            data['count'] += 1
+            data['sum'] += value
+
+    def get_count(self, **labels):
+        with self._lock:
+            data = self._values.get(self._key(labels))
+            return data['count'] if data else 0
+
+    def get_sum(self, **labels):
+        with self._lock:
+            data = self._values.get(self._key(labels))
+            return data['sum'] if data else 0
+
+    def _format_value(self, key, data):
+        # Prometheus buckets are cumulative: each counts observations
+        # less than or equal to its upper bound.
+        lines = []
+        total = 0
+        for bound, count in zip(self._buckets, data['buckets']):
+            total += count
+            le = key + (('le', _number(bound)),)
+            lines.append(_sample(self._name + '_bucket', le, total))
+        le = key + (('le', '+Inf'),)
+        lines.append(_sample(self._name + '_bucket', le, data['count']))
+        lines.append(_sample(self._name + '_sum', key, data['sum']))
+        lines.append(_sample(self._name + '_count', key, data['count']))
+        return lines
+
+
+def _sample(name, key, value):
+    if key:
+        labels = ','.join(
+            '{}="{}"'.format(label, _escape(str(v), True))
+            for label, v in key)
+        name = '{}{{{}}}'.format(name, labels)
+    return '{} {}\n'.format(name, _number(value))
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+def _escape(text, quote):
+    text = text.replace('\\', r'\\').replace('\n', r'\n')
+    if quote:
+        text = text.replace('"', r'\"')
+    return text
+
+
+# The registry the Qvarn server uses, shown by the /metrics route.
+metrics = MetricsRegistry()
+
+
+class MetricTypeMismatch(Exception):
+
+    def __init__(self, name):
+        super().__init__(
+            'Metric {} already exists with another type'.format(name))
@@ -0,0 +1,36 @@
+# Copyright (C) 2017  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import qvarn
+
+
+class MetricsRouter(qvarn.Router):
+
+    def get_routes(self):
+        return [
+            {
+                'method': 'GET',
+                'path': '/metrics',
+                'callback': self._get_metrics,
+                'needs-authorization': False,
+            },
+        ]
+
+    def _get_metrics(self, *args, **kwargs):
+        headers = {
+            'Content-Type': 'text/plain; version=0.0.4',
+        }
+        return qvarn.ok_response(qvarn.metrics.format_text(), headers)
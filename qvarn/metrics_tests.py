@@ -0,0 +1,122 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+import qvarn
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = qvarn.MetricsRegistry()
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.metrics.format_text(), '')
+
+    def test_returns_same_metric_for_same_name(self):
+        c1 = self.metrics.counter('foo', 'Foo')
+        c2 = self.metrics.counter('foo', 'Foo')
+        self.assertTrue(c1 is c2)
+
+    def test_raises_error_for_same_name_with_other_type(self):
+        self.metrics.counter('foo', 'Foo')
+        with self.assertRaises(qvarn.MetricTypeMismatch):
+            self.metrics.histogram('foo', 'Foo')
+
+    def test_counts_per_label_set(self):
+        c = self.metrics.counter('requests_total', 'Requests')
+        c.inc(route='GET')
+        c.inc(route='GET')
+        c.inc(3, route='PUT')
+        self.assertEqual(c.get(route='GET'), 2)
+        self.assertEqual(c.get(route='PUT'), 3)
+        self.assertEqual(c.get(route='DELETE'), 0)
+
+    def test_gauge_is_set(self):
+        g = self.metrics.gauge('connections', 'Connections')
+        g.set(5, state='idle')
+        g.set(2, state='idle')
+        self.assertEqual(g.get(state='idle'), 2)
+
+    def test_formats_counter(self):
+        c = self.metrics.counter('requests_total', 'Number of requests')
+        c.inc(route='GET', status='200')
+        self.assertEqual(
+            self.metrics.format_text(),
+            '# HELP requests_total Number of requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{route="GET",status="200"} 1\n')
+
+    def test_escapes_label_values(self):
+        c = self.metrics.counter('foo', 'Foo')
+        c.inc(path='a"b\\c\nd')
+        self.assertIn(
+            'foo{path="a\\"b\\\\c\\nd"} 1\n', self.metrics.format_text())
+
+    def test_histogram_counts_and_sums(self):
+        h = self.metrics.histogram('duration', 'Duration', buckets=[1, 10])
+        h.observe(0.5, route='GET')
+        h.observe(5, route='GET')
+        self.assertEqual(h.get_count(route='GET'), 2)
+        self.assertEqual(h.get_sum(route='GET'), 5.5)
+        self.assertEqual(h.get_count(route='PUT'), 0)
+        self.assertEqual(h.get_sum(route='PUT'), 0)
+
+    def test_formats_histogram_with_cumulative_buckets(self):
+        h = self.metrics.histogram('duration', 'Duration', buckets=[1, 10])
+        h.observe(0.5)
+        h.observe(5)
+        h.observe(50)
+        self.assertEqual(
+            self.metrics.format_text(),
+            '# HELP duration Duration\n'
+            '# TYPE duration histogram\n'
+            'duration_bucket{le="1"} 1\n'
+            'duration_bucket{le="10"} 2\n'
+            'duration_bucket{le="+Inf"} 3\n'
+            'duration_sum 55.5\n'
+            'duration_count 3\n')
+
+    def test_formats_integral_float_without_decimals(self):
+        h = self.metrics.histogram('duration', 'Duration', buckets=[1, 10])
+        h.observe(2.0)
+        self.assertIn('duration_sum 2\n', self.metrics.format_text())
+
+    def test_default_buckets_grow_from_fraction_of_millisecond(self):
+        h = self.metrics.histogram('duration', 'Duration')
+        h.observe(0.00005)
+        text = self.metrics.format_text()
+        self.assertIn('duration_bucket{le="0.0001"} 1\n', text)
+        self.assertIn('duration_bucket{le="60"} 1\n', text)
+
+    def test_counts_from_many_threads(self):
+        c = self.metrics.counter('foo', 'Foo')
+        h = self.metrics.histogram('bar', 'Bar')
+
+        def work():
+            for i in range(1000):
+                c.inc()
+                h.observe(0.001)
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(c.get(), 8000)
+        self.assertEqual(h.get_count(), 8000)
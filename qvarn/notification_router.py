@@ -51,7 +51,7 @@ class NotificationRouter(qvarn.Router):
         notification_id_path = '{}/<notification_id>'.format(
             notifications_path)
 
-        return [
+        routes = [
             {
                 'method': 'POST',
                 'path': listeners_path,
@@ -87,6 +87,11 @@ class NotificationRouter(qvarn.Router):
                 'path': notifications_path,
                 'callback': self._get_notifications_list,
             },
+            {
+                'method': 'DELETE',
+                'path': notifications_path,
+                'callback': self._delete_notifications,
+            },
             {
                 'method': 'GET',
                 'path': notification_id_path,
@@ -98,6 +103,7 @@ class NotificationRouter(qvarn.Router):
                 'callback': self._delete_notification,
             },
         ]
+        return self.in_units_of_work(routes, self._listener_coll)
 
     def _create_listener(self, content_type, body, *args, **kwargs):
         if content_type != 'application/json':
@@ -151,7 +157,8 @@ class NotificationRouter(qvarn.Router):
                 lid, claims=claims, access_params=params)
             for lid in listener_ids
         ]
-        qvarn.log.log('trace', msg_text='xxx', listeners=listeners)
+        qvarn.log.log(
+            'trace', msg_text='Listeners found', listeners=listeners)
         correct_ids = [
             {"id": listener['id']}
             for listener in listeners
@@ -216,23 +223,30 @@ class NotificationRouter(qvarn.Router):
         listener_id = kwargs['listener_id']
         self._listener_coll.delete(
             listener_id, claims=claims, access_params=params)
-        for obj_id in self._find_notifications(listener_id):
-            self._store.remove_objects(obj_id=obj_id)
+        self._delete_listener_notifications(listener_id)
         return qvarn.ok_response({})
 
-    def _find_notifications(self, listener_id):
-        cond = qvarn.All(
+    def _delete_listener_notifications(self, listener_id):
+        # A listener may have a very large number of pending
+        # notifications. They all get removed in one statement, in one
+        # transaction, rather than one at a time.
+        qvarn.log.log(
+            'info', msg_text='Deleting notifications of listener',
+            listener_id=listener_id)
+        cond = self._notifications_cond(listener_id)
+        with qvarn.Stopwatch(
+                'delete notifications of listener', listener_id=listener_id):
+            count = self._store.remove_matches(cond)
+        qvarn.log.log(
+            'info', msg_text='Deleted notifications of listener',
+            listener_id=listener_id, count=count)
+
+    def _notifications_cond(self, listener_id, *conds):
+        return qvarn.All(
             qvarn.Equal('type', 'notification'),
             qvarn.Equal('listener_id', listener_id),
+            *conds
         )
-        obj_ids = [
-            keys['obj_id']
-            for keys, _ in self._store.get_matches(cond)
-        ]
-        qvarn.log.log(
-            'trace', msg_text='Found notifications',
-            notifications=obj_ids)
-        return obj_ids
 
     def _get_notifications_list(self, *args, **kwargs):
         def timestamp(pair):
@@ -240,10 +254,7 @@ class NotificationRouter(qvarn.Router):
             return obj['timestamp']
 
         listener_id = kwargs['listener_id']
-        cond = qvarn.All(
-            qvarn.Equal('type', 'notification'),
-            qvarn.Equal('listener_id', listener_id)
-        )
+        cond = self._notifications_cond(listener_id)
         pairs = self._store.get_matches(cond)
         ordered = sorted(pairs, key=timestamp)
         body = {
@@ -259,11 +270,8 @@ class NotificationRouter(qvarn.Router):
     def _get_a_notification(self, *args, **kwargs):
         listener_id = kwargs['listener_id']
         notification_id = kwargs['notification_id']
-        cond = qvarn.All(
-            qvarn.Equal('type', 'notification'),
-            qvarn.Equal('listener_id', listener_id),
-            qvarn.Equal('id', notification_id),
-        )
+        cond = self._notifications_cond(
+            listener_id, qvarn.Equal('id', notification_id))
         pairs = self._store.get_matches(cond)
         if not pairs:
             return qvarn.no_such_resource_response(notification_id)
@@ -289,16 +297,39 @@ class NotificationRouter(qvarn.Router):
     def _delete_notification(self, *args, **kwargs):
         listener_id = kwargs['listener_id']
         notification_id = kwargs['notification_id']
-        cond = qvarn.All(
-            qvarn.Equal('type', 'notification'),
-            qvarn.Equal('listener_id', listener_id),
-            qvarn.Equal('id', notification_id),
-        )
-        for keys, _ in self._store.get_matches(cond):
-            values = {
-                key: keys[key]
-                for key in keys
-                if isinstance(keys[key], str)
-            }
-            self._store.remove_objects(**values)
+        cond = self._notifications_cond(
+            listener_id, qvarn.Equal('id', notification_id))
+        self._store.remove_matches(cond)
         return qvarn.ok_response({})
+
+    def _delete_notifications(self, content_type, body, *args, **kwargs):
+        if content_type != 'application/json':
+            raise qvarn.NotJson(content_type)
+
+        if not isinstance(body, dict):
+            return qvarn.bad_request_response('body must be a JSON object')
+
+        ids = body.get('ids')
+        until = body.get('until')
+        if ids is None and until is None:
+            return qvarn.bad_request_response('must have ids or until')
+
+        listener_id = kwargs['listener_id']
+        cond = self._notifications_cond(listener_id)
+        if ids is not None:
+            if not isinstance(ids, list) or not ids or not all(
+                    isinstance(notif_id, str) for notif_id in ids):
+                return qvarn.bad_request_response(
+                    'ids must be a non-empty list of strings')
+            cond.append_subcondition(qvarn.OneOf('id', ids))
+        if until is not None:
+            if not isinstance(until, str):
+                return qvarn.bad_request_response(
+                    'until must be a timestamp string')
+            cond.append_subcondition(qvarn.LessOrEqual('timestamp', until))
+
+        count = self._store.remove_matches(cond)
+        qvarn.log.log(
+            'info', msg_text='Deleted notifications',
+            listener_id=listener_id, count=count)
+        return qvarn.ok_response({'deleted': count})
@@ -14,7 +14,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import contextlib
 import json
+import threading
 
 
 import qvarn
@@ -80,9 +82,15 @@ class ObjectStoreInterface:  # pragma: no cover
     def create_object(self, obj, auxtable=True, **keys):
         raise NotImplementedError()
 
+    def create_objects(self, pairs, auxtable=True):
+        raise NotImplementedError()
+
     def remove_objects(self, **keys):
         raise NotImplementedError()
 
+    def remove_matches(self, cond, **keys):
+        raise NotImplementedError()
+
     def get_matches(self, cond=None, allow_cond=None, **keys):
         raise NotImplementedError()
 
@@ -92,9 +100,34 @@ class ObjectStoreInterface:  # pragma: no cover
     def get_blob(self, subpath=None, **keys):
         raise NotImplementedError()
 
+    def iter_blob(self, subpath=None, **keys):
+        # Return an iterator over the chunks of a blob, to avoid
+        # having all of a big blob in memory at once. NoSuchObject is
+        # raised at once if there is no blob, not when iterating.
+        raise NotImplementedError()
+
+    def get_blob_info(self, subpath=None, **keys):
+        # Return a dict with the SHA-256 (as hex, key "sha256") and
+        # size in bytes (key "size") of a blob.
+        raise NotImplementedError()
+
     def remove_blob(self, subpath=None, **keys):
         raise NotImplementedError()
 
+    def replace_blob(self, blob, subpath=None, **keys):
+        # Remove any existing blob and create a new one, atomically.
+        # Unlike create_blob, this does not check that the object
+        # exists: the caller is expected to have just written it.
+        raise NotImplementedError()
+
+    @contextlib.contextmanager
+    def unit_of_work(self, read_only=False):
+        # Calls made by the current thread within this context are
+        # done atomically, as one unit. If read_only is true, the
+        # caller promises not to change anything, except possibly
+        # outside the unit of work.
+        yield
+
     def have_fine_grained_access_control(self):
         return self._fine_grained_access_control
 
@@ -104,103 +137,123 @@ class ObjectStoreInterface:  # pragma: no cover
     def get_allow_rules(self):
         raise NotImplementedError()
 
+    def get_allow_index(self):
+        raise NotImplementedError()
+
     def has_allow_rule(self, rule):
         raise NotImplementedError()
 
     def add_allow_rule(self, rule):
         raise NotImplementedError()
 
+    def add_allow_rules(self, rules):
+        raise NotImplementedError()
+
+    def replace_allow_rules(self, rules):
+        raise NotImplementedError()
+
     def remove_allow_rule(self, rule):
         raise NotImplementedError()
 
 
-class MemoryObjectStore(ObjectStoreInterface):
+class MemoryObjectStore(qvarn.MemoryBlobStoreMixin, ObjectStoreInterface):
+
+    '''Store objects in memory.
+
+    All methods may be called from several threads at once: each call
+    holds a lock for its whole duration. A unit of work holds the lock
+    until it ends.
+
+    '''
+
+    # The attributes mirror the tables of the PostgreSQL store.
+    # pylint: disable=too-many-instance-attributes
 
     def __init__(self):
         super().__init__()
+        self._lock = threading.RLock()
         self._objs = []
         self._blobs = []
+        self._blobdata = {}
         self._known_keys = {}
         self._fine_grained_access_control = False
         self._allow = []
+        self._allow_index = qvarn.AllowRuleIndex()
 
     def get_known_keys(self):
         return self._known_keys
 
+    @contextlib.contextmanager
+    def unit_of_work(self, read_only=False):
+        with self._lock:
+            yield
+
     def create_store(self, **keys):
-        self.check_keys_have_str_type(**keys)
-        qvarn.log.log(
-            'trace', msg_text='Creating store', keys=repr(keys), exc_info=True)
-        self._known_keys = keys
+        with self._lock:
+            self.check_keys_have_str_type(**keys)
+            if qvarn.log.enabled('trace'):
+                qvarn.log.log(
+                    'trace', msg_text='Creating store', keys=repr(keys),
+                    exc_info=True)
+            self._known_keys = keys
 
     def create_object(self, obj, auxtable=True, **keys):
-        qvarn.log.log(
-            'trace', msg_text='Creating object', object=repr(obj), keys=keys)
-        self.check_all_keys_are_allowed(**keys)
-        self.check_value_types(**keys)
-        self._check_unique_object(**keys)
-        self._objs.append((obj, keys))
+        with self._lock:
+            if qvarn.log.enabled('trace'):
+                qvarn.log.log(
+                    'trace', msg_text='Creating object', object=repr(obj),
+                    keys=keys)
+            self.check_all_keys_are_allowed(**keys)
+            self.check_value_types(**keys)
+            self._check_unique_object(**keys)
+            self._objs.append((obj, keys))
+
+    def create_objects(self, pairs, auxtable=True):
+        with self._lock:
+            for obj, keys in pairs:
+                self.create_object(obj, auxtable=auxtable, **keys)
 
     def _check_unique_object(self, **keys):
         for _, k in self._objs:
             if self._keys_match(k, keys):
                 raise KeyCollision(k)
 
-    def create_blob(self, blob, subpath=None, **keys):
-        qvarn.log.log('trace', msg_text='Creating blob', keys=keys)
-        self.check_all_keys_are_allowed(**keys)
-        self.check_value_types(**keys)
-        self._check_unique_blob(subpath, **keys)
-        if not self.get_matches(**keys):
-            raise NoSuchObject(keys)
-        self._blobs.append((blob, subpath, keys))
-
-    def _check_unique_blob(self, subpath, **keys):
-        for _, s, k in self._blobs:
-            if self._keys_match(k, keys) and s == subpath:
-                raise BlobKeyCollision(subpath, k)
-
-    def get_blob(self, subpath=None, **keys):
-        self.check_all_keys_are_allowed(**keys)
-        self.check_value_types(**keys)
-        blobs = [
-            b
-            for b, s, k in self._blobs
-            if self._keys_match(k, keys) and s == subpath
-        ]
-        assert len(blobs) <= 1
-        if not blobs:
-            raise NoSuchObject(keys)
-        return blobs[0]
-
-    def remove_blob(self, subpath=None, **keys):
-        self.check_all_keys_are_allowed(**keys)
-        self.check_value_types(**keys)
-        self._blobs = [
-            b
-            for b, s, k in self._blobs
-            if not self._keys_match(k, keys) or s != subpath
-        ]
-
     def remove_objects(self, **keys):
-        self.check_all_keys_are_allowed(**keys)
-        self._objs = [
-            (o, k) for o, k in self._objs if not self._keys_match(k, keys)]
+        with self._lock:
+            self.check_all_keys_are_allowed(**keys)
+            self._objs = [
+                (o, k)
+                for o, k in self._objs
+                if not self._keys_match(k, keys)
+            ]
+
+    def remove_matches(self, cond, **keys):
+        with self._lock:
+            self.check_all_keys_are_allowed(**keys)
+            kept = [
+                (o, k)
+                for o, k in self._objs
+                if not (self._keys_match(k, keys) and cond.matches(o, k))
+            ]
+            removed = len(self._objs) - len(kept)
+            self._objs = kept
+            return removed
 
     def get_matches(self, cond=None, allow_cond=None, **keys):
-        assert cond is not None or len(keys) > 0
-        self.check_all_keys_are_allowed(**keys)
-        if cond is None:
-            cond = qvarn.Yes()
-        if allow_cond is None:
-            allow_cond = qvarn.Yes()
-        return [
-            (k, o)
-            for o, k in self._objs
-            if (self._keys_match(k, keys) and cond.
-                matches(o, k) and
-                allow_cond.matches(o, k))
-        ]
+        with self._lock:
+            assert cond is not None or len(keys) > 0
+            self.check_all_keys_are_allowed(**keys)
+            if cond is None:
+                cond = qvarn.Yes()
+            if allow_cond is None:
+                allow_cond = qvarn.Yes()
+            return [
+                (k, o)
+                for o, k in self._objs
+                if (self._keys_match(k, keys) and cond.
+                    matches(o, k) and
+                    allow_cond.matches(o, k))
+            ]
 
     def _keys_match(self, got_keys, wanted_keys):
         for key in wanted_keys.keys():
@@ -209,33 +262,75 @@ class MemoryObjectStore(ObjectStoreInterface):
         return True
 
     def get_allow_rules(self):
-        return list(self._allow)
+        with self._lock:
+            return list(self._allow)
+
+    def get_allow_index(self):
+        with self._lock:
+            return self._allow_index
 
     def has_allow_rule(self, rule):
-        return rule in self._allow
+        with self._lock:
+            return rule in self._allow
 
     def add_allow_rule(self, rule):
-        self._allow.append(dict(rule))
+        with self._lock:
+            if rule not in self._allow:
+                self._allow.append(dict(rule))
+                self._allow_index.add(rule)
+
+    def add_allow_rules(self, rules):
+        with self._lock:
+            for rule in rules:
+                self.add_allow_rule(rule)
+
+    def replace_allow_rules(self, rules):
+        with self._lock:
+            self._allow = []
+            self._allow_index = qvarn.AllowRuleIndex()
+            self.add_allow_rules(rules)
 
     def remove_allow_rule(self, rule):
-        self._allow = [r for r in self._allow if r != rule]
+        with self._lock:
+            self._allow = [r for r in self._allow if r != rule]
+            self._allow_index.remove(rule)
 
 
-class PostgresObjectStore(ObjectStoreInterface):  # pragma: no cover
+class PostgresObjectStore(
+        qvarn.PostgresBlobStoreMixin,
+        ObjectStoreInterface):  # pragma: no cover
 
     _table = '_objects'
     _auxtable = '_aux'
-    _blobtable = '_blobs'
     _allowtable = '_allow'
-
-    def __init__(self, sql):
+    _allowcolumns = [
+        'method',
+        'client_id',
+        'user_id',
+        'subpath',
+        'resource_id',
+        'resource_type',
+        'resource_field',
+        'resource_value',
+    ]
+
+    # Max number of rules to insert with one INSERT statement.
+    _allowbatch = 1000
+
+    def __init__(self, sql, blobs=None):
         super().__init__()
         self._sql = sql
+        if blobs is None:
+            blobs = qvarn.PostgresBlobBackend(sql)
+        self._blob_backend = blobs
         self._keys = None
 
     def get_known_keys(self):
         return self._keys
 
+    def unit_of_work(self, read_only=False):
+        return self._sql.unit_of_work(read_only=read_only)
+
     def create_store(self, **keys):
         self.check_keys_have_str_type(**keys)
         self._keys = dict(keys)
@@ -249,25 +344,46 @@ class PostgresObjectStore(ObjectStoreInterface):  # pragma: no cover
 
         # Create helper table for blobs.
         self._create_table(self._blobtable, self._keys, '_blob', bytes)
+        self._add_blob_columns()
+        self._create_blob_data_tables()
+        self._hash_old_blobs()
 
         # Create table for fine-grained access control rules.
         self._create_allow_table()
 
     def _create_allow_table(self):
         columns = {
-            'method': str,
-            'client_id': str,
-            'user_id': str,
-            'subpath': str,
-            'resource_id': str,
-            'resource_type': str,
-            'resource_field': str,
-            'resource_value': str,
+            name: str
+            for name in self._allowcolumns
         }
         with self._sql.transaction() as t:
             query = t.create_table(self._allowtable, **columns)
             t.execute(query, {})
 
+            # This matches the access check done for each object in
+            # searches (see AccessIsAllowed.as_sql).
+            index_name = self._index_name(self._allowtable, 'access', '')
+            query = t.create_multicolumn_index(
+                self._allowtable, index_name, 'method', 'subpath',
+                'client_id', 'user_id', 'resource_id')
+            t.execute(query, {})
+
+            # Duplicate rules may exist from before the unique index
+            # was added, and need to be removed before it can be
+            # created. An earlier version of the index treated NULL
+            # (any value) and '' as equal, and is replaced.
+            index_name = self._index_name(self._allowtable, 'unique2', '')
+            query, values = t.has_index(index_name)
+            if not list(t.execute(query, values)):
+                query = t.remove_duplicate_rows(
+                    self._allowtable, *self._allowcolumns)
+                t.execute(query, {})
+                old_name = self._index_name(self._allowtable, 'unique', '')
+                t.execute(t.drop_index(old_name), {})
+                query = t.create_unique_index(
+                    self._allowtable, index_name, *self._allowcolumns)
+                t.execute(query, {})
+
     def _create_table(
             self, name, col_dict, col_name, col_type, index=False,
             jsonb_index=False):
@@ -302,12 +418,47 @@ class PostgresObjectStore(ObjectStoreInterface):  # pragma: no cover
         return '{}_idx'.format(name)
 
     def create_object(self, obj, auxtable=True, **keys):
-        with self._sql.transaction() as t:
+        span = qvarn.tracer.span('store: create object')
+        with span, self._sql.transaction() as t:
             self._remove_objects_in_transaction(t, **keys)
             self._insert_into_object_table(t, self._table, obj, **keys)
             if auxtable:
                 self._insert_into_helper(t, self._auxtable, obj, **keys)
 
+    def create_objects(self, pairs, auxtable=True):
+        # Create many new objects in one transaction, with one
+        # multi-row INSERT per table. Unlike create_object, this does
+        # not remove existing objects with the same keys first, so
+        # it's only meant for objects with newly invented ids.
+        if not pairs:
+            return
+        span = qvarn.tracer.span('store: create objects', count=len(pairs))
+        with span, self._sql.transaction() as t:
+            rows = []
+            for obj, keys in pairs:
+                row = dict(keys)
+                row['_obj'] = json.dumps(obj)
+                rows.append(row)
+            self._insert_rows(t, self._table, rows)
+
+            if auxtable:
+                rows = []
+                for obj, keys in pairs:
+                    for field, value in flatten_object(obj):
+                        row = dict(keys)
+                        row['_field'] = json.dumps({
+                            'name': field,
+                            'value': value,
+                        })
+                        rows.append(row)
+                self._insert_rows(t, self._auxtable, rows)
+
+    def _insert_rows(self, t, table_name, rows):
+        if rows:
+            column_names = list(rows[0].keys())
+            query, values = t.insert_objects(table_name, column_names, rows)
+            t.execute(query, values)
+
     def _insert_into_object_table(self, t, table_name, obj, **keys):
         keys['_obj'] = json.dumps(obj)
         column_names = list(keys.keys())
@@ -326,13 +477,26 @@ class PostgresObjectStore(ObjectStoreInterface):  # pragma: no cover
             t.execute(query, keys)
 
     def remove_objects(self, **keys):
-        with self._sql.transaction() as t:
+        span = qvarn.tracer.span('store: remove objects')
+        with span, self._sql.transaction() as t:
             query = t.remove_objects(self._table, *keys.keys())
             t.execute(query, keys)
 
             query = t.remove_objects(self._auxtable, *keys.keys())
             t.execute(query, keys)
 
+    def remove_matches(self, cond, **keys):
+        # All matching objects are removed with one DELETE statement,
+        # instead of finding them first and removing them one by one.
+        self.check_all_keys_are_allowed(**keys)
+        key_names = list(self.get_known_keys().keys())
+        span = qvarn.tracer.span('store: remove matches')
+        with span, self._sql.transaction() as t:
+            query, values = t.remove_objects_with_cond(
+                self._table, self._auxtable, key_names, cond, **keys)
+            cursor = t.execute(query, values)
+            return cursor.rowcount
+
     def _remove_objects_in_transaction(self, t, **keys):
         query = t.remove_objects(self._table, *keys.keys())
         t.execute(query, keys)
@@ -343,7 +507,8 @@ class PostgresObjectStore(ObjectStoreInterface):  # pragma: no cover
         if cond is None:
             cond = qvarn.Yes()
 
-        with self._sql.transaction() as t:
+        span = qvarn.tracer.span('store: get matches')
+        with span, self._sql.transaction(read_only=True) as t:
             query, values = t.select_objects_with_keys_and_cond(
                 self._table, cond, allow_cond, **keys)
             cursor = t.execute(query, values)
@@ -363,51 +528,17 @@ class PostgresObjectStore(ObjectStoreInterface):  # pragma: no cover
         obj = row.pop('_obj')
         return keys, obj
 
-    def create_blob(self, blob, subpath=None, **keys):
-        keys['subpath'] = subpath
-        self.check_all_keys_are_allowed(**keys)
-        self.check_value_types(**keys)
-        if not self.get_matches(**keys):
-            raise NoSuchObject(keys)
-
-        with self._sql.transaction() as t:
-            column_names = list(keys.keys()) + ['_blob']
-            query = t.insert_object(self._blobtable, *column_names)
-
-            values = dict(keys)
-            values['_blob'] = blob
-
-            t.execute(query, values)
-
-    def get_blob(self, subpath=None, **keys):
-        keys['subpath'] = subpath
-        self.check_all_keys_are_allowed(**keys)
-        self.check_value_types(**keys)
-
-        column_names = list(keys.keys())
-
-        with self._sql.transaction() as t:
-            query = t.select_objects(self._blobtable, '_blob', *column_names)
-            blobs = [bytes(row['_blob']) for row in t.execute(query, keys)]
-            if not blobs:
-                raise NoSuchObject(keys)
-            return blobs
-
-    def remove_blob(self, subpath=None, **keys):
-        keys['subpath'] = subpath
-        self.check_all_keys_are_allowed(**keys)
-        self.check_value_types(**keys)
-
-        column_names = list(keys.keys())
-        with self._sql.transaction() as t:
-            query = t.remove_objects(self._blobtable, *column_names)
-            t.execute(query, keys)
-
     def get_allow_rules(self):
         return None
 
+    def get_allow_index(self):
+        # The rules are in the database, which may be shared by
+        # several Qvarn instances, so they can't be cached here. Access
+        # checks are done in SQL instead.
+        return None
+
     def has_allow_rule(self, rule):
-        with self._sql.transaction() as t:
+        with self._sql.transaction(read_only=True) as t:
             query = t.has_allow_rule(self._allowtable, rule)
             for row in t.execute(query, rule):
                 return True
@@ -416,12 +547,34 @@ class PostgresObjectStore(ObjectStoreInterface):  # pragma: no cover
     def add_allow_rule(self, rule):
         with self._sql.transaction() as t:
             column_names = list(rule.keys())
-            query = t.insert_object(self._allowtable, *column_names)
+            query = t.insert_object(
+                self._allowtable, *column_names, skip_duplicates=True)
             qvarn.log.log(
                 'trace', msg_text='add_allow_rule, SQL',
                 query=query, rule=rule)
             t.execute(query, rule)
 
+    def add_allow_rules(self, rules):
+        with self._sql.transaction() as t:
+            self._insert_allow_rules(t, rules)
+
+    def replace_allow_rules(self, rules):
+        with self._sql.transaction() as t:
+            query = t.remove_all_rows(self._allowtable)
+            t.execute(query, {})
+            self._insert_allow_rules(t, rules)
+
+    def _insert_allow_rules(self, t, rules):
+        rows = [
+            {name: rule.get(name) for name in self._allowcolumns}
+            for rule in rules
+        ]
+        for i in range(0, len(rows), self._allowbatch):
+            query, values = t.insert_objects(
+                self._allowtable, self._allowcolumns,
+                rows[i:i + self._allowbatch], skip_duplicates=True)
+            t.execute(query, values)
+
     def remove_allow_rule(self, rule):
         column_names = list(rule.keys())
         with self._sql.transaction() as t:
@@ -435,13 +588,6 @@ class KeyCollision(Exception):
         super().__init__('Cannot add object with same keys: %r' % keys)
 
 
-class BlobKeyCollision(Exception):
-
-    def __init__(self, subpath, keys):
-        super().__init__(
-            'Cannot add blob with same keys: subpath=%s %r' % (subpath, keys))
-
-
 class UnknownKey(Exception):
 
     def __init__(self, key):
@@ -462,12 +608,6 @@ class KeyValueError(Exception):
         super().__init__('Key %r value %r has the wrong type' % (key, value))
 
 
-class NoSuchObject(Exception):
-
-    def __init__(self, keys):
-        super().__init__('No object/blob with keys {}'.format(keys))
-
-
 def flatten_object(obj):
     # We sort only by the name, not the object in each pair in the
     # list. Otherwise, if there are two fields with the same name but
@@ -14,6 +14,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import qvarn
@@ -28,8 +32,8 @@ class ObjectStoreTests(unittest.TestCase):
         self.obj2 = {
             'name': 'this is my other object',
         }
-        self.blob1 = 'my first blob'
-        self.blob2 = 'my other blob'
+        self.blob1 = b'my first blob'
+        self.blob2 = b'my other blob'
 
     def create_store(self, **keys):
         store = qvarn.MemoryObjectStore()
@@ -64,6 +68,14 @@ class ObjectStoreTests(unittest.TestCase):
         store.create_object(self.obj1, key='1st')
         self.assertEqual(self.get_all_objects(store), [self.obj1])
 
+    def test_adds_many_objects(self):
+        store = self.create_store(key=str)
+        store.create_objects([
+            (self.obj1, {'key': '1st'}),
+            (self.obj2, {'key': '2nd'}),
+        ])
+        self.assertEqual(self.get_all_objects(store), [self.obj1, self.obj2])
+
     def test_raises_error_for_surprising_keys(self):
         store = self.create_store(key=str)
         with self.assertRaises(qvarn.UnknownKey):
@@ -154,39 +166,118 @@ class ObjectStoreTests(unittest.TestCase):
             [({'key': '1st'}, self.obj1)]
         )
 
-    def test_has_no_blob_initially(self):
+    def test_removes_matching_objects(self):
         store = self.create_store(key=str)
         store.create_object(self.obj1, key='1st')
-        with self.assertRaises(qvarn.NoSuchObject):
-            store.get_blob(key='1st', subpath='blob')
+        store.create_object(self.obj2, key='2nd')
+        cond = qvarn.Equal('name', self.obj1['name'])
+        self.assertEqual(store.remove_matches(cond), 1)
+        self.assertEqual(self.get_all_objects(store), [self.obj2])
 
-    def test_add_blob_to_nonexistent_parent_fails(self):
+    def test_removes_matching_objects_only_with_given_keys(self):
         store = self.create_store(key=str)
         store.create_object(self.obj1, key='1st')
-        with self.assertRaises(qvarn.NoSuchObject):
-            store.create_blob(self.blob1, key='2nd', subpath='blob')
+        store.create_object(self.obj2, key='2nd')
+        self.assertEqual(store.remove_matches(qvarn.Yes(), key='2nd'), 1)
+        self.assertEqual(self.get_all_objects(store), [self.obj1])
 
-    def test_adds_blob(self):
+    def test_removes_nothing_if_nothing_matches(self):
         store = self.create_store(key=str)
         store.create_object(self.obj1, key='1st')
-        store.create_blob(self.blob1, key='1st', subpath='blob')
-        blob = store.get_blob(key='1st', subpath='blob')
-        self.assertEqual(blob, self.blob1)
+        cond = qvarn.Equal('name', 'no such name')
+        self.assertEqual(store.remove_matches(cond), 0)
+        self.assertEqual(self.get_all_objects(store), [self.obj1])
 
-    def test_add_blob_twice_fails(self):
-        store = self.create_store(key=str)
-        store.create_object(self.obj1, key='1st')
-        store.create_blob(self.blob1, key='1st', subpath='blob')
-        with self.assertRaises(qvarn.BlobKeyCollision):
-            store.create_blob(self.blob1, key='1st', subpath='blob')
 
-    def test_removes_blob(self):
-        store = self.create_store(key=str)
-        store.create_object(self.obj1, key='1st')
-        store.create_blob(self.blob1, key='1st', subpath='blob')
-        store.remove_blob(key='1st', subpath='blob')
-        with self.assertRaises(qvarn.NoSuchObject):
-            store.get_blob(key='1st', subpath='blob')
+class ObjectStoreThreadTestsMixin:
+
+    num_threads = 8
+
+    def test_creates_and_removes_objects_from_many_threads(self):
+        store = self.create_store(obj_id=str)
+        num_threads = self.num_threads
+        num_objects = 100
+
+        def work(thread_no):
+            for i in range(num_objects):
+                obj_id = '{}-{}'.format(thread_no, i)
+                store.create_object({'n': i}, obj_id=obj_id)
+                if i % 2:
+                    store.remove_objects(obj_id=obj_id)
+
+        threads = [
+            threading.Thread(target=work, args=(i,))
+            for i in range(num_threads)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        matches = store.get_matches(qvarn.Yes())
+        self.assertEqual(len(matches), num_threads * num_objects // 2)
+
+
+class MemoryObjectStoreThreadTests(
+        ObjectStoreThreadTestsMixin, unittest.TestCase):
+
+    def create_store(self, **keys):
+        store = qvarn.MemoryObjectStore()
+        store.create_store(**keys)
+        return store
+
+    def test_unit_of_work_is_atomic_for_other_threads(self):
+        store = qvarn.MemoryObjectStore()
+        store.create_store(obj_id=str)
+        seen = []
+
+        def count():
+            seen.append(len(store.get_matches(qvarn.Yes())))
+
+        with store.unit_of_work():
+            store.create_object({'n': 1}, obj_id='1')
+            t = threading.Thread(target=count)
+            t.start()
+            t.join(0.01)
+            store.create_object({'n': 2}, obj_id='2')
+        t.join()
+        self.assertEqual(seen, [2])
+
+
+@unittest.skipUnless(
+    os.environ.get('QVARN_TEST_DATABASE'),
+    'QVARN_TEST_DATABASE is not set')
+class PostgresObjectStoreThreadTests(
+        ObjectStoreThreadTestsMixin, unittest.TestCase):  # pragma: no cover
+
+    def create_store(self, **keys):
+        # One connection per thread, so that threads contend for rows
+        # rather than just wait for the pool.
+        sql = connect_to_test_database(max_conn=self.num_threads)
+        store = qvarn.PostgresObjectStore(sql)
+        store.create_store(**keys)
+        return store
+
+
+class MemoryObjectStoreTraceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = DummyWriter()
+        self.saved_log = qvarn.log
+        qvarn.log = qvarn.LevelGatedLog()
+        qvarn.log.add_log_writer(
+            self.writer, AllowTypes('trace'), accepts=lambda t: t == 'trace')
+
+    def tearDown(self):
+        qvarn.log = self.saved_log
+
+    def test_logs_creation_of_store_and_objects_when_tracing(self):
+        store = qvarn.MemoryObjectStore()
+        store.create_store(key=str)
+        store.create_object({'name': 'foo'}, key='1st')
+        self.assertEqual(
+            [log_obj['msg_text'] for log_obj in self.writer.written],
+            ['Creating store', 'Creating object'])
 
 
 class FlattenObjectsTests(unittest.TestCase):
@@ -273,6 +364,130 @@ class FindObjectsTests(unittest.TestCase):
         self.assertEqual(objs, [(keys1, obj1)])
 
 
+class RemoveMatchesTestsMixin:
+
+    # The same tests are run against both kinds of stores, which must
+    # agree on what matches and what gets removed.
+
+    def create_store(self, **keys):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.store = self.create_store(obj_id=str, subpath=str)
+        self.parent = {'name': 'parent'}
+        self.sub = {'foo': 'yo'}
+        self.other = {'foo': 'bar'}
+        self.store.create_object(self.parent, obj_id='1', subpath='')
+        self.store.create_object(self.sub, obj_id='1', subpath='sub')
+        self.store.create_object(self.other, obj_id='1', subpath='other')
+
+    def get_remaining(self):
+        matches = self.store.get_matches(qvarn.Yes(), obj_id='1')
+        return sorted(keys['subpath'] for keys, _ in matches)
+
+    def test_removes_only_matching_subresource(self):
+        count = self.store.remove_matches(qvarn.Equal('foo', 'yo'))
+        self.assertEqual(count, 1)
+        self.assertEqual(self.get_remaining(), ['', 'other'])
+
+    def test_removes_only_matching_subresource_with_given_keys(self):
+        count = self.store.remove_matches(qvarn.Yes(), subpath='other')
+        self.assertEqual(count, 1)
+        self.assertEqual(self.get_remaining(), ['', 'sub'])
+
+
+class MemoryRemoveMatchesTests(RemoveMatchesTestsMixin, unittest.TestCase):
+
+    def create_store(self, **keys):
+        store = qvarn.MemoryObjectStore()
+        store.create_store(**keys)
+        return store
+
+
+@unittest.skipUnless(
+    os.environ.get('QVARN_TEST_DATABASE'),
+    'QVARN_TEST_DATABASE is not set')
+class PostgresRemoveMatchesTests(
+        RemoveMatchesTestsMixin, unittest.TestCase):  # pragma: no cover
+
+    def create_store(self, **keys):
+        store = qvarn.PostgresObjectStore(connect_to_test_database())
+        store.create_store(**keys)
+        return store
+
+
+@unittest.skipUnless(
+    os.environ.get('QVARN_TEST_DATABASE'),
+    'QVARN_TEST_DATABASE is not set')
+class PostgresFilesystemBlobTests(unittest.TestCase):  # pragma: no cover
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.backend = qvarn.FilesystemBlobBackend(self.tempdir)
+        self.store = qvarn.PostgresObjectStore(
+            connect_to_test_database(), blobs=self.backend)
+        self.store.create_store(obj_id=str, subpath=str)
+        self.blob = b'hello, world'
+        self.hash, _ = qvarn.hash_blob(self.blob)
+        self.store.create_object({}, obj_id='1', subpath='file')
+        self.store.create_blob(self.blob, obj_id='1', subpath='file')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_removes_file_when_removal_is_committed(self):
+        self.store.remove_blob(obj_id='1', subpath='file')
+        filename = self.backend.get_filename(self.hash)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_keeps_file_when_removal_is_rolled_back(self):
+        with self.assertRaises(RollBack):
+            with self.store.unit_of_work():
+                self.store.remove_blob(obj_id='1', subpath='file')
+                raise RollBack()
+        self.assertEqual(
+            self.store.get_blob(obj_id='1', subpath='file'), self.blob)
+
+
+def connect_to_test_database(max_conn=1):  # pragma: no cover
+    # QVARN_TEST_DATABASE names a scratch database, whose Qvarn
+    # tables are removed. The other connection parameters come from
+    # the usual PG* environment variables.
+    tables = ['_objects', '_aux', '_blobs', '_blobrefs', '_blobdata', '_allow']
+    sql = qvarn.PostgresAdapter()
+    sql.connect(
+        database=os.environ['QVARN_TEST_DATABASE'],
+        user=None, password=None, host=None, port=None,
+        min_conn=1, max_conn=max_conn)
+    with sql.transaction() as t:
+        for table in tables:
+            t.execute('DROP TABLE IF EXISTS {}'.format(table), {})
+    return sql
+
+
+class RollBack(Exception):
+
+    pass
+
+
+class AllowTypes:
+
+    def __init__(self, *msg_types):
+        self._msg_types = msg_types
+
+    def allow(self, log_obj):
+        return log_obj['msg_type'] in self._msg_types
+
+
+class DummyWriter:
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, log_obj):
+        self.written.append(log_obj)
+
+
 class AllowRuleTests(unittest.TestCase):
 
     rule = {
@@ -318,3 +533,38 @@ class AllowRuleTests(unittest.TestCase):
         store.add_allow_rule(self.rule)
         store.remove_allow_rule(self.rule)
         self.assertFalse(store.has_allow_rule(self.rule))
+
+    def test_allow_index_follows_added_and_removed_rules(self):
+        store = self.create_store(obj_id=str)
+        rule = dict(self.rule, resource_id='*')
+        params = {
+            'method': 'GET',
+            'client_id': 'test-client',
+            'user_id': 'test-user',
+        }
+        obj = {'type': 'person'}
+        keys = {'obj_id': '123'}
+        store.add_allow_rule(rule)
+        self.assertTrue(store.get_allow_index().allows(params, obj, keys))
+        store.remove_allow_rule(rule)
+        self.assertFalse(store.get_allow_index().allows(params, obj, keys))
+
+    def test_does_not_add_duplicate_rule(self):
+        store = self.create_store(obj_id=str)
+        store.add_allow_rule(self.rule)
+        store.add_allow_rule(self.rule)
+        self.assertEqual(store.get_allow_rules(), [self.rule])
+
+    def test_adds_many_allow_rules(self):
+        store = self.create_store(obj_id=str)
+        other = dict(self.rule, method='PUT')
+        store.add_allow_rules([self.rule, other, self.rule])
+        self.assertEqual(store.get_allow_rules(), [self.rule, other])
+
+    def test_replaces_allow_rules(self):
+        store = self.create_store(obj_id=str)
+        other = dict(self.rule, method='PUT')
+        store.add_allow_rule(self.rule)
+        store.replace_allow_rules([other])
+        self.assertFalse(store.has_allow_rule(self.rule))
+        self.assertTrue(store.has_allow_rule(other))
@@ -0,0 +1,157 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+
+
+import qvarn
+
+
+# The pool keeps its settings, its state, and its statistics as
+# separate attributes.
+class ConnectionPool:  # pylint: disable=too-many-instance-attributes
+
+    '''A pool of database connections, shared by threads.
+
+    Connections are made by calling the connect function, which gets
+    no arguments. At most max_conn connections are open at a time. If
+    they're all in use, get_conn waits for one to be returned, for up
+    to timeout seconds, and then raises PoolTimeout.
+
+    A connection that has been idle for check_interval seconds or
+    more is checked to be alive when it is taken from the pool. This
+    catches connections broken by a database restart. A dead
+    connection is closed and replaced by a new one. Connections that
+    are closed when returned to the pool are dropped.
+
+    '''
+
+    def __init__(self, connect, min_conn=1, max_conn=1, timeout=30.0,
+                 check_interval=5.0):
+        self._connect = connect
+        self._max_conn = max_conn
+        self._timeout = timeout
+        self._check_interval = check_interval
+        self._cond = threading.Condition()
+        self._idle = []
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+        for _ in range(min_conn):
+            self._idle.append((self._connect(), time.time()))
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'max_conn': self._max_conn,
+                'checkouts': self._checkouts,
+                'wait_ms_total': 1000.0 * self._wait_total,
+                'wait_ms_max': 1000.0 * self._wait_max,
+                'timeouts': self._timeouts,
+                'reconnects': self._reconnects,
+            }
+
+    def get_conn(self):
+        conn, idle_since = self._checkout()
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.time() - idle_since >= self._check_interval:
+                if not self._is_alive(conn):
+                    conn = self._reconnect(conn)
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def put_conn(self, conn):
+        with self._cond:
+            self._in_use -= 1
+            if not conn.closed:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def _checkout(self):
+        started = time.time()
+        deadline = started + self._timeout
+        with self._cond:
+            self._waiting += 1
+            try:
+                while not self._idle and self._in_use >= self._max_conn:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(self._timeout)
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            waited = time.time() - started
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+            return None, None
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        # The pool doesn't know which database library made the
+        # connection, so any error means the connection is broken.
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+        except Exception as e:  # pylint: disable=broad-except
+            qvarn.log.log(
+                'warning', msg_text='Database connection is broken',
+                exception=str(e))
+            return False
+        return True
+
+    def _reconnect(self, conn):
+        # Closing a broken connection may fail in any way. It's being
+        # replaced anyway, so the error doesn't matter.
+        try:
+            conn.close()
+        except Exception:  # pragma: no cover pylint: disable=broad-except
+            pass
+        new_conn = self._connect()
+        with self._cond:
+            self._reconnects += 1
+        qvarn.log.log('info', msg_text='Reconnected to database')
+        return new_conn
+
+
+class PoolTimeout(Exception):
+
+    def __init__(self, timeout):
+        super().__init__(
+            'No database connection became free in {} seconds'.format(
+                timeout))
@@ -0,0 +1,155 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+import qvarn
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, query):
+        if self._conn.broken:
+            raise Exception('connection is broken')
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+    def connect(self):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def create_pool(self, **kwargs):
+        return qvarn.ConnectionPool(self.connect, **kwargs)
+
+    def test_opens_min_conn_connections_at_start(self):
+        self.create_pool(min_conn=2, max_conn=3)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_reuses_returned_connection(self):
+        pool = self.create_pool(min_conn=0, max_conn=1)
+        conn = pool.get_conn()
+        pool.put_conn(conn)
+        self.assertEqual(pool.get_conn(), conn)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_opens_new_connections_up_to_max(self):
+        pool = self.create_pool(min_conn=0, max_conn=2, timeout=0.01)
+        conn1 = pool.get_conn()
+        conn2 = pool.get_conn()
+        self.assertNotEqual(conn1, conn2)
+        with self.assertRaises(qvarn.PoolTimeout):
+            pool.get_conn()
+        self.assertEqual(len(self.connections), 2)
+
+    def test_times_out_when_all_connections_are_in_use(self):
+        pool = self.create_pool(min_conn=0, max_conn=1, timeout=0.01)
+        pool.get_conn()
+        with self.assertRaises(qvarn.PoolTimeout):
+            pool.get_conn()
+        self.assertEqual(pool.get_stats()['timeouts'], 1)
+
+    def test_waits_for_connection_to_be_returned(self):
+        pool = self.create_pool(min_conn=0, max_conn=1, timeout=10)
+        conn = pool.get_conn()
+        timer = threading.Timer(0.01, pool.put_conn, args=(conn,))
+        timer.start()
+        self.assertEqual(pool.get_conn(), conn)
+        timer.join()
+
+    def test_replaces_broken_connection(self):
+        pool = self.create_pool(min_conn=1, max_conn=1, check_interval=0)
+        conn = pool.get_conn()
+        conn.broken = True
+        pool.put_conn(conn)
+        new_conn = pool.get_conn()
+        self.assertNotEqual(new_conn, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.get_stats()['reconnects'], 1)
+
+    def test_replaces_connection_closed_while_idle(self):
+        pool = self.create_pool(min_conn=1, max_conn=1, check_interval=0)
+        conn = pool.get_conn()
+        pool.put_conn(conn)
+        conn.close()
+        self.assertNotEqual(pool.get_conn(), conn)
+        self.assertEqual(pool.get_stats()['reconnects'], 1)
+
+    def test_releases_slot_when_connecting_fails(self):
+        pool = qvarn.ConnectionPool(
+            self.fail_to_connect, min_conn=0, max_conn=1, timeout=0.01)
+        with self.assertRaises(ConnectError):
+            pool.get_conn()
+        self.assertEqual(pool.get_stats()['in_use'], 0)
+
+    def fail_to_connect(self):
+        raise ConnectError()
+
+    def test_does_not_check_recently_used_connection(self):
+        pool = self.create_pool(min_conn=1, max_conn=1, check_interval=60)
+        conn = pool.get_conn()
+        conn.broken = True
+        pool.put_conn(conn)
+        self.assertEqual(pool.get_conn(), conn)
+
+    def test_drops_closed_connection(self):
+        pool = self.create_pool(min_conn=1, max_conn=1)
+        conn = pool.get_conn()
+        conn.close()
+        pool.put_conn(conn)
+        self.assertEqual(pool.get_stats()['idle'], 0)
+        self.assertNotEqual(pool.get_conn(), conn)
+
+    def test_reports_stats(self):
+        pool = self.create_pool(min_conn=1, max_conn=2)
+        pool.get_conn()
+        stats = pool.get_stats()
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 0)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['checkouts'], 1)
+
+
+class ConnectError(Exception):
+
+    pass
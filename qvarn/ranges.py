@@ -0,0 +1,122 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Helpers for conditional and partial GET of files (RFC 7232 and RFC
+# 7233). Only single byte ranges are supported: a request for several
+# ranges gets the whole file, which the RFC allows.
+
+
+import re
+
+
+def etag_matches(header, etag, strong=False):
+    # Does an If-None-Match or If-Range header match an ETag? Weak
+    # comparison is used by default, which is what If-None-Match
+    # requires. If-Range requires strong comparison, where a weak
+    # ETag never matches.
+    if not header:
+        return False
+    if header.strip() == '*':
+        return not strong
+    if strong:
+        return any(
+            tag.strip() == etag and not etag.startswith('W/')
+            for tag in header.split(',')
+        )
+    wanted = _strip_weak(etag)
+    return any(
+        _strip_weak(tag.strip()) == wanted
+        for tag in header.split(',')
+    )
+
+
+def _strip_weak(etag):
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
+
+def parse_range(header, size):
+    # Return the first and last byte position (inclusive) of the range
+    # requested by a Range header, or None if the whole file should be
+    # returned. Raise RangeNotSatisfiable if the range is past the end
+    # of the file.
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    # int() would also accept signs, spaces, underscores, and
+    # non-ASCII digits, which aren't valid in a byte range.
+    m = _byte_range_pattern.match(spec.strip())
+    if m is None or m.group(0) == '-':
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        end = int(last) if last else size - 1
+    else:
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable(header)
+        start = max(0, size - length)
+        end = size - 1
+
+    if first and last and end < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+
+_byte_range_pattern = re.compile(r'^([0-9]*)-([0-9]*)$')
+
+
+def iter_range(blob, start, end):
+    # Return the bytes from start to end (inclusive) of a blob, given
+    # as an iterable of chunks or as an open file. A file is read from
+    # start; an iterable is skipped over until start. An iterable with
+    # an iter_from method, such as TableChunks, skips the chunks
+    # before start without reading them.
+    if hasattr(blob, 'seek'):
+        with blob:
+            blob.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = blob.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        return
+
+    pos = 0
+    if hasattr(blob, 'iter_from'):
+        pos, blob = blob.iter_from(start)
+    for chunk in blob:
+        chunk_end = pos + len(chunk)
+        if chunk_end > start:
+            yield chunk[max(0, start - pos):end + 1 - pos]
+        pos = chunk_end
+        if pos > end:
+            break
+
+
+class RangeNotSatisfiable(Exception):
+
+    def __init__(self, header):
+        super().__init__('Range not satisfiable: {}'.format(header))
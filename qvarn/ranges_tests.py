@@ -0,0 +1,155 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import unittest
+
+import qvarn
+
+
+class EtagMatchesTests(unittest.TestCase):
+
+    def test_does_not_match_without_header(self):
+        self.assertFalse(qvarn.etag_matches(None, '"abc"'))
+
+    def test_matches_star(self):
+        self.assertTrue(qvarn.etag_matches('*', '"abc"'))
+
+    def test_matches_same_etag(self):
+        self.assertTrue(qvarn.etag_matches('"abc"', '"abc"'))
+
+    def test_does_not_match_other_etag(self):
+        self.assertFalse(qvarn.etag_matches('"def"', '"abc"'))
+
+    def test_matches_any_in_list(self):
+        self.assertTrue(qvarn.etag_matches('"def", "abc"', '"abc"'))
+
+    def test_matches_weak_etag(self):
+        self.assertTrue(qvarn.etag_matches('W/"abc"', '"abc"'))
+
+    def test_strong_comparison_matches_same_etag(self):
+        self.assertTrue(qvarn.etag_matches('"abc"', '"abc"', strong=True))
+
+    def test_strong_comparison_does_not_match_weak_etag(self):
+        self.assertFalse(
+            qvarn.etag_matches('W/"abc"', '"abc"', strong=True))
+
+    def test_strong_comparison_does_not_match_star(self):
+        self.assertFalse(qvarn.etag_matches('*', '"abc"', strong=True))
+
+
+class ParseRangeTests(unittest.TestCase):
+
+    def test_returns_none_without_header(self):
+        self.assertEqual(qvarn.parse_range(None, 10), None)
+
+    def test_returns_none_for_other_unit(self):
+        self.assertEqual(qvarn.parse_range('items=0-1', 10), None)
+
+    def test_returns_none_for_several_ranges(self):
+        self.assertEqual(qvarn.parse_range('bytes=0-1,3-4', 10), None)
+
+    def test_returns_none_for_garbage(self):
+        self.assertEqual(qvarn.parse_range('bytes=x-y', 10), None)
+
+    def test_returns_none_for_signed_positions(self):
+        self.assertEqual(qvarn.parse_range('bytes=+1-+2', 10), None)
+        self.assertEqual(qvarn.parse_range('bytes=--5', 10), None)
+
+    def test_returns_none_for_spaces_in_positions(self):
+        self.assertEqual(qvarn.parse_range('bytes=1- 2', 10), None)
+
+    def test_returns_none_for_dash_only(self):
+        self.assertEqual(qvarn.parse_range('bytes=-', 10), None)
+
+    def test_returns_none_without_dash(self):
+        self.assertEqual(qvarn.parse_range('bytes=5', 10), None)
+
+    def test_returns_none_for_backwards_range(self):
+        self.assertEqual(qvarn.parse_range('bytes=5-4', 10), None)
+
+    def test_parses_closed_range(self):
+        self.assertEqual(qvarn.parse_range('bytes=2-5', 10), (2, 5))
+
+    def test_parses_open_range(self):
+        self.assertEqual(qvarn.parse_range('bytes=2-', 10), (2, 9))
+
+    def test_parses_suffix_range(self):
+        self.assertEqual(qvarn.parse_range('bytes=-3', 10), (7, 9))
+
+    def test_clamps_long_suffix_range(self):
+        self.assertEqual(qvarn.parse_range('bytes=-30', 10), (0, 9))
+
+    def test_clamps_end_to_size(self):
+        self.assertEqual(qvarn.parse_range('bytes=5-100', 10), (5, 9))
+
+    def test_raises_error_for_range_past_end(self):
+        with self.assertRaises(qvarn.RangeNotSatisfiable):
+            qvarn.parse_range('bytes=10-', 10)
+
+    def test_raises_error_for_empty_suffix_range(self):
+        with self.assertRaises(qvarn.RangeNotSatisfiable):
+            qvarn.parse_range('bytes=-0', 10)
+
+
+class IterRangeTests(unittest.TestCase):
+
+    def get(self, blob, start, end):
+        return b''.join(qvarn.iter_range(blob, start, end))
+
+    def test_returns_range_within_one_chunk(self):
+        self.assertEqual(self.get([b'abcdef'], 1, 3), b'bcd')
+
+    def test_returns_range_across_chunks(self):
+        chunks = [b'abc', b'def', b'ghi', b'jkl']
+        self.assertEqual(self.get(chunks, 2, 9), b'cdefghij')
+
+    def test_stops_reading_chunks_after_end(self):
+        chunks = iter([b'abc', b'def', b'ghi'])
+        self.assertEqual(self.get(chunks, 0, 3), b'abcd')
+        self.assertEqual(list(chunks), [b'ghi'])
+
+    def test_skips_chunks_before_start_without_reading_them(self):
+        chunks = SkippableChunks([b'abc', b'def', b'ghi'], 3)
+        self.assertEqual(self.get(chunks, 7, 8), b'hi')
+        self.assertEqual(chunks.skipped, 2)
+
+    def test_returns_range_from_file(self):
+        f = io.BytesIO(b'abcdefghij')
+        self.assertEqual(self.get(f, 2, 5), b'cdef')
+        self.assertTrue(f.closed)
+
+    def test_returns_rest_of_short_file(self):
+        f = io.BytesIO(b'abcdef')
+        self.assertEqual(self.get(f, 2, 100), b'cdef')
+
+
+class SkippableChunks:
+
+    def __init__(self, chunks, chunk_size):
+        self._chunks = chunks
+        self._chunk_size = chunk_size
+        self.skipped = None
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def iter_from(self, start):
+        self.skipped = start // self._chunk_size
+        return (
+            self.skipped * self._chunk_size,
+            iter(self._chunks[self.skipped:]),
+        )
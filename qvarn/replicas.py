@@ -0,0 +1,109 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+
+
+import qvarn
+
+
+# The replicas, their lag checks, and the read-your-writes window are
+# all state that belongs together.
+class ReplicaSet:  # pylint: disable=too-many-instance-attributes
+
+    '''Choose a read-only database replica for a transaction.
+
+    The replicas are connection pools. choose returns one of them, in
+    turn, or None if the primary database should be used instead.
+    That happens when no replica is fresh enough, or when the current
+    thread has written to the primary in the last rw_window seconds:
+    its writes might not have reached the replicas yet, and it should
+    be able to read them back (read-your-writes).
+
+    The time of the last write is kept per thread, not per client. A
+    client whose next request is handled by another thread, or another
+    process, may not see its own writes until the replicas catch up.
+
+    The replication lag of each replica is checked at most every
+    check_interval seconds, by calling get_lag with the replica's pool.
+    A replica that lags more than max_lag seconds, or whose lag can't
+    be checked, isn't used until its next check.
+
+    '''
+
+    def __init__(self, pools, get_lag, max_lag=5.0, check_interval=1.0,
+                 rw_window=5.0):
+        self._replicas = [_Replica(pool) for pool in pools]
+        self._get_lag = get_lag
+        self._max_lag = max_lag
+        self._check_interval = check_interval
+        self._rw_window = rw_window
+        self._lock = threading.Lock()
+        self._next = 0
+        self._local = threading.local()
+
+    def note_write(self):
+        self._local.last_write = time.time()
+
+    def choose(self):
+        last_write = getattr(self._local, 'last_write', None)
+        if last_write is not None:
+            if time.time() - last_write < self._rw_window:
+                return None
+
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self._replicas)
+
+        for i in range(len(self._replicas)):
+            replica = self._replicas[(start + i) % len(self._replicas)]
+            if self._is_fresh(replica):
+                return replica.pool
+        return None
+
+    def _is_fresh(self, replica):
+        now = time.time()
+        with self._lock:
+            check = now - replica.checked >= self._check_interval
+            if check:
+                # Mark as checked now, so that other threads don't
+                # check at the same time.
+                replica.checked = now
+
+        if check:
+            try:
+                lag = self._get_lag(replica.pool)
+            # A replica can fail in any number of ways, and each of
+            # them just means the replica isn't used for now.
+            except Exception as e:  # pylint: disable=broad-except
+                qvarn.log.log(
+                    'warning', msg_text='Could not check replica lag',
+                    exception=str(e))
+                lag = None
+            with self._lock:
+                replica.lag = lag
+
+        with self._lock:
+            return replica.lag is not None and replica.lag <= self._max_lag
+
+
+class _Replica:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lag = None
+        self.checked = 0
@@ -0,0 +1,88 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+import qvarn
+
+
+class ReplicaSetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lags = {
+            'replica1': 0,
+            'replica2': 0,
+        }
+
+    def get_lag(self, pool):
+        lag = self.lags[pool]
+        if lag is None:
+            raise Exception('replica is down')
+        return lag
+
+    def create_set(self, **kwargs):
+        return qvarn.ReplicaSet(
+            ['replica1', 'replica2'], self.get_lag, **kwargs)
+
+    def test_uses_replicas_in_turn(self):
+        replicas = self.create_set()
+        self.assertEqual(
+            [replicas.choose() for _ in range(4)],
+            ['replica1', 'replica2', 'replica1', 'replica2'])
+
+    def test_skips_lagging_replica(self):
+        self.lags['replica1'] = 10
+        replicas = self.create_set(max_lag=5)
+        self.assertEqual(
+            [replicas.choose() for _ in range(2)], ['replica2', 'replica2'])
+
+    def test_skips_replica_that_is_down(self):
+        self.lags['replica2'] = None
+        replicas = self.create_set()
+        self.assertEqual(
+            [replicas.choose() for _ in range(2)], ['replica1', 'replica1'])
+
+    def test_uses_primary_if_all_replicas_lag(self):
+        self.lags['replica1'] = 10
+        self.lags['replica2'] = 10
+        replicas = self.create_set(max_lag=5)
+        self.assertEqual(replicas.choose(), None)
+
+    def test_checks_lag_again_after_interval(self):
+        self.lags['replica1'] = 10
+        self.lags['replica2'] = 10
+        replicas = self.create_set(max_lag=5, check_interval=0)
+        self.assertEqual(replicas.choose(), None)
+        self.lags['replica1'] = 0
+        self.assertEqual(replicas.choose(), 'replica1')
+
+    def test_uses_primary_after_write(self):
+        replicas = self.create_set(rw_window=60)
+        replicas.note_write()
+        self.assertEqual(replicas.choose(), None)
+
+    def test_uses_replica_after_write_in_other_thread(self):
+        replicas = self.create_set(rw_window=60)
+        t = threading.Thread(target=replicas.note_write)
+        t.start()
+        t.join()
+        self.assertEqual(replicas.choose(), 'replica1')
+
+    def test_uses_replica_after_read_your_writes_window(self):
+        replicas = self.create_set(rw_window=0)
+        replicas.note_write()
+        self.assertEqual(replicas.choose(), 'replica1')
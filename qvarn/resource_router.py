@@ -30,6 +30,7 @@ class ResourceRouter(qvarn.Router):
         self._baseurl = None
         self._notify = None
         self._log_access = None
+        self._log_access_many = None
 
     def set_api(self, api):
         self._api = api
@@ -46,6 +47,15 @@ class ResourceRouter(qvarn.Router):
     def set_access_logger(self, log_access):
         self._log_access = log_access
 
+    def set_bulk_access_logger(self, log_access_many):
+        self._log_access_many = log_access_many
+
+    def around_unit_of_work(self):
+        # Access entries are queued only after the unit of work ends:
+        # queueing may wait for the access log writer, which can't
+        # write while this thread holds the database.
+        return self._api.deferred_access_log()
+
     def get_routes(self):
         assert self._baseurl is not None
 
@@ -54,7 +64,8 @@ class ResourceRouter(qvarn.Router):
         id_path = '{}/<id>'.format(path)
 
         def S(callback, msg, **kwargs):
-            return qvarn.stopwatch(callback, msg, **kwargs)
+            return qvarn.stopwatch(
+                callback, msg, resource_type=rt.get_type(), **kwargs)
 
         routes = [
             {
@@ -93,7 +104,7 @@ class ResourceRouter(qvarn.Router):
                 },
             ]
 
-        return routes
+        return self.in_units_of_work(routes, self._coll)
 
     def _create(self, content_type, body, *args, **kwargs):
         if content_type != 'application/json':
@@ -106,12 +117,13 @@ class ResourceRouter(qvarn.Router):
 
         validator = qvarn.Validator()
         try:
-            if id_allowed:
-                validator.validate_new_resource_with_id(
-                    body, self._coll.get_type())
-            else:
-                validator.validate_new_resource(
-                    body, self._coll.get_type())
+            with qvarn.tracer.span('validate'):
+                if id_allowed:
+                    validator.validate_new_resource_with_id(
+                        body, self._coll.get_type())
+                else:
+                    validator.validate_new_resource(
+                        body, self._coll.get_type())
         except (qvarn.HasId, qvarn.HasRevision) as e:
             qvarn.log.log('error', msg_text=str(e), body=body)
             return qvarn.bad_request_response(str(e))
@@ -153,7 +165,9 @@ class ResourceRouter(qvarn.Router):
 
         validator = qvarn.Validator()
         try:
-            validator.validate_resource_update(body, self._coll.get_type())
+            with qvarn.tracer.span('validate'):
+                validator.validate_resource_update(
+                    body, self._coll.get_type())
         except qvarn.ValidationError as e:
             qvarn.log.log('error', msg_text=str(e), body=body)
             return qvarn.bad_request_response(str(e))
@@ -193,16 +207,15 @@ class ResourceRouter(qvarn.Router):
         params = self.get_access_params(self._coll.get_type_name(), claims)
         body = self._coll.list(claims=claims, access_params=params)
 
-        for obj in body.get('resources', []):
-            self._log_access(
-                obj,
-                self._coll.get_type_name(),
-                'GET',
-                # FIXME: add header getting to apifw
-                bottle.request.get_header('Authorization', ''),
-                bottle.request.get_header('Qvarn-Token', ''),
-                bottle.request.get_header('Qvarn-Access-By', ''),
-                bottle.request.get_header('Qvarn-Why', None))
+        self._log_access_many(
+            body.get('resources', []),
+            self._coll.get_type_name(),
+            'GET',
+            # FIXME: add header getting to apifw
+            bottle.request.get_header('Authorization', ''),
+            bottle.request.get_header('Qvarn-Token', ''),
+            bottle.request.get_header('Qvarn-Access-By', ''),
+            bottle.request.get_header('Qvarn-Why', None))
 
         return qvarn.ok_response(body)
 
@@ -244,16 +257,15 @@ class ResourceRouter(qvarn.Router):
         except qvarn.SearchParserError as e:
             return qvarn.search_parser_error_response(e)
 
-        for obj in result:
-            self._log_access(
-                obj,
-                self._coll.get_type_name(),
-                'SEARCH',
-                # FIXME: add header getting to apifw
-                bottle.request.get_header('Authorization', ''),
-                bottle.request.get_header('Qvarn-Token', ''),
-                bottle.request.get_header('Qvarn-Access-By', ''),
-                bottle.request.get_header('Qvarn-Why', None))
+        self._log_access_many(
+            result,
+            self._coll.get_type_name(),
+            'SEARCH',
+            # FIXME: add header getting to apifw
+            bottle.request.get_header('Authorization', ''),
+            bottle.request.get_header('Qvarn-Token', ''),
+            bottle.request.get_header('Qvarn-Access-By', ''),
+            bottle.request.get_header('Qvarn-Why', None))
 
         return qvarn.ok_response({'resources': result})
 
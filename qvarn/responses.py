@@ -17,6 +17,12 @@
 import apifw
 
 
+# apifw doesn't define these.
+HTTP_PARTIAL_CONTENT = 206
+HTTP_NOT_MODIFIED = 304
+HTTP_RANGE_NOT_SATISFIABLE = 416
+
+
 def response(status, body, headers):
     return apifw.Response(
         {
@@ -37,6 +43,22 @@ def ok_response(body, headers=None):
     return response(apifw.HTTP_OK, body, headers)
 
 
+def partial_content_response(body, headers):
+    return response(HTTP_PARTIAL_CONTENT, body, headers)
+
+
+def not_modified_response(headers):
+    return response(HTTP_NOT_MODIFIED, '', headers)
+
+
+def range_not_satisfiable_response(size):
+    headers = {
+        'Content-Type': 'text/plain',
+        'Content-Range': 'bytes */{}'.format(size),
+    }
+    return response(HTTP_RANGE_NOT_SATISFIABLE, '', headers)
+
+
 def no_such_resource_response(msg):
     return response(apifw.HTTP_NOT_FOUND, msg, {})
 
@@ -14,8 +14,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import contextlib
+
 import bottle
-import jwt
 
 import qvarn
 
@@ -28,6 +29,32 @@ class Router:
     def get_routes(self):
         raise NotImplementedError()
 
+    def in_units_of_work(self, routes, coll):
+        # Handle each request in one unit of work, so that it uses
+        # one database transaction. GET requests are read-only. A
+        # unit of work that isn't read-only always uses the primary
+        # database, so reads that decide what to write aren't stale.
+        for route in routes:
+            route['callback'] = self._in_unit_of_work(
+                route['callback'], coll, route['method'] == 'GET')
+        return routes
+
+    def _in_unit_of_work(self, callback, coll, read_only):
+        # The request span is the outermost one, so that the trace
+        # is written only after the unit of work has been committed.
+        def unit_of_work_wrapper(*args, **kwargs):
+            with qvarn.tracer.span('request'):
+                with self.around_unit_of_work():
+                    with coll.unit_of_work(read_only=read_only):
+                        return callback(*args, **kwargs)
+        return unit_of_work_wrapper
+
+    @contextlib.contextmanager
+    def around_unit_of_work(self):
+        # Subclasses may override this for work that must be done
+        # outside the unit of work of a request.
+        yield
+
     def get_access_params(self, type_name, claims):
         user_id = claims.get('sub')
         if not user_id and self.is_trusted_client(claims):
@@ -56,9 +83,10 @@ class Router:
 
     def get_user_id_from_headers(self):
         headers = bottle.request.headers
-        qvarn.log.log(
-            'trace', msg_text='access params headers',
-            headers=dict(headers))
+        if qvarn.log.enabled('trace'):
+            qvarn.log.log(
+                'trace', msg_text='access params headers',
+                headers=dict(headers))
         token = headers.get('Qvarn-Access-By')
         qvarn.log.log(
             'trace', msg_text='Qvarn-Access-By token',
@@ -69,8 +97,4 @@ class Router:
         return ''
 
     def parse_token(self, token):
-        return jwt.decode(
-            token,
-            verify=False,
-            audience=None, options={'verify_aud': False}
-        )
+        return qvarn.decode_token(token)
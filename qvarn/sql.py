@@ -6,10 +6,15 @@
 '''Communicate with a PostgreSQL server.'''
 
 
+import collections
+import contextlib
+import hashlib
+import random
+import re
+import threading
 import time
 
 import psycopg2
-import psycopg2.pool
 import psycopg2.extras
 import psycopg2.extensions
 import slog
@@ -19,42 +24,245 @@ import qvarn
 
 class PostgresAdapter:  # pragma: no cover
 
+    # The attributes are the connections, and the settings and
+    # statistics that apply to all of their transactions.
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self):
         self._pool = None
+        self._replicas = None
+        self._local = threading.local()
+        self._max_prepared = 0
+        self._lock = threading.Lock()
+        self._prepared_hits = 0
+        self._prepared_misses = 0
+        self._slow_query_ms = 0
+        self._explain_sample_rate = 0
 
     def connect(self, **kwargs):
-        self._pool = psycopg2.pool.ThreadedConnectionPool(
-            minconn=kwargs['min_conn'],
-            maxconn=kwargs['max_conn'],
-            database=kwargs['database'],
-            user=kwargs['user'],
-            password=kwargs['password'],
-            host=kwargs['host'],
-            port=kwargs['port'],
-        )
+        # The prepared_statements setting is the max number of
+        # prepared statements kept per connection. Zero disables them.
+        self._max_prepared = kwargs.get('prepared_statements', 0)
+
+        # Queries taking at least slow_query_ms milliseconds are logged
+        # as slow-query messages. Zero disables this. A sample of them,
+        # explain_sample_rate (0 to 1), is also run with EXPLAIN, which
+        # runs the query again.
+        self._slow_query_ms = kwargs.get('slow_query_ms', 0)
+        self._explain_sample_rate = kwargs.get('explain_sample_rate', 0.1)
+
+        extra = {}
+        if self._max_prepared:
+            extra['connection_factory'] = PreparingConnection
+
+        def connect():
+            return psycopg2.connect(
+                database=kwargs['database'],
+                user=kwargs['user'],
+                password=kwargs['password'],
+                host=kwargs['host'],
+                port=kwargs['port'],
+                **extra
+            )
+
+        def connect_replica(dsn):
+            return lambda: psycopg2.connect(dsn=dsn, **extra)
+
+        def new_pool(connect):
+            return qvarn.ConnectionPool(
+                connect,
+                min_conn=kwargs['min_conn'],
+                max_conn=kwargs['max_conn'],
+                timeout=kwargs.get('pool_timeout', 30.0),
+                check_interval=kwargs.get('pool_check_interval', 5.0),
+            )
+
+        self._pool = new_pool(connect)
+
+        # The replicas setting is a list of connection strings (DSNs)
+        # for read-only replicas of the database.
+        replicas = kwargs.get('replicas', [])
+        if replicas:
+            self._replicas = qvarn.ReplicaSet(
+                [new_pool(connect_replica(dsn)) for dsn in replicas],
+                self._get_replica_lag,
+                max_lag=kwargs.get('replica_max_lag', 5.0),
+                check_interval=kwargs.get('replica_check_interval', 1.0),
+                rw_window=kwargs.get('read_your_writes_window', 5.0),
+            )
 
-    def transaction(self):
-        return Transaction(self)
+    def _get_replica_lag(self, pool):
+        # A replica that has replayed everything it has received is
+        # not lagging, even if nothing has been written for a while.
+        query = ' '.join('''
+            SELECT CASE
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                THEN 0
+                ELSE EXTRACT(
+                    EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END
+        '''.split())
+        conn = pool.get_conn()
+        try:
+            c = conn.cursor()
+            c.execute(query)
+            lag = c.fetchone()[0]
+            conn.rollback()
+        finally:
+            pool.put_conn(conn)
+        return float(lag or 0)
+
+    def is_slow_query(self, ms):
+        return bool(self._slow_query_ms) and ms >= self._slow_query_ms
+
+    def should_explain(self, query):
+        return (
+            is_explainable(query) and
+            random.random() < self._explain_sample_rate)
+
+    def get_max_prepared(self):
+        return self._max_prepared
+
+    def count_prepared(self, hit):
+        with self._lock:
+            if hit:
+                self._prepared_hits += 1
+            else:
+                self._prepared_misses += 1
+
+    def get_prepared_stats(self):
+        with self._lock:
+            total = self._prepared_hits + self._prepared_misses
+            return {
+                'hits': self._prepared_hits,
+                'misses': self._prepared_misses,
+                'hit_rate': self._prepared_hits / total if total else None,
+            }
+
+    def transaction(self, read_only=False, independent=False):
+        # Inside a unit of work, use its transaction, unless it's on
+        # a replica and this one needs to write. An independent
+        # transaction never joins a unit of work: it may outlive it.
+        unit = getattr(self._local, 'unit', None)
+        if unit is not None and not independent:
+            if read_only or unit.get_pool() is self._pool:
+                if not read_only:
+                    unit.mark_write()
+                return JoinedTransaction(unit)
+
+        # Read-only transactions may go to a replica. Everything else
+        # goes to the primary database.
+        pool = None
+        if read_only and self._replicas is not None:
+            pool = self._replicas.choose()
+        if pool is None:
+            pool = self._pool
+        return Transaction(self, pool, read_only=read_only)
+
+    @contextlib.contextmanager
+    def unit_of_work(self, read_only=False):
+        # All transactions of the current thread within this context
+        # are one database transaction, committed at the end, or
+        # rolled back if there's an exception. Nested units of work
+        # are part of the outermost one.
+        if getattr(self._local, 'unit', None) is not None:
+            yield
+            return
+
+        with self.transaction(read_only=read_only) as t:
+            self._local.unit = t
+            try:
+                yield
+            finally:
+                self._local.unit = None
+
+    def note_write(self):
+        if self._replicas is not None:
+            self._replicas.note_write()
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+
+    '''A database connection that knows its prepared statements.
+
+    The prepared attribute maps statement names to the names of the
+    statement's parameters, least recently used first.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = collections.OrderedDict()
+
+
+class JoinedTransaction:  # pragma: no cover
+
+    '''Use a transaction that is already in progress.
+
+    The transaction is not committed or rolled back at the end of the
+    context: the code that started it does that.
+
+    '''
+
+    def __init__(self, transaction):
+        self._transaction = transaction
 
-    def get_conn(self):
-        return self._pool.getconn()
+    def __enter__(self):
+        return self._transaction
 
-    def put_conn(self, conn):
-        self._pool.putconn(conn)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
 
 
 class Transaction:  # pragma: no cover
 
-    def __init__(self, sql):
+    # The attributes are the state of one transaction, and what's
+    # needed to log it.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, sql, pool, read_only=False):
         self._sql = sql
+        self._pool = pool
+        self._read_only = read_only
+        self._wrote = not read_only
+        self._after_commit = []
         self._conn = None
         self._started = None
+        self._checkout_ms = None
         self._queries = None
+        self._num_queries = 0
+        self._log_queries = False
+
+    def get_pool(self):
+        return self._pool
+
+    def use_snapshot(self):
+        # Make all queries of this transaction see the database as it
+        # was at its first query, instead of each query seeing what
+        # was committed before it started. Must be called before any
+        # query.
+        assert self._num_queries == 0
+        c = self._conn.cursor()
+        c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+    def after_commit(self, func):
+        # Call func() once this transaction has been committed. It's
+        # not called if the transaction is rolled back.
+        self._after_commit.append(func)
+
+    def mark_write(self):
+        # A write joined this transaction, which may have been started
+        # as read-only.
+        self._wrote = True
 
     def __enter__(self):
         self._started = time.time()
         self._queries = []
-        self._conn = self._sql.get_conn()
+        self._num_queries = 0
+        # Queries and their values are only kept if they'll be logged.
+        self._log_queries = qvarn.log.enabled('sql')
+        self._conn = self._pool.get_conn()
+        self._checkout_ms = 1000.0 * (time.time() - self._started)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -63,36 +271,127 @@ class Transaction:  # pragma: no cover
             if exc_type is None:
                 t = time.time()
                 self._conn.commit()
-                commit_ms = time.time() - t
+                commit_ms = 1000.0 * (time.time() - t)
             else:  # pragma: no cover
                 self._conn.rollback()
         except BaseException:  # pragma: no cover
-            self._sql.put_conn(self._conn)
+            self._pool.put_conn(self._conn)
             self._conn = None
             raise
-        self._sql.put_conn(self._conn)
+        self._pool.put_conn(self._conn)
         self._conn = None
+        if exc_type is None and self._wrote:
+            self._sql.note_write()
+        after_commit = self._after_commit
+        self._after_commit = []
+        if exc_type is None:
+            for func in after_commit:
+                func()
 
         ended = time.time()
         duration = 1000.0 * (ended - self._started)
-        qvarn.log.log(
-            'sql', msg_text='SQL transaction', ms=duration,
-            commit_ms=commit_ms, queries=self._queries)
+        qvarn.tracer.record(
+            'sql transaction', self._started, ended,
+            read_only=self._read_only, queries=self._num_queries,
+            checkout_ms=self._checkout_ms)
+        prepared_stats = None
+        if self._sql.get_max_prepared():
+            prepared_stats = self._sql.get_prepared_stats()
+        pool_stats = self._pool.get_stats()
+        if self._log_queries:
+            qvarn.log.log(
+                'sql', msg_text='SQL transaction', ms=duration,
+                commit_ms=commit_ms, checkout_ms=self._checkout_ms,
+                read_only=self._read_only, queries=self._queries,
+                prepared_stats=prepared_stats,
+                pool_stats=pool_stats)
+        record_transaction_metrics(
+            duration, self._checkout_ms, self._read_only,
+            exc_type is None, self._num_queries, pool_stats)
         self._started = None
         self._queries = []
 
     def execute(self, query, values):
         started = time.time()
         c = self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        c.execute(query, values)
-        duration = 1000.0 * (time.time() - started)
-        self._queries.append({
-            'query': query,
-            'values': values,
-            'ms': duration,
-        })
+        prepared = self._execute_prepared(c, query, values)
+        if not prepared:
+            c.execute(query, values)
+        self._num_queries += 1
+        ended = time.time()
+        duration = 1000.0 * (ended - started)
+        qvarn.tracer.record(
+            'sql query', started, ended, query=query, prepared=prepared)
+        if self._log_queries:
+            self._queries.append({
+                'query': query,
+                'values': loggable_values(values),
+                'ms': duration,
+                'prepared': prepared,
+            })
+        if self._sql.is_slow_query(duration):
+            self._log_slow_query(query, values, duration, prepared)
         return c
 
+    def _log_slow_query(self, query, values, duration, prepared):
+        qvarn.metrics.counter(
+            'qvarn_db_slow_queries_total',
+            'Number of database queries slower than the threshold').inc()
+        if not qvarn.log.enabled('slow-query'):
+            return
+        plan = None
+        if self._sql.should_explain(query):
+            plan = self._explain(query, values)
+        qvarn.log.log(
+            'slow-query', msg_text='Slow SQL query', query=query,
+            values=loggable_values(values), ms=duration, prepared=prepared,
+            read_only=self._read_only, plan=plan)
+
+    def _explain(self, query, values):
+        # EXPLAIN ANALYZE runs the query. Only SELECTs are explained,
+        # and in a savepoint, so that a failure doesn't abort the
+        # transaction.
+        c = self._conn.cursor()
+        c.execute('SAVEPOINT qvarn_explain')
+        try:
+            c.execute(get_explain_query(query), values)
+            plan = c.fetchone()[0]
+        except psycopg2.Error as e:
+            c.execute('ROLLBACK TO SAVEPOINT qvarn_explain')
+            qvarn.log.log(
+                'warning', msg_text='Could not EXPLAIN slow query',
+                exception=str(e))
+            return None
+        c.execute('RELEASE SAVEPOINT qvarn_explain')
+        return plan
+
+    def _execute_prepared(self, c, query, values):
+        max_prepared = self._sql.get_max_prepared()
+        if not max_prepared or not is_preparable(query):
+            return False
+
+        statements = self._conn.prepared
+        name = get_statement_name(query)
+        hit = name in statements
+        if hit:
+            statements.move_to_end(name)
+        else:
+            if len(statements) >= max_prepared:
+                old_name, _ = statements.popitem(last=False)
+                c.execute('DEALLOCATE {}'.format(old_name))
+            text, param_names = prepare_query(query)
+            c.execute('PREPARE {} AS {}'.format(name, text))
+            statements[name] = param_names
+        self._sql.count_prepared(hit)
+
+        args = ', '.join(
+            '%({})s'.format(param_name) for param_name in statements[name])
+        if args:
+            c.execute('EXECUTE {} ({})'.format(name, args), values)
+        else:
+            c.execute('EXECUTE {}'.format(name))
+        return True
+
     def get_rows(self, cursor):
         for row in cursor:
             yield dict(row)
@@ -106,10 +405,73 @@ class Transaction:  # pragma: no cover
             self._q(table_name),
             columns)
 
+    def add_column(self, table_name, column_name, col_type, default=None):
+        query = 'ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}'.format(
+            self._q(table_name), self._q(column_name),
+            self._sqltype(col_type))
+        if default is not None:
+            assert isinstance(default, int)
+            query += ' DEFAULT {:d}'.format(default)
+        return query
+
     def create_index(self, table_name, index_name, column_name):
         return 'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
             self._q(index_name), self._q(table_name), self._q(column_name))
 
+    def create_multicolumn_index(self, table_name, index_name, *column_names):
+        return 'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            self._q(index_name), self._q(table_name),
+            ', '.join(self._q(name) for name in column_names))
+
+    def create_unique_index(
+            self, table_name, index_name, *column_names, nulls_equal=True):
+        # NULLs are never equal to each other in SQL, so a plain
+        # unique index would allow duplicate rows if any column is
+        # NULL. Index whether each column is NULL, and its value with
+        # NULL as an empty string, instead: NULLs are then equal to
+        # each other, but not to empty strings. Only an index on plain
+        # columns can be used with ON CONFLICT (column).
+        columns = self._unique_columns(column_names, nulls_equal)
+        return 'CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            self._q(index_name), self._q(table_name), ', '.join(columns))
+
+    def _unique_columns(self, column_names, nulls_equal):
+        if nulls_equal:
+            columns = []
+            for name in column_names:
+                columns.append('({} IS NULL)'.format(self._q(name)))
+                columns.append("COALESCE({}, '')".format(self._q(name)))
+            return columns
+        return [self._q(name) for name in column_names]
+
+    def drop_index(self, index_name):
+        return 'DROP INDEX IF EXISTS {}'.format(self._q(index_name))
+
+    def has_index(self, index_name):
+        query = 'SELECT 1 FROM pg_indexes WHERE indexname = {}'.format(
+            self._placeholder('index_name'))
+        values = {
+            'index_name': self._q(index_name),
+        }
+        return query, values
+
+    def remove_duplicate_rows(
+            self, table_name, *column_names, nulls_equal=True):
+        # Rows are duplicates if create_unique_index, with the same
+        # nulls_equal, would consider them equal.
+        template = ' '.join('''
+            DELETE FROM {table} WHERE ctid IN (
+                SELECT ctid FROM (
+                    SELECT ctid, row_number() OVER (PARTITION BY {columns})
+                        AS _n FROM {table}
+                ) AS _dups WHERE _n > 1
+            )
+        '''.split())
+        return template.format(
+            table=self._q(table_name),
+            columns=', '.join(
+                self._unique_columns(column_names, nulls_equal)))
+
     def create_jsonb_index(
             self, table_name, index_name, column_name, field_name):
         sql = "CREATE INDEX IF NOT EXISTS {} ON {} (lower({} ->> '{}'))"
@@ -130,14 +492,91 @@ class Transaction:  # pragma: no cover
                 return n
         assert False
 
-    def insert_object(self, table_name, *keys):
+    def insert_object(self, table_name, *keys, skip_duplicates=False):
         columns = [self._q(k) for k in keys]
         placeholders = [self._placeholder(k) for k in keys]
-        return 'INSERT INTO {} ({}) VALUES ({})'.format(
+        query = 'INSERT INTO {} ({}) VALUES ({})'.format(
             self._q(table_name),
             ', '.join(columns),
             ', '.join(placeholders),
         )
+        if skip_duplicates:
+            query += ' ON CONFLICT DO NOTHING'
+        return query
+
+    def insert_objects(
+            self, table_name, column_names, rows, skip_duplicates=False):
+        columns = [self._q(k) for k in column_names]
+        tuples = []
+        values = {}
+        for i, row in enumerate(rows):
+            placeholders = []
+            for k in column_names:
+                name = '{}_{}'.format(k, i)
+                placeholders.append(self._placeholder(name))
+                values[self._q(name)] = row[k]
+            tuples.append('({})'.format(', '.join(placeholders)))
+        query = 'INSERT INTO {} ({}) VALUES {}'.format(
+            self._q(table_name),
+            ', '.join(columns),
+            ', '.join(tuples),
+        )
+        if skip_duplicates:
+            query += ' ON CONFLICT DO NOTHING'
+        return query, values
+
+    def increment_count(self, table_name, key_name, count_name, *columns):
+        # Add a row with a count of one, or add one to the count of an
+        # existing row, atomically. The new count is returned. The key
+        # column needs a unique index without nulls_equal.
+        names = [key_name] + list(columns)
+        template = ' '.join('''
+            INSERT INTO {table} ({count}, {columns}) VALUES (1, {values})
+            ON CONFLICT ({key}) DO UPDATE SET {count} = {table}.{count} + 1
+            RETURNING {count}
+        '''.split())
+        return template.format(
+            table=self._q(table_name),
+            key=self._q(key_name),
+            count=self._q(count_name),
+            columns=', '.join(self._q(name) for name in names),
+            values=', '.join(self._placeholder(name) for name in names))
+
+    def decrement_count(self, table_name, key_name, count_name):
+        template = ' '.join('''
+            UPDATE {table} SET {count} = {count} - 1 WHERE {key} = {value}
+            RETURNING {count}
+        '''.split())
+        return template.format(
+            table=self._q(table_name),
+            key=self._q(key_name),
+            count=self._q(count_name),
+            value=self._placeholder(key_name))
+
+    def claim_uncounted(self, table_name, key_name, count_name):
+        # Add a row with a count of zero, unless there's a row for the
+        # key already. The count is returned only if the row was
+        # added. If another transaction has added a row for the key,
+        # but not yet committed, this waits for it to end. The key
+        # column needs a unique index without nulls_equal.
+        template = ' '.join('''
+            INSERT INTO {table} ({key}, {count}) VALUES ({value}, 0)
+            ON CONFLICT ({key}) DO NOTHING
+            RETURNING {count}
+        '''.split())
+        return template.format(
+            table=self._q(table_name),
+            key=self._q(key_name),
+            count=self._q(count_name),
+            value=self._placeholder(key_name))
+
+    def remove_uncounted(self, table_name, key_name, count_name):
+        return 'DELETE FROM {} WHERE {} = {} AND {} <= 0'.format(
+            self._q(table_name), self._q(key_name),
+            self._placeholder(key_name), self._q(count_name))
+
+    def remove_all_rows(self, table_name):
+        return 'DELETE FROM {}'.format(self._q(table_name))
 
     def remove_objects(self, table_name, *keys):
         conditions = [
@@ -152,11 +591,38 @@ class Transaction:  # pragma: no cover
     def select_objects_with_keys_and_cond(
             self, table_name, cond, allow_cond, **keys):
         keys_check = self.keys_checks(keys)
+        # Use a new counter for each query so that the same kind of
+        # query always gets the same SQL text and placeholder names.
+        # This allows it to be prepared once and re-used.
         query, values = qvarn.sql_select(
-            _counter, cond, allow_cond, keys_check)
+            slog.Counter(), cond, allow_cond, keys_check)
         values.update(self.keys_values(keys))
         return query, values
 
+    def remove_objects_with_cond(
+            self, table_name, aux_name, key_names, cond, **keys):
+        # Rows are matched and removed by all keys, so that removing a
+        # sub-resource leaves the other sub-resources of the same
+        # resource alone. The row count of the result is the number of
+        # objects removed.
+        select, values = qvarn.select_matching_keys(
+            slog.Counter(), cond, aux_name, key_names, keys)
+        template = ' '.join('''
+            WITH _matches AS ({select}),
+            _aux_removed AS (
+                DELETE FROM {aux} WHERE ({columns}) IN
+                    (SELECT {columns} FROM _matches)
+            )
+            DELETE FROM {table} WHERE ({columns}) IN
+                (SELECT {columns} FROM _matches)
+        '''.split())
+        query = template.format(
+            select=select,
+            aux=self._q(aux_name),
+            table=self._q(table_name),
+            columns=', '.join(self._q(key) for key in key_names))
+        return query, values
+
     def keys_checks(self, keys):
         if not keys:
             checks = ['TRUE']
@@ -174,7 +640,7 @@ class Transaction:  # pragma: no cover
             for key in keys
         }
 
-    def select_objects(self, table_name, col_name, *keys):
+    def select_objects(self, table_name, col_name, *keys, for_update=False):
         conditions = [
             '{} = {}'.format(self._q(key), self._placeholder(key))
             for key in keys
@@ -185,8 +651,17 @@ class Transaction:  # pragma: no cover
         )
         if conditions:
             query += ' WHERE {}'.format(' AND '.join(conditions))
+        if for_update:
+            query += ' FOR UPDATE'
         return query
 
+    def select_keys_with_null(self, table_name, null_name, *keys):
+        # Select the distinct keys of rows where a column is NULL.
+        return 'SELECT DISTINCT {} FROM {} WHERE {} IS NULL'.format(
+            ', '.join(self._q(key) for key in keys),
+            self._q(table_name),
+            self._q(null_name))
+
     def has_allow_rule(self, table_name, rule):
         conditions = [
             '{} = {}'.format(self._q(key), self._placeholder(key))
@@ -238,246 +713,97 @@ def placeholder(name):  # pragma: no cover
     return '%({})s'.format(quote(name))
 
 
-_counter = slog.Counter()
-
-
-def get_unique_name(base, counter=None):  # pragma: no cover
-    if counter is None:
-        counter = _counter
-    return '{}{}'.format(base, counter.increment())
-
+def record_transaction_metrics(
+        ms, checkout_ms, read_only, committed, num_queries,
+        pool_stats):  # pragma: no cover
+    labels = {
+        'read_only': str(read_only).lower(),
+        'outcome': 'commit' if committed else 'rollback',
+    }
+    qvarn.metrics.histogram(
+        'qvarn_db_transaction_duration_seconds',
+        'Duration of database transactions').observe(ms / 1000.0, **labels)
+    qvarn.metrics.counter(
+        'qvarn_db_queries_total',
+        'Number of database queries').inc(num_queries, **labels)
+    qvarn.metrics.histogram(
+        'qvarn_db_pool_checkout_seconds',
+        'Time waited for a database connection').observe(
+            checkout_ms / 1000.0)
 
-class Condition:  # pragma: no cover
+    connections = qvarn.metrics.gauge(
+        'qvarn_db_pool_connections',
+        'Database connections in the pool of the last transaction')
+    for state in ['in_use', 'idle', 'waiting']:
+        connections.set(pool_stats[state], state=state)
 
-    def get_subconditions(self):
-        return []
 
-    def matches(self, obj, keys):  # pragma: no cover
-        raise NotImplementedError()
+def loggable_values(values):
+    # Binary values, such as blob chunks, are not kept for logging:
+    # they may be big, and are of no use in a log.
+    if not values:
+        return values
+    return {
+        key: (
+            '<{} bytes>'.format(len(value))
+            if isinstance(value, (bytes, memoryview)) else value)
+        for key, value in values.items()
+    }
 
-    def as_sql(self):  # pragma: no cover
-        raise NotImplementedError()
 
+def is_preparable(query):
+    words = query.split(None, 1)
+    return bool(words) and words[0].upper() in _preparable
 
-class All(Condition):
 
-    def __init__(self, *conds):
-        self.conds = list(conds)
+_preparable = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
 
-    def append_subcondition(self, cond):
-        self.conds.append(cond)
 
-    def get_subconditions(self):
-        return self.conds
-
-    def matches(self, obj, keys):
-        for cond in self.conds:
-            if not cond.matches(obj, keys):
-                return False
-        return True
-
-    def as_sql(self):  # pragma: no cover
-        pairs = [cond.as_sql() for cond in self.conds]
-        conds = ' AND '.join(query for query, _ in pairs)
-        values = {}
-        for _, value in pairs:
-            values.update(value)
-        return '( {} )'.format(conds), values
+def is_explainable(query):
+    # Only queries that don't change anything may be run again by
+    # EXPLAIN ANALYZE. A WITH query may contain an INSERT or DELETE.
+    words = query.split(None, 1)
+    return bool(words) and words[0].upper() == 'SELECT'
 
 
-class Cmp(Condition):  # pragma: no cover
+def get_explain_query(query):
+    return 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query
 
-    def __init__(self, name, pattern):
-        self.name = name
-        self.pattern = pattern
 
-    def compare(self, a, b):
-        raise NotImplementedError()
+def get_statement_name(query):
+    normalised = ' '.join(query.split())
+    digest = hashlib.sha1(normalised.encode('utf-8')).hexdigest()
+    return 'qvarn_{}'.format(digest[:24])
 
-    def cmp_py(self, actual):
-        if isinstance(actual, str):
-            return self.compare(actual.lower(), self.pattern.lower())
-        return self.compare(actual, self.pattern)
 
-    def cmp_sql(self, pattern_name):
-        return "lower(_field->>'value') {} lower(%({})s)".format(
-            self.get_operator(), pattern_name)
-
-    def get_operator(self):
-        raise NotImplementedError()
-
-    def matches(self, obj, keys):
-        for key, actual in qvarn.flatten_object(obj):
-            if key == self.name and self.cmp_py(actual):
-                return True
-        return False
-
-    def as_sql(self):  # pragma: no cover
-        name_name = get_unique_name('name')
-        pattern_name = get_unique_name('pattern')
-        values = {
-            name_name: self.name,
-            pattern_name: self.pattern,
-        }
-        query = ("_field ->> 'name' = %%(%s)s AND "
-                 "_field ->> 'value' %s") % (
-                     name_name, self.cmp_sql(pattern_name))
-        return query, values
+def prepare_query(query):
+    # Convert a query with psycopg2 placeholders, %(name)s, into one
+    # with PostgreSQL positional parameters, $1, for PREPARE. Return
+    # the new query and the parameter names in order.
+    param_names = []
 
+    def replace(m):
+        name = m.group(1)
+        if name is None:
+            return '%'
+        if name not in param_names:
+            param_names.append(name)
+        return '${}'.format(param_names.index(name) + 1)
 
-class Equal(Cmp):
+    return _placeholder_pattern.sub(replace, query), param_names
 
-    def compare(self, a, b):
-        return a == b
 
-    def get_operator(self):  # pragma: no cover
-        return '='
+_placeholder_pattern = re.compile(r'%\((\w+)\)s|%%')
 
 
-class ResourceTypeIs(Equal):
-
-    def __init__(self, type_name):
-        super().__init__('type', type_name)
-
-    def matches(self, obj, keys):
-        return obj.get('type') == self.pattern
-
-
-class NotEqual(Cmp):
-
-    def compare(self, a, b):
-        return a != b
-
-    def get_operator(self):  # pragma: no cover
-        return '!='
-
-
-class GreaterThan(Cmp):
-
-    def compare(self, a, b):
-        return a > b
-
-    def get_operator(self):  # pragma: no cover
-        return '>'
-
-
-class GreaterOrEqual(Cmp):
-
-    def compare(self, a, b):
-        return a >= b
-
-    def get_operator(self):  # pragma: no cover
-        return '>='
-
-
-class LessThan(Cmp):
-
-    def compare(self, a, b):
-        return a < b
-
-    def get_operator(self):  # pragma: no cover
-        return '<'
-
-
-class LessOrEqual(Cmp):
-
-    def compare(self, a, b):
-        return a <= b
-
-    def get_operator(self):  # pragma: no cover
-        return '<='
-
-
-class Contains(Cmp):
-
-    def compare(self, a, b):
-        return b in a
-
-    def cmp_sql(self, pattern_name):  # pragma: no cover
-        t = "lower(_field->>'value') LIKE '%%' || lower(%({})s) || '%%'"
-        return t.format(pattern_name)
-
-    def get_operator(self):  # pragma: no cover
-        pass
-
-
-class Startswith(Cmp):
-
-    def compare(self, a, b):
-        return a.startswith(b)
-
-    def cmp_sql(self, pattern_name):  # pragma: no cover
-        t = "lower(_field->>'value') LIKE lower(%({})s) || '%%'"
-        return t.format(pattern_name)
-
-    def get_operator(self):  # pragma: no cover
-        pass
-
-
-class Yes(Condition):
-
-    def compare(self, a, b):  # pragma: no cover
-        assert False
-
-    def matches(self, obj, keys):
-        return True
-
-    def as_sql(self):  # pragma: no cover
-        return 'TRUE', {}
-
-
-class No(Condition):
-
-    def compare(self, a, b):  # pragma: no cover
-        assert False
-
-    def matches(self, obj, keys):
-        return False
-
-    def as_sql(self):  # pragma: no cover
-        return 'FALSE', {}
-
-
-class AccessIsAllowed(Condition):  # pragma: no cover
-
-    def __init__(self, req_params, allow):
-        self._params = req_params
-        self._allow = allow or []
-
-    def matches(self, obj, keys):  # pragma: no cover
-
-        def rule_allows(r):
-            qvarn.log.log('zzz', obj=obj, r=r, params=self._params)
-            p = self._params
-            return (
-                r['method'] == p['method'] and
-                r['client_id'] in ('*', p['client_id']) and
-                r['user_id'] in ('*', p['user_id']) and
-                r['resource_id'] in ('*', keys['obj_id']) and
-                ('type' not in obj or
-                 r['resource_type'] in (None, obj['type'])) and
-                (r['resource_field'] is None or r['resource_field'] in obj) and
-                (r['resource_value'] in ('*', obj.get(r['resource_field'])))
-            )
+# This is shared by all threads. Queries built by sql_select use a
+# counter of their own instead.
+_counter = slog.Counter()
+_counter_lock = threading.Lock()
 
-        qvarn.log.log('yyy', allow=self._allow)
-        return any(rule_allows(r) for r in self._allow)
 
-    def as_sql(self):  # pragma: no cover
-        placeholders = {
-            key: placeholder(key)
-            for key in self._params
-        }
-        values = {
-            quote(key): self._params[key]
-            for key in self._params
-        }
-        query = ' AND '.join([
-            "_allow.method = {method}",
-            "_allow.subpath = _objects.subpath",
-            "(_allow.client_id = '*' OR _allow.client_id = {client_id})",
-            "(_allow.user_id = '*' OR _allow.user_id = {user_id})",
-            ("(_allow.resource_id = '*' OR _"
-             "allow.resource_id = _objects.obj_id)"),
-        ]).format(**placeholders)
-        return query, values
+def get_unique_name(base, counter=None):  # pragma: no cover
+    if counter is None:
+        with _counter_lock:
+            return '{}{}'.format(base, _counter.increment())
+    return '{}{}'.format(base, counter.increment())
@@ -29,27 +29,11 @@ def select_on_multiple_conds(counter, conds, allow_cond, keys_check):
     params = {
         'count': len(conds),
     }
-
-    part_template = "(_field->>'name' = %({name})s AND {valuecmp})"
-    parts = []
-    for subcond in conds:
-        if isinstance(subcond, qvarn.Cmp):
-            name = qvarn.get_unique_name('name', counter=counter)
-            value = qvarn.get_unique_name('value', counter=counter)
-            params[name] = subcond.name
-            params[value] = subcond.pattern
-            part = part_template.format(
-                name=name,
-                valuecmp=subcond.cmp_sql(value),
-            )
-        else:  # pragma: no cover
-            part, values = subcond.as_sql()
-            params.update(values)
-        parts.append(part)
+    parts = get_cond_parts(counter, conds, params)
 
     template = ' '.join('''
-        SELECT DISTINCT _objects.obj_id, _objects.subpath, _objects._obj
-            FROM _objects, {allow_table} (
+        SELECT _objects.obj_id, _objects.subpath, _objects._obj
+            FROM _objects, (
             SELECT obj_id, count(obj_id) AS _hits FROM _aux WHERE
             {parts}
             GROUP BY obj_id
@@ -59,22 +43,71 @@ def select_on_multiple_conds(counter, conds, allow_cond, keys_check):
             {keys_check} AND {allow_check}
     '''.split())
 
-    allow_table = ''
     allow_check = 'TRUE'
     if allow_cond is not None:
-        allow_table = '_allow, '
         allow_check, allow_params = allow_cond.as_sql()
         params.update(allow_params)
 
     query = template.format(
         parts=' OR '.join(parts),
         keys_check=keys_check,
-        allow_table=allow_table,
         allow_check=allow_check,
     )
     return query, params
 
 
+def select_matching_keys(counter, cond, aux_name, key_names, keys):
+    # Select the keys of the objects that match cond. Unlike
+    # sql_select, an object matches only by its own rows in the aux
+    # table, not by those of other sub-resources of the same resource.
+    conds = list(flatten(cond))
+    params = {
+        'count': len(conds),
+    }
+    parts = get_cond_parts(counter, conds, params)
+
+    checks = ['TRUE']
+    for key in keys:
+        checks.append('{} = {}'.format(
+            qvarn.quote(key), qvarn.placeholder(key)))
+        params[qvarn.quote(key)] = keys[key]
+
+    template = ' '.join('''
+        SELECT {columns} FROM {aux}
+            WHERE ({parts}) AND {keys_check}
+            GROUP BY {columns}
+            HAVING count(*) >= %(count)s
+    '''.split())
+
+    query = template.format(
+        columns=', '.join(qvarn.quote(key) for key in key_names),
+        aux=qvarn.quote(aux_name),
+        parts=' OR '.join(parts),
+        keys_check=' AND '.join(checks),
+    )
+    return query, params
+
+
+def get_cond_parts(counter, conds, params):
+    part_template = "(_field->>'name' = %({name})s AND {valuecmp})"
+    parts = []
+    for subcond in conds:
+        if isinstance(subcond, qvarn.Cmp):
+            name = qvarn.get_unique_name('name', counter=counter)
+            value = qvarn.get_unique_name('value', counter=counter)
+            params[name] = subcond.name
+            params[value] = subcond.pattern
+            part = part_template.format(
+                name=name,
+                valuecmp=subcond.cmp_sql(value),
+            )
+        else:  # pragma: no cover
+            part, values = subcond.as_sql()
+            params.update(values)
+        parts.append(part)
+    return parts
+
+
 def flatten(cond):
     subs = cond.get_subconditions()
     if subs:
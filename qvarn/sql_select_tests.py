@@ -40,3 +40,20 @@ class SqlSelectTests(unittest.TestCase):
         query, values = qvarn.sql_select(counter, cond, all_cond, 'TRUE')
         self.assertTrue(isinstance(query, str))
         self.assertTrue(isinstance(values, dict))
+
+    def test_returns_same_query_for_same_conditions(self):
+        def select():
+            cond = qvarn.All(
+                qvarn.Equal('foo', 'bar'), qvarn.NotEqual('foo2', 'bar2'))
+            return qvarn.sql_select(slog.Counter(), cond, None, 'TRUE')
+
+        self.assertEqual(select(), select())
+
+    def test_selects_matching_keys_by_all_key_columns(self):
+        cond = qvarn.Equal('foo', 'bar')
+        query, values = qvarn.select_matching_keys(
+            slog.Counter(), cond, '_aux', ['obj_id', 'subpath'],
+            {'subpath': 'sub'})
+        self.assertTrue('GROUP BY obj_id, subpath' in query)
+        self.assertEqual(values['subpath'], 'sub')
+        self.assertEqual(values['count'], 1)
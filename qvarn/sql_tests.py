@@ -19,90 +19,85 @@ import unittest
 import qvarn
 
 
-class AllConditionTests(unittest.TestCase):
-
-    def test_returns_true_without_subconditions(self):
-        self.assertTrue(qvarn.All().matches(None, None))
-
-    def test_returns_false_without_false_subcondition(self):
-        cond = qvarn.All(qvarn.No())
-        self.assertFalse(cond.matches(None, None))
-
-    def test_returns_appended_subcondition(self):
-        cond = qvarn.All()
-        yes = qvarn.Yes()
-        cond.append_subcondition(yes)
-        self.assertEqual(cond.get_subconditions(), [yes])
-
-    def test_returns_true_with_true_subconditions(self):
-        cond = qvarn.All()
-        yes = qvarn.Yes()
-        cond.append_subcondition(yes)
-        self.assertTrue(cond.matches(None, None))
-
-
-class CmpTests(unittest.TestCase):
-
-    def cmp_test(self, klass, pattern, actual, expected):
-        obj = klass(None, pattern)
-        self.assertEqual(obj.cmp_py(actual), expected)
-
-    def test_equal(self):
-        self.cmp_test(qvarn.Equal, 'foo', 'foo', True)
-        self.cmp_test(qvarn.Equal, 'foo', 'bar', False)
-
-    def test_not_equal(self):
-        self.cmp_test(qvarn.NotEqual, 'foo', 'foo', False)
-        self.cmp_test(qvarn.NotEqual, 'foo', 'bar', True)
-
-    def test_greater_than(self):
-        self.cmp_test(qvarn.GreaterThan, 'foo', 'bar', False)
-        self.cmp_test(qvarn.GreaterThan, 'foo', 'foo', False)
-        self.cmp_test(qvarn.GreaterThan, 'foo', 'yo', True)
-
-        self.cmp_test(qvarn.GreaterThan, 1, 0, False)
-        self.cmp_test(qvarn.GreaterThan, 1, 1, False)
-        self.cmp_test(qvarn.GreaterThan, 1, 2, True)
-
-    def test_greater_than_or_equal(self):
-        self.cmp_test(qvarn.GreaterOrEqual, 'foo', 'bar', False)
-        self.cmp_test(qvarn.GreaterOrEqual, 'foo', 'foo', True)
-        self.cmp_test(qvarn.GreaterOrEqual, 'foo', 'yo', True)
-
-        self.cmp_test(qvarn.GreaterOrEqual, 1, 0, False)
-        self.cmp_test(qvarn.GreaterOrEqual, 1, 1, True)
-        self.cmp_test(qvarn.GreaterOrEqual, 1, 2, True)
-
-    def test_less_than(self):
-        self.cmp_test(qvarn.LessThan, 'foo', 'bar', True)
-        self.cmp_test(qvarn.LessThan, 'foo', 'foo', False)
-        self.cmp_test(qvarn.LessThan, 'foo', 'yo', False)
-
-        self.cmp_test(qvarn.LessThan, 1, 0, True)
-        self.cmp_test(qvarn.LessThan, 1, 1, False)
-        self.cmp_test(qvarn.LessThan, 1, 2, False)
-
-    def test_less_than_or_equal(self):
-        self.cmp_test(qvarn.LessOrEqual, 'foo', 'bar', True)
-        self.cmp_test(qvarn.LessOrEqual, 'foo', 'foo', True)
-        self.cmp_test(qvarn.LessOrEqual, 'foo', 'yo', False)
-
-        self.cmp_test(qvarn.LessOrEqual, 1, 0, True)
-        self.cmp_test(qvarn.LessOrEqual, 1, 1, True)
-        self.cmp_test(qvarn.LessOrEqual, 1, 2, False)
-
-    def test_contains(self):
-        self.cmp_test(qvarn.Contains, 'o', 'foo', True)
-        self.cmp_test(qvarn.Contains, 'foo', 'foo', True)
-        self.cmp_test(qvarn.Contains, 'foo', 'bar', False)
-
-    def test_starts_with(self):
-        self.cmp_test(qvarn.Startswith, 'foo', 'o', False)
-        self.cmp_test(qvarn.Startswith, 'foo', 'foo', True)
-        self.cmp_test(qvarn.Startswith, 'foo', 'foobar', True)
-
-    def test_resource_type_is(self):
-        restype = {
-            'type': 'foo',
-        }
-        self.assertTrue(qvarn.ResourceTypeIs('foo').matches(restype, None))
+class PreparedStatementTests(unittest.TestCase):
+
+    def test_select_is_preparable(self):
+        self.assertTrue(qvarn.is_preparable('select * from foo'))
+
+    def test_delete_is_preparable(self):
+        self.assertTrue(qvarn.is_preparable(' DELETE FROM foo'))
+
+    def test_create_table_is_not_preparable(self):
+        self.assertFalse(qvarn.is_preparable('CREATE TABLE foo (bar TEXT)'))
+
+    def test_empty_query_is_not_preparable(self):
+        self.assertFalse(qvarn.is_preparable(''))
+
+    def test_statement_name_ignores_whitespace(self):
+        self.assertEqual(
+            qvarn.get_statement_name('SELECT  *\n FROM foo'),
+            qvarn.get_statement_name('SELECT * FROM foo'))
+
+    def test_statement_name_differs_for_different_queries(self):
+        self.assertNotEqual(
+            qvarn.get_statement_name('SELECT * FROM foo'),
+            qvarn.get_statement_name('SELECT * FROM bar'))
+
+    def test_converts_placeholders_to_parameters(self):
+        query, names = qvarn.prepare_query(
+            'SELECT * FROM foo WHERE a = %(a)s AND b = %(b)s OR a < %(a)s')
+        self.assertEqual(
+            query, 'SELECT * FROM foo WHERE a = $1 AND b = $2 OR a < $1')
+        self.assertEqual(names, ['a', 'b'])
+
+    def test_unescapes_percent_signs(self):
+        query, names = qvarn.prepare_query(
+            "SELECT * FROM foo WHERE a LIKE '%%' || %(a)s")
+        self.assertEqual(query, "SELECT * FROM foo WHERE a LIKE '%' || $1")
+        self.assertEqual(names, ['a'])
+
+
+class ExplainTests(unittest.TestCase):
+
+    def test_select_is_explainable(self):
+        self.assertTrue(qvarn.is_explainable(' select * from foo'))
+
+    def test_delete_is_not_explainable(self):
+        self.assertFalse(qvarn.is_explainable('DELETE FROM foo'))
+
+    def test_with_is_not_explainable(self):
+        self.assertFalse(qvarn.is_explainable(
+            'WITH x AS (DELETE FROM foo RETURNING *) SELECT * FROM x'))
+
+    def test_empty_query_is_not_explainable(self):
+        self.assertFalse(qvarn.is_explainable(''))
+
+    def test_explain_query_analyzes_with_buffers(self):
+        self.assertEqual(
+            qvarn.get_explain_query('SELECT * FROM foo'),
+            'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT * FROM foo')
+
+
+class UniqueRowsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.t = qvarn.sql.Transaction(None, None)
+
+    def test_removes_duplicates_as_unique_index_compares_them(self):
+        # Rows the unique index considers equal must be removed as
+        # duplicates, or creating the index fails.
+        index = self.t.create_unique_index('foo', 'foo_idx', 'a', 'b')
+        dedup = self.t.remove_duplicate_rows('foo', 'a', 'b')
+        columns = (
+            "(a IS NULL), COALESCE(a, ''), (b IS NULL), COALESCE(b, '')")
+        self.assertTrue('({})'.format(columns) in index)
+        self.assertTrue('PARTITION BY {}'.format(columns) in dedup)
+
+    def test_removes_duplicates_of_plain_columns(self):
+        dedup = self.t.remove_duplicate_rows(
+            'foo', 'a', 'b', nulls_equal=False)
+        self.assertTrue('PARTITION BY a, b)' in dedup)
+
+    def test_drops_index_if_it_exists(self):
+        self.assertEqual(
+            self.t.drop_index('foo_idx'), 'DROP INDEX IF EXISTS foo_idx')
@@ -17,20 +17,32 @@
 import time
 
 
+import bottle
+
 import qvarn
 
 
 class Stopwatch:
 
+    '''Log how long a block of code takes.
+
+    The block is also a span of the current trace, if there is one.
+
+    '''
+
     def __init__(self, msg, **kwargs):
         self.started = None
         self.msg = msg
         self.kwargs = kwargs
+        self.span = None
 
     def __enter__(self):
+        self.span = qvarn.tracer.span(self.msg, **self.kwargs)
+        self.span.__enter__()
         self.started = time.time()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.span.__exit__(exc_type, exc_val, exc_tb)
         if exc_type is None:
             duration = time.time() - self.started
             qvarn.log.log(
@@ -39,7 +51,29 @@ class Stopwatch:
 
 
 def stopwatch(callback, msg, **swkwargs):  # pragma: no cover
+    # The duration of each request also goes into a histogram, with
+    # the route, HTTP method, response status, and the keyword
+    # arguments (such as resource_type) as labels.
+    histogram = qvarn.metrics.histogram(
+        'qvarn_request_duration_seconds', 'Duration of API requests')
+
     def stopwatch_wrapper(content_type, body, *args, **kwargs):
-        with qvarn.Stopwatch(msg, **swkwargs):
-            return callback(content_type, body, *args, **kwargs)
+        started = time.time()
+        status = 'error'
+        try:
+            with qvarn.Stopwatch(msg, **swkwargs):
+                response = callback(content_type, body, *args, **kwargs)
+            status = get_status(response)
+            return response
+        finally:
+            histogram.observe(
+                time.time() - started, route=msg,
+                method=bottle.request.method, status=status, **swkwargs)
     return stopwatch_wrapper
+
+
+def get_status(response):  # pragma: no cover
+    try:
+        return str(response['status'])
+    except (KeyError, TypeError):
+        return 'unknown'
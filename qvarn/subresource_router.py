@@ -36,12 +36,14 @@ class SubresourceRouter(qvarn.Router):
 
     def get_routes(self):
 
+        rt = self._parent_coll.get_type()
+
         def S(callback, msg, **kwargs):
-            return qvarn.stopwatch(callback, msg, **kwargs)
+            return qvarn.stopwatch(
+                callback, msg, resource_type=rt.get_type(), **kwargs)
 
-        rt = self._parent_coll.get_type()
         path = '{}/<id>/{}'.format(rt.get_path(), self._subpath)
-        return [
+        routes = [
             {
                 'method': 'GET',
                 'path': path,
@@ -53,6 +55,7 @@ class SubresourceRouter(qvarn.Router):
                 'callback': S(self._put_subresource, 'PUT subresource'),
             },
         ]
+        return self.in_units_of_work(routes, self._parent_coll)
 
     def _get_subresource(self, *args, **kwargs):
         claims = kwargs.get('claims')
@@ -86,7 +89,8 @@ class SubresourceRouter(qvarn.Router):
         rt = self._parent_coll.get_type()
         validator = qvarn.Validator()
         try:
-            validator.validate_subresource(self._subpath, rt, body)
+            with qvarn.tracer.span('validate'):
+                validator.validate_subresource(self._subpath, rt, body)
         except qvarn.ValidationError as e:
             qvarn.log.log('error', msg_text=str(e), body=body)
             return qvarn.bad_request_response(str(e))
@@ -0,0 +1,74 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Parsing access tokens and the headers that carry them. The same
+# tokens arrive over and over again, in request after request, so
+# parsing results are kept in small LRU caches keyed by the raw
+# header values. Signatures are not checked here: apifw has already
+# done that for the tokens that matter.
+
+
+import copy
+import functools
+import re
+
+import jwt
+
+
+CACHE_SIZE = 1024
+
+
+def decode_token(token):
+    # Claims may be lists, such as "aud", so a deep copy is needed to
+    # keep callers from changing the cached value.
+    return copy.deepcopy(_decode_token(token))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _decode_token(token):
+    return jwt.decode(
+        token,
+        verify=False,
+        audience=None, options={'verify_aud': False}
+    )
+
+
+def get_accessors(ahead, qhead, ohead):
+    return [
+        {
+            'accessor_id': copy.deepcopy(accessor_id),
+            'accessor_type': accessor_type,
+        }
+        for accessor_id, accessor_type in _parse_accessors(ahead, qhead, ohead)
+    ]
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _parse_accessors(ahead, qhead, ohead):
+    token_headers = ahead
+    if qhead:
+        token_headers = ', '.join([ahead, qhead])
+    encoded_tokens = re.split(r'(?:\A|,\s*)Bearer ', token_headers)[1:]
+    tokens = [_decode_token(t) for t in encoded_tokens]
+    persons = [(t['sub'], 'person') for t in tokens]
+    clients = [(t['aud'], 'client') for t in tokens]
+    orgs = [
+        (t, 'org')
+        for t in re.findall(r',?\s*Org (.+?)(?:,|\Z)', ohead) if t]
+    others = [
+        (t, 'other')
+        for t in re.findall(r',?\s*Other (.+?)(?:,|\Z)', ohead) if t]
+    return tuple([*persons, *clients, *orgs, *others])
@@ -0,0 +1,104 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import jwt
+
+import qvarn
+
+
+def encode(claims):
+    token = jwt.encode(claims, 'secret', algorithm='HS256')
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    return token
+
+
+class DecodeTokenTests(unittest.TestCase):
+
+    def test_returns_claims(self):
+        claims = {
+            'sub': 'user-1',
+            'aud': 'client-1',
+        }
+        self.assertEqual(qvarn.decode_token(encode(claims)), claims)
+
+    def test_returns_a_new_copy_every_time(self):
+        token = encode({'sub': 'user-1'})
+        claims = qvarn.decode_token(token)
+        claims['sub'] = 'someone else'
+        self.assertEqual(qvarn.decode_token(token), {'sub': 'user-1'})
+
+    def test_does_not_share_list_claims(self):
+        token = encode({'sub': 'user-1', 'aud': ['client-1']})
+        claims = qvarn.decode_token(token)
+        claims['aud'].append('client-2')
+        self.assertEqual(qvarn.decode_token(token)['aud'], ['client-1'])
+
+
+class GetAccessorsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.token = encode({'sub': 'user-1', 'aud': 'client-1'})
+        self.token2 = encode({'sub': 'user-2', 'aud': 'client-2'})
+
+    def test_returns_nothing_without_headers(self):
+        self.assertEqual(qvarn.get_accessors('', '', ''), [])
+
+    def test_returns_person_and_client_from_token(self):
+        ahead = 'Bearer {}'.format(self.token)
+        self.assertEqual(
+            qvarn.get_accessors(ahead, '', ''),
+            [
+                {'accessor_id': 'user-1', 'accessor_type': 'person'},
+                {'accessor_id': 'client-1', 'accessor_type': 'client'},
+            ]
+        )
+
+    def test_returns_accessors_from_all_headers(self):
+        ahead = 'Bearer {}'.format(self.token)
+        qhead = 'Bearer {}'.format(self.token2)
+        ohead = 'Org org-1, Other other-1'
+        self.assertEqual(
+            qvarn.get_accessors(ahead, qhead, ohead),
+            [
+                {'accessor_id': 'user-1', 'accessor_type': 'person'},
+                {'accessor_id': 'user-2', 'accessor_type': 'person'},
+                {'accessor_id': 'client-1', 'accessor_type': 'client'},
+                {'accessor_id': 'client-2', 'accessor_type': 'client'},
+                {'accessor_id': 'org-1', 'accessor_type': 'org'},
+                {'accessor_id': 'other-1', 'accessor_type': 'other'},
+            ]
+        )
+
+    def test_returns_a_new_list_every_time(self):
+        ahead = 'Bearer {}'.format(self.token)
+        accessors = qvarn.get_accessors(ahead, '', '')
+        accessors[0]['accessor_id'] = 'someone else'
+        accessors.append({})
+        self.assertEqual(len(qvarn.get_accessors(ahead, '', '')), 2)
+        self.assertEqual(
+            qvarn.get_accessors(ahead, '', '')[0]['accessor_id'], 'user-1')
+
+    def test_does_not_share_list_audiences(self):
+        token = encode({'sub': 'user-1', 'aud': ['client-1']})
+        ahead = 'Bearer {}'.format(token)
+        accessors = qvarn.get_accessors(ahead, '', '')
+        accessors[1]['accessor_id'].append('client-2')
+        self.assertEqual(
+            qvarn.get_accessors(ahead, '', '')[1]['accessor_id'],
+            ['client-1'])
@@ -0,0 +1,191 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import random
+import threading
+import time
+
+
+import qvarn
+
+
+class Tracer:
+
+    '''Record how long the parts of handling a request take.
+
+    A trace is started for each request, in the thread handling it,
+    with start_trace. A sample of traces is recorded: for the others,
+    spans cost next to nothing. A span is a named, timed piece of work,
+    such as validation or an SQL query, and spans nest. When the
+    outermost span of a trace ends, its spans are given to the writer.
+
+    Spans are recorded as events in the Trace Event format, which
+    chrome://tracing and Perfetto can show.
+
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._writer = None
+        self._sample_rate = 0
+
+    def configure(self, writer, sample_rate=1.0):
+        self._writer = writer
+        self._sample_rate = sample_rate
+
+    def start_trace(self, trace_id):
+        # Events recorded after the outermost span of the previous
+        # trace ended, such as the transactions of a file streamed in
+        # chunks, are written before that trace is replaced.
+        old = self._get_trace()
+        if old is not None and old.has_events():
+            self._finish(old)
+
+        trace = None
+        if self._writer is not None and random.random() < self._sample_rate:
+            trace = Trace(trace_id)
+        self._local.trace = trace
+
+    def get_trace_id(self):
+        trace = self._get_trace()
+        if trace is None:
+            return None
+        return trace.trace_id
+
+    def _get_trace(self):
+        return getattr(self._local, 'trace', None)
+
+    def span(self, name, **args):
+        trace = self._get_trace()
+        if trace is None:
+            return _null_span
+        return Span(self, trace, name, args)
+
+    def record(self, name, started, ended, **args):
+        # Record a span that has already ended, timed by the caller.
+        trace = self._get_trace()
+        if trace is not None:
+            trace.add_event(name, started, ended, args)
+
+    def _finish(self, trace):
+        # A trace is only a diagnostic aid: failing to write it, in
+        # whatever way, must not fail the request.
+        events = trace.pop_events()
+        try:
+            self._writer.write(events)
+        except Exception as e:  # pragma: no cover pylint: disable=broad-except
+            qvarn.log.log(
+                'error', msg_text='Could not write trace',
+                trace_id=trace.trace_id, exception=str(e))
+
+
+class Trace:
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.depth = 0
+        self._events = []
+
+    def add_event(self, name, started, ended, args):
+        args = dict(args)
+        args['trace_id'] = self.trace_id
+        self._events.append({
+            'name': name,
+            'cat': 'qvarn',
+            'ph': 'X',
+            'ts': int(started * 1000000),
+            'dur': int((ended - started) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+    def has_events(self):
+        return bool(self._events)
+
+    def pop_events(self):
+        events = self._events
+        self._events = []
+        return events
+
+
+class Span:
+
+    def __init__(self, owner, trace, name, args):
+        self._tracer = owner
+        self._trace = trace
+        self._name = name
+        self._args = args
+        self._started = None
+
+    def __enter__(self):
+        self._trace.depth += 1
+        self._started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        ended = time.time()
+        if exc_type is not None:
+            self._args['error'] = exc_type.__name__
+        self._trace.add_event(self._name, self._started, ended, self._args)
+        self._trace.depth -= 1
+        if self._trace.depth == 0:
+            self._tracer._finish(self._trace)
+        return False
+
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null_span = NullSpan()
+
+
+class TraceFileWriter:
+
+    '''Append trace events to a file, as a JSON array.
+
+    The closing bracket of the array is never written, which the
+    Trace Event format allows, so that events can be appended to the
+    file as long as Qvarn runs. Each process must write its own file:
+    "{pid}" in the filename is replaced with the process id.
+
+    '''
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+
+    def write(self, events):
+        text = ''.join(json.dumps(event) + ',\n' for event in events)
+        filename = self._filename.format(pid=os.getpid())
+        with self._lock:
+            with open(filename, 'a') as f:
+                if f.tell() == 0:
+                    text = '[\n' + text
+                f.write(text)
+
+
+# The tracer the Qvarn server uses, configured by the trace-file and
+# trace-sample-rate settings.
+tracer = Tracer()
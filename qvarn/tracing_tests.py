@@ -0,0 +1,159 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+import qvarn
+
+
+class TracerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = DummyWriter()
+        self.tracer = qvarn.Tracer()
+        self.tracer.configure(self.writer, sample_rate=1.0)
+
+    def test_has_no_trace_id_without_trace(self):
+        self.assertEqual(self.tracer.get_trace_id(), None)
+
+    def test_records_nothing_without_trace(self):
+        with self.tracer.span('foo'):
+            pass
+        self.assertEqual(self.writer.traces, [])
+
+    def test_records_nothing_if_not_sampled(self):
+        self.tracer.configure(self.writer, sample_rate=0)
+        self.tracer.start_trace('trace 1')
+        self.assertEqual(self.tracer.get_trace_id(), None)
+        with self.tracer.span('foo'):
+            pass
+        self.assertEqual(self.writer.traces, [])
+
+    def test_records_nothing_if_not_configured(self):
+        tracer = qvarn.Tracer()
+        tracer.start_trace('trace 1')
+        with tracer.span('foo'):
+            pass
+        self.assertEqual(tracer.get_trace_id(), None)
+
+    def test_records_span(self):
+        self.tracer.start_trace('trace 1')
+        self.assertEqual(self.tracer.get_trace_id(), 'trace 1')
+        with self.tracer.span('foo', bar='yo'):
+            pass
+        self.assertEqual(len(self.writer.traces), 1)
+        [event] = self.writer.traces[0]
+        self.assertEqual(event['name'], 'foo')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['pid'], os.getpid())
+        self.assertTrue(event['dur'] >= 0)
+        self.assertEqual(event['args'], {'bar': 'yo', 'trace_id': 'trace 1'})
+
+    def test_writes_nested_spans_when_outermost_ends(self):
+        self.tracer.start_trace('trace 1')
+        with self.tracer.span('outer'):
+            with self.tracer.span('inner'):
+                pass
+            self.assertEqual(self.writer.traces, [])
+        names = [event['name'] for event in self.writer.traces[0]]
+        self.assertEqual(names, ['inner', 'outer'])
+
+    def test_records_timed_span(self):
+        self.tracer.start_trace('trace 1')
+        with self.tracer.span('outer'):
+            self.tracer.record('query', 1.0, 1.5, query='SELECT')
+        event = self.writer.traces[0][0]
+        self.assertEqual(event['name'], 'query')
+        self.assertEqual(event['ts'], 1000000)
+        self.assertEqual(event['dur'], 500000)
+        self.assertEqual(event['args']['query'], 'SELECT')
+
+    def test_records_exception(self):
+        self.tracer.start_trace('trace 1')
+        with self.assertRaises(ZeroDivisionError):
+            with self.tracer.span('foo'):
+                raise ZeroDivisionError()
+        [event] = self.writer.traces[0]
+        self.assertEqual(event['args']['error'], 'ZeroDivisionError')
+
+    def test_new_trace_replaces_old(self):
+        self.tracer.start_trace('trace 1')
+        self.tracer.start_trace('trace 2')
+        with self.tracer.span('foo'):
+            pass
+        [event] = self.writer.traces[0]
+        self.assertEqual(event['args']['trace_id'], 'trace 2')
+
+    def test_new_trace_writes_events_recorded_after_old_one_ended(self):
+        self.tracer.start_trace('trace 1')
+        with self.tracer.span('foo'):
+            pass
+        self.tracer.record('query', 1.0, 1.5)
+        self.tracer.start_trace('trace 2')
+        self.assertEqual(len(self.writer.traces), 2)
+        [event] = self.writer.traces[1]
+        self.assertEqual(event['name'], 'query')
+        self.assertEqual(event['args']['trace_id'], 'trace 1')
+
+    def test_new_trace_writes_nothing_if_old_one_has_no_events_left(self):
+        self.tracer.start_trace('trace 1')
+        with self.tracer.span('foo'):
+            pass
+        self.tracer.start_trace('trace 2')
+        self.assertEqual(len(self.writer.traces), 1)
+
+
+class TraceFileWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_appends_events_as_json_array(self):
+        filename = os.path.join(self.tempdir, 'trace.json')
+        writer = qvarn.TraceFileWriter(filename)
+        writer.write([{'name': 'foo'}])
+        writer.write([{'name': 'bar'}, {'name': 'foobar'}])
+        with open(filename) as f:
+            text = f.read()
+        events = json.loads(text.rstrip().rstrip(',') + ']')
+        self.assertEqual(
+            events,
+            [{'name': 'foo'}, {'name': 'bar'}, {'name': 'foobar'}])
+
+    def test_puts_pid_in_filename(self):
+        filename = os.path.join(self.tempdir, 'trace-{pid}.json')
+        writer = qvarn.TraceFileWriter(filename)
+        writer.write([{'name': 'foo'}])
+        expected = os.path.join(
+            self.tempdir, 'trace-{}.json'.format(os.getpid()))
+        self.assertTrue(os.path.exists(expected))
+
+
+class DummyWriter:
+
+    def __init__(self):
+        self.traces = []
+
+    def write(self, events):
+        self.traces.append(events)